@@ -0,0 +1,105 @@
+'''
+Accounting export CLI: streams an export table for a date range into a gzip file.
+
+    DATABASE_URL=... python backend/admin/export.py transactions --from 2026-01-01 --to 2026-02-01 \
+        --format csv --workers 4 --output transactions_2026_01.csv.gz
+
+With --workers > 1 the key range is split into chunks exported in parallel over one
+shared snapshot; the gzip parts are concatenated into a single valid gzip file.
+'''
+import argparse
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import List, Optional, Tuple
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from index import EXPORT_FORMATS, EXPORT_TABLES, write_export
+
+def connect(dsn: str):
+    return psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+
+def split_key_range(conn, table: str, workers: int) -> List[Optional[Tuple[int, int]]]:
+    if workers <= 1:
+        return [None]
+
+    key = EXPORT_TABLES[table]['key_column']
+    cur = conn.cursor()
+    cur.execute(f"SELECT MIN({key}) AS lo, MAX({key}) AS hi FROM {table}")
+    bounds = cur.fetchone()
+    cur.close()
+    if bounds['lo'] is None:
+        return [None]
+
+    lo, hi = bounds['lo'], bounds['hi'] + 1
+    step = max(1, -(-(hi - lo) // workers))
+    return [(start, min(start + step, hi)) for start in range(lo, hi, step)]
+
+def export_chunk(dsn: str, snapshot: str, path: str, table: str, date_from: date, date_to: date,
+                 fmt: str, key_range: Optional[Tuple[int, int]], header: bool) -> None:
+    conn = connect(dsn)
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    try:
+        cur = conn.cursor()
+        cur.execute(f"SET TRANSACTION SNAPSHOT '{snapshot}'")
+        cur.close()
+        with open(path, 'wb') as out:
+            write_export(conn, out, table, date_from, date_to, fmt, key_range, header)
+        conn.rollback()
+    finally:
+        conn.close()
+
+def run_export(dsn: str, table: str, date_from: date, date_to: date, fmt: str, workers: int, output: str) -> None:
+    coordinator = connect(dsn)
+    coordinator.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    try:
+        ranges = split_key_range(coordinator, table, workers)
+        cur = coordinator.cursor()
+        cur.execute("SELECT pg_export_snapshot() AS snapshot")
+        snapshot = cur.fetchone()['snapshot']
+        cur.close()
+
+        parts = [f'{output}.part{i}' for i in range(len(ranges))]
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            futures = [
+                pool.submit(export_chunk, dsn, snapshot, part, table, date_from, date_to, fmt, key_range, i == 0)
+                for i, (part, key_range) in enumerate(zip(parts, ranges))
+            ]
+            for future in futures:
+                future.result()
+    finally:
+        coordinator.close()
+
+    with open(output, 'wb') as out:
+        for part in parts:
+            with open(part, 'rb') as chunk:
+                shutil.copyfileobj(chunk, out)
+            os.remove(part)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Export accounting data as gzip-compressed CSV or NDJSON')
+    parser.add_argument('table', choices=sorted(EXPORT_TABLES))
+    parser.add_argument('--from', dest='date_from', required=True, type=date.fromisoformat, help='inclusive, YYYY-MM-DD')
+    parser.add_argument('--to', dest='date_to', required=True, type=date.fromisoformat, help='exclusive, YYYY-MM-DD')
+    parser.add_argument('--format', dest='fmt', choices=EXPORT_FORMATS, default='csv')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--output')
+    parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'))
+    args = parser.parse_args(argv)
+
+    if not args.dsn:
+        parser.error('--dsn or DATABASE_URL is required')
+    if args.date_from >= args.date_to:
+        parser.error('--from must be before --to')
+
+    output = args.output or f'{args.table}_{args.date_from}_{args.date_to}.{args.fmt}.gz'
+    run_export(args.dsn, args.table, args.date_from, args.date_to, args.fmt, max(1, args.workers), output)
+    print(output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
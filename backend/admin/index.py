@@ -1,22 +1,475 @@
 import json
 import os
-import secrets
-import string
-from typing import Dict, Any
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import time
+import math
+import hashlib
+import io
+from datetime import date, datetime
+from typing import Dict, Any, List, Optional, Tuple
 
-def get_db_connection():
-    database_url = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(database_url, cursor_factory=RealDictCursor)
+import metrics
+from replica import current_wal_lsn, get_db_connection, get_last_write_lsn, get_read_connection, last_write_headers
+from responses import JSON_HEADERS, encoded_response, json_response, error_response
+
+TRANSACTION_KINDS = {'ad_view': 1, 'credit': 2, 'withdrawal': 3, 'campaign_create': 4, 'campaign_refund': 5, 'campaign_import': 6}
+TRANSACTION_KIND_NAMES = {kind: name for name, kind in TRANSACTION_KINDS.items()}
+MODERATION_LEASE_MINUTES = int(os.environ.get('MODERATION_LEASE_MINUTES', '10'))
+EXPORT_MAX_DAYS = int(os.environ.get('EXPORT_MAX_DAYS', '7'))
+EXPORT_MAX_BYTES = int(os.environ.get('EXPORT_MAX_BYTES', str(4 * 1024 * 1024)))
+EXPORT_FORMATS = ('csv', 'ndjson')
+EXPORT_TABLES = {
+    'transactions': {
+        'columns': 'id, user_id, kind, amount, ref_id, created_at',
+        'date_column': 'created_at',
+        'key_column': 'id'
+    },
+    'ad_views': {
+        'columns': 'id, user_id, campaign_id, reward, completed, completed_at, created_at',
+        'date_column': 'created_at',
+        'key_column': 'id'
+    },
+    'withdrawal_requests': {
+        'columns': 'id, user_id, credits, usd_amount, method_id, wallet_address, status, created_at, processed_at',
+        'date_column': 'created_at',
+        'key_column': 'id'
+    },
+    'referral_earnings': {
+        'columns': 'referrer_id, referred_user_id, day, views, credits',
+        'date_column': 'day',
+        'key_column': 'referrer_id'
+    }
+}
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400'))
+IDEMPOTENCY_CACHE_SIZE = 1000
+IDEMPOTENCY_PURGE_EVERY = 100
+IDEMPOTENCY_PURGE_BATCH = 1000
+_idempotency_cache: Dict[Tuple[str, str], Tuple[float, int, str]] = {}
+PURGE_EXPIRED_RESPONSES_SQL = f"""DELETE FROM idempotency_keys WHERE ctid = ANY (ARRAY(
+    SELECT ctid FROM idempotency_keys
+    WHERE created_at < NOW() - INTERVAL '{IDEMPOTENCY_TTL_SECONDS} seconds'
+    ORDER BY created_at LIMIT {IDEMPOTENCY_PURGE_BATCH}))"""
+VOUCHERS_LIST_SQL = """SELECT id, code, credits, is_used, used_by, used_at, created_at
+    FROM vouchers ORDER BY created_at DESC LIMIT 100"""
+WITHDRAWALS_LIST_SQL = """SELECT wr.id, wr.user_id, u.username, u.email, wr.credits, wr.usd_amount,
+           wr.wallet_address, wm.name as method_name, wr.status, wr.created_at
+    FROM withdrawal_requests wr
+    JOIN users u ON wr.user_id = u.id
+    JOIN withdrawal_methods wm ON wr.method_id = wm.id
+    ORDER BY wr.created_at DESC LIMIT 100"""
+VOUCHER_FILTER_TTL_SECONDS = float(os.environ.get('VOUCHER_FILTER_TTL_SECONDS', '60'))
+VOUCHER_FILTER_REBUILD_SECONDS = float(os.environ.get('VOUCHER_FILTER_REBUILD_SECONDS', '3600'))
+
+class VoucherCodeFilter:
+    '''
+    Bloom filter over issued voucher codes, ~1% false positives. Lives in the warm
+    container and is trusted while fresh, so a guessed code is rejected without a query.
+    Staleness is bounded: codes issued by another container are missing for up to
+    VOUCHER_FILTER_TTL_SECONDS, and a generate_vouchers batch that commits after a newer
+    batch was already picked up waits for the full rebuild (VOUCHER_FILTER_REBUILD_SECONDS).
+    Redeemed codes stay in it, so a retried redemption still reaches its stored response.
+    '''
+    
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(capacity * 2, 1000)
+        self.size = int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self.built_at = time.time()
+        self.refreshed_at = self.built_at
+        self.watermark = None
+    
+    def _positions(self, code: str):
+        digest = hashlib.blake2b(code.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+    
+    def add(self, code: str) -> None:
+        self.count += 1
+        for pos in self._positions(code):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+    
+    def __contains__(self, code: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(code))
+    
+    def is_fresh(self) -> bool:
+        return time.time() - self.refreshed_at < VOUCHER_FILTER_TTL_SECONDS
+    
+    def needs_rebuild(self) -> bool:
+        return self.count > self.capacity or time.time() - self.built_at >= VOUCHER_FILTER_REBUILD_SECONDS
+
+class ExportTooLarge(Exception):
+    pass
+
+class CappedExportBuffer(io.BytesIO):
+    '''
+    Response body of the HTTP export action. It is held in memory and base64-encoded,
+    so it refuses to grow past EXPORT_MAX_BYTES; larger exports go through export.py.
+    '''
+    
+    def write(self, data) -> int:
+        if self.tell() + len(data) > EXPORT_MAX_BYTES:
+            raise ExportTooLarge()
+        return super().write(data)
+
+_voucher_filter = None
+
+def build_voucher_filter(cur) -> VoucherCodeFilter:
+    cur.execute("SELECT COUNT(*) AS total, MAX(created_at) AS watermark FROM vouchers")
+    row = cur.fetchone()
+    voucher_filter = VoucherCodeFilter(row['total'])
+    voucher_filter.watermark = row['watermark']
+    
+    codes_cur = cur.connection.cursor(name='voucher_filter_codes')
+    codes_cur.itersize = 10000
+    codes_cur.execute("SELECT code FROM vouchers")
+    for row in codes_cur:
+        voucher_filter.add(row['code'])
+    codes_cur.close()
+    metrics.count_cache('voucher_filter', 'rebuild')
+    return voucher_filter
+
+def build_voucher_refresh_query(watermark: Optional[datetime]) -> str:
+    since = f"'{watermark.isoformat()}'::timestamp" if watermark is not None else "'-infinity'::timestamp"
+    return f"SELECT code, created_at FROM vouchers WHERE created_at > {since}"
+
+def refresh_voucher_filter(conn) -> None:
+    '''
+    Bring a stale filter up to date in a short read transaction of its own, before the
+    redemption starts: only codes created after the newest one already seen, or a full
+    rebuild when the container has none, it is over capacity or past the rebuild age.
+    At most once per VOUCHER_FILTER_TTL_SECONDS; a failure keeps the previous filter.
+    '''
+    global _voucher_filter
+    if _voucher_filter is not None and _voucher_filter.is_fresh():
+        return
+    
+    import psycopg2
+    
+    cur = conn.cursor()
+    try:
+        if _voucher_filter is None or _voucher_filter.needs_rebuild():
+            _voucher_filter = build_voucher_filter(cur)
+        else:
+            cur.execute(build_voucher_refresh_query(_voucher_filter.watermark))
+            for row in cur.fetchall():
+                _voucher_filter.add(row['code'])
+                _voucher_filter.watermark = max(_voucher_filter.watermark or row['created_at'], row['created_at'])
+            _voucher_filter.refreshed_at = time.time()
+            metrics.count_cache('voucher_filter', 'catch_up')
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+    finally:
+        cur.close()
+
+def remember_voucher_codes(codes: List[str]) -> None:
+    '''Codes this container just issued are redeemable here at once, without a refresh'''
+    if _voucher_filter is not None:
+        for code in codes:
+            _voucher_filter.add(code)
+
+def is_unknown_voucher(voucher_code: str) -> bool:
+    '''True when a fresh filter is loaded and lacks the code; the caller answers 404 without SQL'''
+    if _voucher_filter is None or not _voucher_filter.is_fresh():
+        metrics.count_cache('voucher_filter', 'cold')
+        return False
+    unknown = voucher_code not in _voucher_filter
+    metrics.count_cache('voucher_filter', 'rejected' if unknown else 'passed')
+    return unknown
+
+def voucher_filter_stats() -> Dict[str, float]:
+    if _voucher_filter is None:
+        return {'loaded': 0}
+    return {
+        'loaded': 1,
+        'bits': _voucher_filter.size,
+        'hash_count': _voucher_filter.hash_count,
+        'codes': _voucher_filter.count,
+        'age_seconds': round(time.time() - _voucher_filter.built_at, 1),
+        'refreshed_seconds_ago': round(time.time() - _voucher_filter.refreshed_at, 1)
+    }
+
+metrics.register_cache('voucher_filter', voucher_filter_stats)
 
 def escape_sql_string(value: str) -> str:
     return value.replace("'", "''")
 
+def build_stats_series_query(granularity: str, days: int, filters: str) -> str:
+    if granularity == 'hour':
+        return f"""
+            SELECT hour AS bucket, SUM(views)::bigint AS views, SUM(spend) AS spend,
+                   SUM(payouts) AS payouts, SUM(referral_payouts) AS referral_payouts
+            FROM campaign_stats_hourly
+            WHERE hour >= DATE_TRUNC('hour', NOW()) - INTERVAL '{days} days' {filters}
+            GROUP BY hour
+            ORDER BY hour
+            """
+    return f"""
+        SELECT day AS bucket, SUM(views)::bigint AS views, SUM(spend) AS spend,
+               SUM(payouts) AS payouts, SUM(referral_payouts) AS referral_payouts
+        FROM campaign_stats_daily
+        WHERE day > CURRENT_DATE - {days} {filters}
+        GROUP BY day
+        ORDER BY day
+        """
+
+def fetch_stats_series(cur, granularity: str, days: int, filters: str) -> list:
+    '''Time-series of views, spend and payouts from campaign_stats_hourly/daily rollups'''
+    cur.execute(build_stats_series_query(granularity, days, filters))
+    return cur.fetchall()
+
+def build_withdrawal_history_query(user_id: int) -> str:
+    return f"""SELECT wr.id, wr.credits, wr.usd_amount, wr.wallet_address, wr.status, 
+               wr.created_at, wm.name as method_name
+        FROM withdrawal_requests wr
+        JOIN withdrawal_methods wm ON wr.method_id = wm.id
+        WHERE wr.user_id = {int(user_id)}
+        ORDER BY wr.created_at DESC LIMIT 50"""
+
+def build_transaction_history_query(user_id: int, limit: int, kind: Optional[int] = None,
+                                    cursor: Optional[Tuple[datetime, int]] = None) -> str:
+    '''One keyset page (limit + 1 rows, to tell whether a next page exists), newest first'''
+    filters = f"t.user_id = {int(user_id)}"
+    if kind:
+        filters += f" AND t.kind = {int(kind)}"
+    if cursor:
+        filters += f" AND (t.created_at, t.id) < ('{cursor[0].isoformat()}', {int(cursor[1])})"
+    return f"""SELECT t.id, t.kind, t.amount, t.ref_id, t.created_at,
+               v.code AS voucher_code, c.title AS campaign_title
+        FROM transactions t
+        LEFT JOIN vouchers v ON t.kind = {TRANSACTION_KINDS['credit']} AND v.id = t.ref_id
+        LEFT JOIN campaigns c ON t.kind = {TRANSACTION_KINDS['campaign_create']} AND c.id = t.ref_id
+        WHERE {filters}
+        ORDER BY t.created_at DESC, t.id DESC
+        LIMIT {int(limit) + 1}"""
+
+def render_transaction_description(row: Dict[str, Any]) -> str:
+    kind = row['kind']
+    if kind == TRANSACTION_KINDS['ad_view']:
+        return f"Viewed campaign #{row['ref_id']}"
+    if kind == TRANSACTION_KINDS['credit']:
+        return f"Voucher: {row['voucher_code']}" if row['voucher_code'] else 'Voucher'
+    if kind == TRANSACTION_KINDS['withdrawal']:
+        return f"Withdrawal #{row['ref_id']}"
+    if kind == TRANSACTION_KINDS['campaign_create']:
+        return f"Created campaign: {row['campaign_title']}" if row['campaign_title'] else 'Created campaign'
+    if kind == TRANSACTION_KINDS['campaign_import']:
+        return f"Imported campaigns starting at #{row['ref_id']}"
+    if kind == TRANSACTION_KINDS['campaign_refund']:
+        return f"Refund for rejected campaign #{row['ref_id']}"
+    return ''
+
+def get_idempotency_key(headers: Dict[str, Any]) -> Optional[str]:
+    key = headers.get('idempotency-key') or headers.get('Idempotency-Key') or ''
+    return str(key).strip()[:100] or None
+
+def replay_response(status_code: int, body: str, last_write_lsn: str) -> Dict[str, Any]:
+    '''Stored response with a WAL position at or after the original write, so reads that follow a replay see it too'''
+    return {
+        'statusCode': status_code,
+        'headers': {**JSON_HEADERS, 'Access-Control-Expose-Headers': 'Idempotent-Replayed, X-Last-Write-LSN',
+                    'Idempotent-Replayed': 'true', 'X-Last-Write-LSN': last_write_lsn},
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+def remember_response(scope: str, key: str, status_code: int, body: str, last_write_lsn: str) -> None:
+    if len(_idempotency_cache) >= IDEMPOTENCY_CACHE_SIZE:
+        _idempotency_cache.pop(next(iter(_idempotency_cache)))
+    _idempotency_cache[(scope, key)] = (time.time() + IDEMPOTENCY_TTL_SECONDS, status_code, body, last_write_lsn)
+
+def find_cached_response(scope: str, key: str) -> Optional[Dict[str, Any]]:
+    entry = _idempotency_cache.get((scope, key))
+    if entry and entry[0] > time.time():
+        metrics.count_cache('idempotency', 'hit')
+        return replay_response(entry[1], entry[2], entry[3])
+    metrics.count_cache('idempotency', 'miss')
+    return None
+
+metrics.register_cache('idempotency', lambda: {'entries': len(_idempotency_cache), 'capacity': IDEMPOTENCY_CACHE_SIZE})
+
+def build_stored_response_query(scope: str, key: str) -> str:
+    return f"""SELECT status_code, response FROM idempotency_keys
+        WHERE scope = '{escape_sql_string(scope)}' AND idem_key = '{escape_sql_string(key)}'
+          AND created_at > NOW() - INTERVAL '{IDEMPOTENCY_TTL_SECONDS} seconds'"""
+
+def find_stored_response(cur, scope: str, key: str) -> Optional[Dict[str, Any]]:
+    '''Replay of a response already stored for this key: in-memory tier first, then idempotency_keys'''
+    cached = find_cached_response(scope, key)
+    if cached:
+        return cached
+    
+    cur.execute(build_stored_response_query(scope, key))
+    row = cur.fetchone()
+    if not row:
+        return None
+    # The write that stored the row has committed, so the primary's current position covers it
+    last_write_lsn = current_wal_lsn(cur)
+    remember_response(scope, key, row['status_code'], row['response'], last_write_lsn)
+    return replay_response(row['status_code'], row['response'], last_write_lsn)
+
+def purge_expired_responses(conn) -> None:
+    '''
+    About once per IDEMPOTENCY_PURGE_EVERY stored responses, delete up to
+    IDEMPOTENCY_PURGE_BATCH rows past the TTL in a short transaction of their own,
+    so idempotency_keys stays bounded without a scheduled job. Runs after the
+    caller's commit; a failure here never affects the response.
+    '''
+    if int.from_bytes(os.urandom(2), 'little') % IDEMPOTENCY_PURGE_EVERY:
+        return
+    
+    import psycopg2
+    
+    cur = conn.cursor()
+    try:
+        cur.execute(PURGE_EXPIRED_RESPONSES_SQL)
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+    finally:
+        cur.close()
+
+def store_response(cur, scope: str, key: str, response: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    '''
+    Record the response inside the caller's transaction (an expired row is overwritten).
+    If a concurrent request with the same key committed first, the caller's transaction is
+    rolled back and that request's response is returned instead.
+    '''
+    cur.execute(
+        f"""INSERT INTO idempotency_keys (scope, idem_key, status_code, response)
+            VALUES ('{escape_sql_string(scope)}', '{escape_sql_string(key)}', {response['statusCode']}, '{escape_sql_string(response['body'])}')
+            ON CONFLICT (scope, idem_key) DO UPDATE SET
+                status_code = EXCLUDED.status_code, response = EXCLUDED.response, created_at = NOW()
+            WHERE idempotency_keys.created_at <= NOW() - INTERVAL '{IDEMPOTENCY_TTL_SECONDS} seconds'
+            RETURNING idem_key"""
+    )
+    if cur.fetchone():
+        return None
+    
+    cur.connection.rollback()
+    return find_stored_response(cur, scope, key) or error_response(409, 'Request with this Idempotency-Key is already in progress')
+
+def build_export_query(table: str, date_from: date, date_to: date, key_range: Optional[Tuple[int, int]] = None) -> str:
+    spec = EXPORT_TABLES[table]
+    where = f"{spec['date_column']} >= '{date_from.isoformat()}' AND {spec['date_column']} < '{date_to.isoformat()}'"
+    if key_range:
+        where += f" AND {spec['key_column']} >= {int(key_range[0])} AND {spec['key_column']} < {int(key_range[1])}"
+    return f"SELECT {spec['columns']} FROM {table} WHERE {where}"
+
+def write_export(conn, out, table: str, date_from: date, date_to: date, fmt: str = 'csv',
+                 key_range: Optional[Tuple[int, int]] = None, header: bool = True) -> None:
+    '''
+    Write rows of an export table into binary file `out` as gzip-compressed CSV or NDJSON.
+    CSV goes through COPY ... TO STDOUT, NDJSON through a named server-side cursor,
+    so memory stays constant regardless of the row count.
+    '''
+    import gzip
+    
+    query = build_export_query(table, date_from, date_to, key_range)
+    with gzip.GzipFile(fileobj=out, mode='wb') as gz:
+        if fmt == 'csv':
+            cur = conn.cursor()
+            cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER {'true' if header else 'false'})", gz)
+            cur.close()
+        else:
+            cur = conn.cursor(name=f'export_{table}')
+            cur.itersize = 10000
+            cur.execute(f"SELECT row_to_json(t)::text AS line FROM ({query}) t")
+            for row in cur:
+                gz.write(row['line'].encode())
+                gz.write(b'\n')
+            cur.close()
+
+def parse_user_id(value: Any) -> Optional[int]:
+    '''users.id from a request; None unless it is a positive INTEGER'''
+    try:
+        user_id = int(value)
+    except (TypeError, ValueError):
+        return None
+    return user_id if 0 < user_id <= 2147483647 else None
+
+def build_voucher_redemption_query(voucher_code: str, user_id: int) -> str:
+    '''Mark the voucher used, credit the user and write the ledger row; no row when it cannot be redeemed'''
+    return f"""
+        WITH redeemed AS (
+            UPDATE vouchers SET is_used = TRUE, used_by = {user_id}, used_at = NOW()
+            WHERE code = '{escape_sql_string(voucher_code)}' AND is_used = FALSE
+              AND EXISTS (SELECT 1 FROM users WHERE id = {user_id})
+            RETURNING id, credits
+        ), credited AS (
+            UPDATE users SET credits = users.credits + redeemed.credits
+            FROM redeemed
+            WHERE users.id = {user_id}
+            RETURNING users.credits AS new_balance, redeemed.id AS voucher_id, redeemed.credits AS voucher_credits
+        ), ledger AS (
+            INSERT INTO transactions (user_id, amount, kind, ref_id)
+            SELECT {user_id}, voucher_credits, {TRANSACTION_KINDS['credit']}, voucher_id FROM credited
+        )
+        SELECT new_balance, voucher_credits FROM credited
+        """
+
+def build_moderation_lease_query(moderator: str, batch_size: int) -> str:
+    moderator_escaped = escape_sql_string(moderator)
+    return f"""
+        UPDATE campaigns
+        SET moderation_lease_owner = '{moderator_escaped}',
+            moderation_lease_until = NOW() + INTERVAL '{MODERATION_LEASE_MINUTES} minutes'
+        WHERE id IN (
+            SELECT id FROM campaigns
+            WHERE moderation_status = 'pending'
+              AND (moderation_lease_until IS NULL OR moderation_lease_until < NOW()
+                   OR moderation_lease_owner = '{moderator_escaped}')
+            ORDER BY created_at, id
+            LIMIT {int(batch_size)}
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, advertiser_id, title, url, budget, required_views, created_at, moderation_lease_until
+        """
+
+def build_moderation_query(moderator: str, decision: str, campaign_ids: List[int]) -> str:
+    '''Approve, or reject and refund, the pending campaigns not leased to another moderator'''
+    ids_sql = ', '.join(str(int(cid)) for cid in campaign_ids)
+    claimable = f"""id IN ({ids_sql}) AND moderation_status = 'pending'
+        AND (moderation_lease_owner = '{escape_sql_string(moderator)}'
+             OR moderation_lease_until IS NULL OR moderation_lease_until < NOW())"""
+    
+    if decision == 'approve':
+        return f"""
+            UPDATE campaigns
+            SET moderation_status = 'approved', is_active = true, updated_at = NOW(),
+                moderation_lease_owner = NULL, moderation_lease_until = NULL
+            WHERE {claimable}
+            RETURNING id
+            """
+    return f"""
+        WITH rejected AS (
+            UPDATE campaigns
+            SET moderation_status = 'rejected', is_active = false, updated_at = NOW(),
+                moderation_lease_owner = NULL, moderation_lease_until = NULL
+            WHERE {claimable}
+            RETURNING id, advertiser_id, budget - spent AS refund
+        ), refunds AS (
+            UPDATE users SET ad_balance = users.ad_balance + totals.refund
+            FROM (SELECT advertiser_id, SUM(refund) AS refund FROM rejected GROUP BY advertiser_id) totals
+            WHERE users.id = totals.advertiser_id
+        ), ledger AS (
+            INSERT INTO transactions (user_id, amount, kind, ref_id)
+            SELECT advertiser_id, refund, {TRANSACTION_KINDS['campaign_refund']}, id
+            FROM rejected WHERE refund > 0
+        )
+        SELECT id FROM rejected
+        """
+
 def generate_voucher_code() -> str:
+    import secrets
+    import string
+    
     chars = string.ascii_uppercase + string.digits
     return ''.join(secrets.choice(chars) for _ in range(20))
 
+@metrics.instrument('admin')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Unified admin/user endpoint - vouchers, withdrawals, settings
@@ -32,14 +485,32 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token, X-Last-Write-LSN, Idempotency-Key',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
     
-    conn = get_db_connection()
+    idempotency_key = get_idempotency_key(event.get('headers') or {})
+    if method == 'POST':
+        body_data = json.loads(event.get('body', '{}'))
+        # user_id is part of idempotency_keys.scope (VARCHAR(50)): only a valid id goes in
+        idempotency_scope = f"{body_data.get('action')}:{parse_user_id(body_data.get('user_id'))}"
+        if idempotency_key and body_data.get('action') in ['activate_voucher', 'request_withdrawal']:
+            cached = find_cached_response(idempotency_scope, idempotency_key)
+            if cached:
+                return cached
+        
+        # Checked before any idempotency lookup: an unknown code has nothing to replay
+        voucher_code = str(body_data.get('voucher_code') or '').strip().upper()
+        if body_data.get('action') == 'activate_voucher' and voucher_code and is_unknown_voucher(voucher_code):
+            return error_response(404, 'Voucher not found')
+    
+    if method == 'GET':
+        conn = get_read_connection(get_last_write_lsn(event.get('headers') or {}))
+    else:
+        conn = get_db_connection()
     cur = conn.cursor()
     
     try:
@@ -48,32 +519,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             action = params.get('action', '')
             
             if action == 'vouchers':
-                cur.execute(
-                    """SELECT id, code, credits, is_used, used_by, used_at, created_at
-                       FROM vouchers ORDER BY created_at DESC LIMIT 100"""
-                )
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'vouchers': [dict(v) for v in cur.fetchall()]}),
-                    'isBase64Encoded': False
-                }
+                cur.execute(VOUCHERS_LIST_SQL)
+                return json_response(200, {'vouchers': cur.fetchall()}, event)
             
             elif action == 'withdrawals':
-                cur.execute(
-                    """SELECT wr.id, wr.user_id, u.username, u.email, wr.credits, wr.usd_amount,
-                              wr.wallet_address, wm.name as method_name, wr.status, wr.created_at
-                       FROM withdrawal_requests wr
-                       JOIN users u ON wr.user_id = u.id
-                       JOIN withdrawal_methods wm ON wr.method_id = wm.id
-                       ORDER BY wr.created_at DESC LIMIT 100"""
-                )
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'withdrawals': [dict(w) for w in cur.fetchall()]}),
-                    'isBase64Encoded': False
-                }
+                cur.execute(WITHDRAWALS_LIST_SQL)
+                return json_response(200, {'withdrawals': cur.fetchall()}, event)
             
             elif action == 'withdrawal_methods':
                 cur.execute("SELECT id, name FROM withdrawal_methods WHERE is_active = TRUE ORDER BY id")
@@ -82,36 +533,90 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 rate_row = cur.fetchone()
                 rate = float(rate_row['value']) if rate_row else 100.0
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'methods': [dict(m) for m in methods], 'conversion_rate': rate}),
-                    'isBase64Encoded': False
-                }
+                return json_response(200, {'methods': methods, 'conversion_rate': rate})
             
             elif action == 'withdrawal_history':
                 user_id = params.get('user_id')
                 if not user_id:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'user_id required'}),
-                        'isBase64Encoded': False
-                    }
+                    return error_response(400, 'user_id required')
+                
+                cur.execute(build_withdrawal_history_query(user_id))
+                return json_response(200, {'history': cur.fetchall()}, event)
+            
+            elif action == 'transaction_history':
+                user_id = params.get('user_id')
+                tx_type = params.get('type')
+                cursor = params.get('cursor')
+                
+                try:
+                    user_id = int(user_id)
+                    limit = int(params.get('limit', 50))
+                    if cursor:
+                        cursor_created_at, cursor_id = cursor.rsplit('|', 1)
+                        cursor_created_at = datetime.fromisoformat(cursor_created_at)
+                        cursor_id = int(cursor_id)
+                except (TypeError, ValueError):
+                    user_id = None
+                
+                if not user_id or limit <= 0 or limit > 200 or (tx_type and tx_type not in TRANSACTION_KINDS):
+                    return error_response(400, 'Invalid params (user_id, 1 <= limit <= 200, type, cursor)')
+                
+                cur.execute(build_transaction_history_query(
+                    user_id, limit, TRANSACTION_KINDS.get(tx_type), (cursor_created_at, cursor_id) if cursor else None
+                ))
+                rows = cur.fetchall()
+                page = rows[:limit]
+                next_cursor = None
+                if len(rows) > limit:
+                    next_cursor = f"{page[-1]['created_at'].isoformat()}|{page[-1]['id']}"
+                
+                return json_response(200, {
+                    'transactions': [
+                        {
+                            'id': t['id'],
+                            'type': TRANSACTION_KIND_NAMES.get(t['kind'], 'other'),
+                            'amount': t['amount'],
+                            'ref_id': t['ref_id'],
+                            'description': render_transaction_description(t),
+                            'created_at': t['created_at']
+                        }
+                        for t in page
+                    ],
+                    'next_cursor': next_cursor
+                }, event)
+            
+            elif action == 'export':
+                table = params.get('table')
+                fmt = params.get('format', 'csv')
+                try:
+                    date_from = date.fromisoformat(params.get('from', ''))
+                    date_to = date.fromisoformat(params.get('to', ''))
+                except ValueError:
+                    date_from = date_to = None
+                
+                if (table not in EXPORT_TABLES or fmt not in EXPORT_FORMATS or not date_from or not date_to
+                        or not 0 < (date_to - date_from).days <= EXPORT_MAX_DAYS):
+                    return error_response(400, f'Invalid params (table, format csv/ndjson, from < to within {EXPORT_MAX_DAYS} days)')
+                
+                import base64
+                
+                buffer = CappedExportBuffer()
+                try:
+                    write_export(conn, buffer, table, date_from, date_to, fmt)
+                except ExportTooLarge:
+                    return error_response(
+                        413, f'Export exceeds {EXPORT_MAX_BYTES} compressed bytes; use a shorter range or backend/admin/export.py'
+                    )
                 
-                cur.execute(
-                    f"""SELECT wr.id, wr.credits, wr.usd_amount, wr.wallet_address, wr.status, 
-                               wr.created_at, wm.name as method_name
-                        FROM withdrawal_requests wr
-                        JOIN withdrawal_methods wm ON wr.method_id = wm.id
-                        WHERE wr.user_id = {int(user_id)}
-                        ORDER BY wr.created_at DESC LIMIT 50"""
-                )
                 return {
                     'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'history': [dict(h) for h in cur.fetchall()]}),
-                    'isBase64Encoded': False
+                    'headers': {
+                        'Content-Type': 'application/gzip',
+                        'Access-Control-Allow-Origin': '*',
+                        'Content-Disposition': f'attachment; filename="{table}_{date_from}_{date_to}.{fmt}.gz"'
+                    },
+                    'body': base64.b64encode(buffer.getvalue()).decode(),
+                    'isBase64Encoded': True
                 }
             
             elif action == 'settings':
@@ -120,94 +625,109 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 cur.execute("SELECT id, name, is_active FROM withdrawal_methods ORDER BY id")
                 methods = cur.fetchall()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'settings': {s['key']: s['value'] for s in settings},
-                        'withdrawal_methods': [dict(m) for m in methods]
-                    }),
-                    'isBase64Encoded': False
-                }
+                return json_response(200, {
+                    'settings': {s['key']: s['value'] for s in settings},
+                    'withdrawal_methods': methods
+                })
+        
+            elif action == 'analytics':
+                granularity = params.get('granularity', 'day')
+                try:
+                    days = int(params.get('days', 7 if granularity == 'hour' else 30))
+                    advertiser_id = int(params['advertiser_id']) if params.get('advertiser_id') else None
+                    campaign_id = int(params['campaign_id']) if params.get('campaign_id') else None
+                except ValueError:
+                    days = 0
+                    advertiser_id = campaign_id = None
+                
+                if granularity not in ('hour', 'day') or days <= 0 or days > (7 if granularity == 'hour' else 365):
+                    return error_response(400, 'Invalid params (granularity hour: 1-7 days, day: 1-365 days)')
+                
+                filters = ''
+                if advertiser_id:
+                    filters += f" AND advertiser_id = {advertiser_id}"
+                if campaign_id:
+                    filters += f" AND campaign_id = {campaign_id}"
+                
+                return json_response(200, {
+                    'granularity': granularity,
+                    'series': fetch_stats_series(cur, granularity, days, filters)
+                }, event)
         
         elif method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
             action = body_data.get('action')
             
             if action == 'activate_voucher':
-                voucher_code = body_data.get('voucher_code', '').strip().upper()
-                user_id = body_data.get('user_id')
+                user_id = parse_user_id(body_data.get('user_id'))
                 
                 if not voucher_code or not user_id:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Voucher code and user_id required'}),
-                        'isBase64Encoded': False
-                    }
-                
-                voucher_code_escaped = escape_sql_string(voucher_code)
-                cur.execute(f"SELECT id, credits, is_used FROM vouchers WHERE code = '{voucher_code_escaped}'")
-                voucher = cur.fetchone()
-                
-                if not voucher:
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Voucher not found'}),
-                        'isBase64Encoded': False
-                    }
-                
-                if voucher['is_used']:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Voucher already used'}),
-                        'isBase64Encoded': False
-                    }
-                
-                credits = float(voucher['credits'])
-                cur.execute(f"UPDATE vouchers SET is_used = TRUE, used_by = {user_id}, used_at = NOW() WHERE id = {voucher['id']}")
-                cur.execute(f"UPDATE users SET credits = credits + {credits} WHERE id = {user_id} RETURNING credits")
-                new_balance = cur.fetchone()
-                cur.execute(f"INSERT INTO transactions (user_id, amount, type, description) VALUES ({user_id}, {credits}, 'credit', 'Voucher: {voucher_code_escaped}')")
+                    return error_response(400, 'Voucher code and user_id required')
+                
+                refresh_voucher_filter(conn)
+                
+                if idempotency_key:
+                    stored = find_stored_response(cur, idempotency_scope, idempotency_key)
+                    if stored:
+                        return stored
+                
+                cur.execute(build_voucher_redemption_query(voucher_code, user_id))
+                redeemed = cur.fetchone()
+                
+                if not redeemed:
+                    conn.rollback()
+                    cur.execute(f"SELECT is_used FROM vouchers WHERE code = '{escape_sql_string(voucher_code)}'")
+                    voucher = cur.fetchone()
+                    if not voucher:
+                        error, status = 'Voucher not found', 404
+                    elif voucher['is_used']:
+                        error, status = 'Voucher already used', 400
+                    else:
+                        error, status = 'User not found', 404
+                    return error_response(status, error)
+                
+                credits = float(redeemed['voucher_credits'])
+                response = json_response(200, {
+                    'success': True,
+                    'credits_added': credits,
+                    'new_balance': redeemed['new_balance']
+                })
+                
+                if idempotency_key:
+                    stored = store_response(cur, idempotency_scope, idempotency_key, response)
+                    if stored:
+                        return stored
+                
                 conn.commit()
+                response['headers'].update(last_write_headers(cur))
+                if idempotency_key:
+                    remember_response(idempotency_scope, idempotency_key, response['statusCode'], response['body'],
+                                      response['headers']['X-Last-Write-LSN'])
+                    purge_expired_responses(conn)
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'success': True,
-                        'credits_added': credits,
-                        'new_balance': float(new_balance['credits'])
-                    }),
-                    'isBase64Encoded': False
-                }
+                return response
             
             elif action == 'request_withdrawal':
-                user_id = body_data.get('user_id')
-                credits = float(body_data.get('credits', 0))
-                method_id = body_data.get('method_id')
-                wallet_address = body_data.get('wallet_address', '').strip()
+                user_id = parse_user_id(body_data.get('user_id'))
+                try:
+                    credits = float(body_data.get('credits', 0))
+                    method_id = int(body_data.get('method_id'))
+                except (TypeError, ValueError):
+                    credits, method_id = 0, None
+                wallet_address = str(body_data.get('wallet_address') or '').strip()
                 
                 if not all([user_id, credits > 0, method_id, wallet_address]):
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'All fields required'}),
-                        'isBase64Encoded': False
-                    }
+                    return error_response(400, 'All fields required')
+                
+                if idempotency_key:
+                    stored = find_stored_response(cur, idempotency_scope, idempotency_key)
+                    if stored:
+                        return stored
                 
                 cur.execute(f"SELECT credits FROM users WHERE id = {user_id}")
                 user = cur.fetchone()
                 
                 if not user or float(user['credits']) < credits:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Insufficient credits'}),
-                        'isBase64Encoded': False
-                    }
+                    return error_response(400, 'Insufficient credits')
                 
                 cur.execute("SELECT value FROM settings WHERE key = 'credits_to_usd_rate'")
                 rate_row = cur.fetchone()
@@ -221,27 +741,29 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 )
                 request_id = cur.fetchone()['id']
                 cur.execute(f"UPDATE users SET credits = credits - {credits} WHERE id = {user_id}")
-                cur.execute(f"INSERT INTO transactions (user_id, amount, type, description) VALUES ({user_id}, -{credits}, 'withdrawal', 'Withdrawal #{request_id}')")
+                cur.execute(f"INSERT INTO transactions (user_id, amount, kind, ref_id) VALUES ({user_id}, -{credits}, {TRANSACTION_KINDS['withdrawal']}, {request_id})")
+                response = json_response(201, {'success': True, 'request_id': request_id, 'usd_amount': round(usd_amount, 2)})
+                
+                if idempotency_key:
+                    stored = store_response(cur, idempotency_scope, idempotency_key, response)
+                    if stored:
+                        return stored
+                
                 conn.commit()
+                response['headers'].update(last_write_headers(cur))
+                if idempotency_key:
+                    remember_response(idempotency_scope, idempotency_key, response['statusCode'], response['body'],
+                                      response['headers']['X-Last-Write-LSN'])
+                    purge_expired_responses(conn)
                 
-                return {
-                    'statusCode': 201,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True, 'request_id': request_id, 'usd_amount': round(usd_amount, 2)}),
-                    'isBase64Encoded': False
-                }
+                return response
             
             elif action == 'generate_vouchers':
                 credits = float(body_data.get('credits', 0))
                 count = int(body_data.get('count', 1))
                 
                 if credits <= 0 or count <= 0 or count > 1000:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Invalid params (credits > 0, 1 <= count <= 1000)'}),
-                        'isBase64Encoded': False
-                    }
+                    return error_response(400, 'Invalid params (credits > 0, 1 <= count <= 1000)')
                 
                 vouchers = []
                 for _ in range(count):
@@ -251,61 +773,87 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     vouchers.append({'id': voucher['id'], 'code': voucher['code'], 'credits': credits})
                 
                 conn.commit()
+                remember_voucher_codes([v['code'] for v in vouchers])
                 csv_content = "Code,Credits\n" + "\n".join(f"{v['code']},{v['credits']}" for v in vouchers)
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {
-                        'Content-Type': 'text/csv',
-                        'Access-Control-Allow-Origin': '*',
-                        'Content-Disposition': f'attachment; filename="vouchers_{len(vouchers)}.csv"'
-                    },
-                    'body': csv_content,
-                    'isBase64Encoded': False
-                }
+                return encoded_response(200, csv_content.encode(), {
+                    'Content-Type': 'text/csv',
+                    'Access-Control-Allow-Origin': '*',
+                    'Content-Disposition': f'attachment; filename="vouchers_{len(vouchers)}.csv"',
+                    **last_write_headers(cur)
+                }, event)
             
             elif action == 'update_rate':
                 rate = float(body_data.get('rate', 100))
                 if rate <= 0:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Rate must be > 0'}),
-                        'isBase64Encoded': False
-                    }
+                    return error_response(400, 'Rate must be > 0')
                 
                 cur.execute(f"UPDATE settings SET value = '{rate}', updated_at = NOW() WHERE key = 'credits_to_usd_rate'")
                 conn.commit()
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True, 'rate': rate}),
-                    'isBase64Encoded': False
-                }
+                return json_response(200, {'success': True, 'rate': rate}, headers=last_write_headers(cur))
             
             elif action == 'toggle_withdrawal_method':
                 method_id = int(body_data.get('method_id'))
                 is_active = body_data.get('is_active', True)
                 cur.execute(f"UPDATE withdrawal_methods SET is_active = {is_active} WHERE id = {method_id}")
                 conn.commit()
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True}),
-                    'isBase64Encoded': False
-                }
+                return json_response(200, {'success': True}, headers=last_write_headers(cur))
+            
+            elif action == 'moderation_lease':
+                moderator = str(body_data.get('moderator') or '').strip()[:100]
+                batch_size = int(body_data.get('batch_size', 50))
+                
+                if not moderator or batch_size <= 0 or batch_size > 500:
+                    return error_response(400, 'Invalid params (moderator, 1 <= batch_size <= 500)')
+                
+                cur.execute(build_moderation_lease_query(moderator, batch_size))
+                leased = sorted(cur.fetchall(), key=lambda c: (c['created_at'], c['id']))
+                conn.commit()
+                
+                return json_response(200, {
+                    'campaigns': [
+                        {
+                            'id': c['id'],
+                            'advertiser_id': c['advertiser_id'],
+                            'title': c['title'],
+                            'url': c['url'],
+                            'budget': c['budget'],
+                            'required_views': c['required_views'],
+                            'created_at': c['created_at']
+                        }
+                        for c in leased
+                    ],
+                    'lease_until': leased[0]['moderation_lease_until'] if leased else None
+                }, headers=last_write_headers(cur))
+            
+            elif action == 'moderate_campaigns':
+                moderator = str(body_data.get('moderator') or '').strip()[:100]
+                decision = body_data.get('decision')
+                try:
+                    campaign_ids = sorted({int(cid) for cid in body_data.get('campaign_ids') or []})
+                except (TypeError, ValueError):
+                    campaign_ids = []
+                
+                if not moderator or decision not in ['approve', 'reject'] or not campaign_ids or len(campaign_ids) > 500:
+                    return error_response(400, 'Invalid params (moderator, decision approve/reject, 1-500 campaign_ids)')
+                
+                cur.execute(build_moderation_query(moderator, decision, campaign_ids))
+                processed = sorted(row['id'] for row in cur.fetchall())
+                processed_ids = set(processed)
+                conn.commit()
+                
+                return json_response(200, {
+                    'success': True,
+                    'processed': processed,
+                    'skipped': [cid for cid in campaign_ids if cid not in processed_ids]
+                }, headers=last_write_headers(cur))
             
             elif action == 'process_withdrawal':
                 request_id = int(body_data.get('request_id'))
                 status = body_data.get('status', 'completed')
                 
                 if status not in ['completed', 'rejected']:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Invalid status'}),
-                        'isBase64Encoded': False
-                    }
+                    return error_response(400, 'Invalid status')
                 
                 cur.execute(
                     f"""UPDATE withdrawal_requests SET status = '{status}', processed_at = NOW() 
@@ -319,28 +867,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     cur.execute(f"UPDATE users SET credits = credits + {withdrawal['credits']} WHERE id = {withdrawal['user_id']}")
                 
                 conn.commit()
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True}),
-                    'isBase64Encoded': False
-                }
+                return json_response(200, {'success': True}, headers=last_write_headers(cur))
             
             else:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Invalid action'}),
-                    'isBase64Encoded': False
-                }
+                return error_response(400, 'Invalid action')
         
         else:
-            return {
-                'statusCode': 405,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
+            return error_response(405, 'Method not allowed')
     
     finally:
         cur.close()
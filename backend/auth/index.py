@@ -2,10 +2,13 @@ import json
 import os
 import hashlib
 import secrets
-from datetime import datetime, timedelta
 from typing import Dict, Any, Optional
-import psycopg2
-from psycopg2.extras import RealDictCursor
+
+import metrics
+from responses import json_response, error_response
+
+SESSION_TTL_DAYS = 30
+USER_COLUMNS = 'id, email, username, credits, ad_balance, total_clicks, total_payouts, referral_code, total_referral_earnings'
 
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
@@ -18,11 +21,51 @@ def generate_referral_code() -> str:
 
 def get_db_connection():
     database_url = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(database_url, cursor_factory=RealDictCursor)
+    return metrics.connect(database_url)
 
 def escape_sql_string(value: str) -> str:
     return value.replace("'", "''") 
 
+def build_register_query(email: str, password_hash: str, username: str, referral_code: str,
+                         referrer_code: str, session_token: str) -> str:
+    referrer = f"(SELECT id FROM users WHERE referral_code = '{escape_sql_string(referrer_code)}')" if referrer_code else 'NULL'
+    return f"""
+        WITH new_user AS (
+            INSERT INTO users (email, password_hash, username, referral_code, referred_by, credits)
+            VALUES ('{escape_sql_string(email)}', '{password_hash}', '{escape_sql_string(username)}',
+                    '{referral_code}', {referrer}, 0.00)
+            ON CONFLICT ((LOWER(email))) DO NOTHING
+            RETURNING {USER_COLUMNS}
+        ), new_session AS (
+            INSERT INTO sessions (user_id, session_token, expires_at)
+            SELECT id, '{session_token}', NOW() + INTERVAL '{SESSION_TTL_DAYS} days' FROM new_user
+        )
+        SELECT {USER_COLUMNS} FROM new_user
+        """
+
+def build_login_query(email: str, password_hash: str, session_token: str) -> str:
+    return f"""
+        WITH found AS (
+            SELECT {USER_COLUMNS}
+            FROM users
+            WHERE LOWER(email) = '{escape_sql_string(email)}' AND password_hash = '{password_hash}'
+        ), new_session AS (
+            INSERT INTO sessions (user_id, session_token, expires_at)
+            SELECT id, '{session_token}', NOW() + INTERVAL '{SESSION_TTL_DAYS} days' FROM found
+        )
+        SELECT {USER_COLUMNS} FROM found
+        """
+
+def build_verify_query(session_token: str) -> str:
+    return f"""
+        SELECT u.id, u.email, u.username, u.credits, u.ad_balance, u.total_clicks, u.total_payouts,
+               u.referral_code, u.total_referral_earnings
+        FROM sessions s
+        JOIN users u ON s.user_id = u.id
+        WHERE s.session_token = '{escape_sql_string(session_token)}' AND s.expires_at > NOW()
+        """
+
+@metrics.instrument('auth')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: User authentication with credits system and referral support
@@ -46,12 +89,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+        return error_response(405, 'Method not allowed')
     
     body_data = json.loads(event.get('body', '{}'))
     action = body_data.get('action')
@@ -61,191 +99,53 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     referral_code = body_data.get('referral_code', '').strip()
     
     if not email or not password:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Email and password are required'}),
-            'isBase64Encoded': False
-        }
+        return error_response(400, 'Email and password are required')
     
     conn = get_db_connection()
+    conn.autocommit = True
     cur = conn.cursor()
     
     try:
         if action == 'register':
             if not username:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Username is required'}),
-                    'isBase64Encoded': False
-                }
-            
-            email_escaped = escape_sql_string(email)
-            cur.execute(f"SELECT id FROM users WHERE email = '{email_escaped}'")
-            if cur.fetchone():
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Email already registered'}),
-                    'isBase64Encoded': False
-                }
-            
-            referrer_id = None
-            if referral_code:
-                referral_code_escaped = escape_sql_string(referral_code)
-                cur.execute(f"SELECT id FROM users WHERE referral_code = '{referral_code_escaped}'")
-                referrer = cur.fetchone()
-                if referrer:
-                    referrer_id = referrer['id']
-            
-            password_hash = hash_password(password)
-            username_escaped = escape_sql_string(username)
-            user_referral_code = generate_referral_code()
-            
-            if referrer_id:
-                cur.execute(
-                    f"""INSERT INTO users (email, password_hash, username, referral_code, referred_by, credits) 
-                        VALUES ('{email_escaped}', '{password_hash}', '{username_escaped}', '{user_referral_code}', {referrer_id}, 0.00) 
-                        RETURNING id"""
-                )
-            else:
-                cur.execute(
-                    f"""INSERT INTO users (email, password_hash, username, referral_code, credits) 
-                        VALUES ('{email_escaped}', '{password_hash}', '{username_escaped}', '{user_referral_code}', 0.00) 
-                        RETURNING id"""
-                )
-            
-            user_id = cur.fetchone()['id']
-            conn.commit()
+                return error_response(400, 'Username is required')
             
             session_token = generate_session_token()
-            expires_at = (datetime.now() + timedelta(days=30)).isoformat()
-            cur.execute(
-                f"INSERT INTO sessions (user_id, session_token, expires_at) VALUES ({user_id}, '{session_token}', '{expires_at}')"
-            )
-            conn.commit()
+            cur.execute(build_register_query(
+                email, hash_password(password), username, generate_referral_code(), referral_code, session_token
+            ))
+            user = cur.fetchone()
             
-            return {
-                'statusCode': 201,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'session_token': session_token,
-                    'user': {
-                        'id': user_id,
-                        'email': email,
-                        'username': username,
-                        'referral_code': user_referral_code
-                    }
-                }),
-                'isBase64Encoded': False
-            }
+            if not user:
+                return error_response(400, 'Email already registered')
+            
+            return json_response(201, {'success': True, 'session_token': session_token, 'user': user})
         
         elif action == 'login':
-            password_hash = hash_password(password)
-            email_escaped = escape_sql_string(email)
-            cur.execute(
-                f"""SELECT id, email, username, credits, ad_balance, total_clicks, total_payouts, 
-                           referral_code, total_referral_earnings 
-                    FROM users 
-                    WHERE email = '{email_escaped}' AND password_hash = '{password_hash}'"""
-            )
+            session_token = generate_session_token()
+            cur.execute(build_login_query(email, hash_password(password), session_token))
             user = cur.fetchone()
             
             if not user:
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Invalid credentials'}),
-                    'isBase64Encoded': False
-                }
-            
-            session_token = generate_session_token()
-            expires_at = (datetime.now() + timedelta(days=30)).isoformat()
-            cur.execute(
-                f"INSERT INTO sessions (user_id, session_token, expires_at) VALUES ({user['id']}, '{session_token}', '{expires_at}')"
-            )
-            conn.commit()
+                return error_response(401, 'Invalid credentials')
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'session_token': session_token,
-                    'user': {
-                        'id': user['id'],
-                        'email': user['email'],
-                        'username': user['username'],
-                        'credits': float(user['credits']),
-                        'ad_balance': float(user['ad_balance']),
-                        'total_clicks': user['total_clicks'],
-                        'total_payouts': float(user['total_payouts']),
-                        'referral_code': user['referral_code'],
-                        'total_referral_earnings': float(user['total_referral_earnings'])
-                    }
-                }),
-                'isBase64Encoded': False
-            }
+            return json_response(200, {'success': True, 'session_token': session_token, 'user': user})
         
         elif action == 'verify':
             session_token = body_data.get('session_token')
             if not session_token:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Session token required'}),
-                    'isBase64Encoded': False
-                }
+                return error_response(400, 'Session token required')
             
-            session_token_escaped = escape_sql_string(session_token)
-            cur.execute(
-                f"""
-                SELECT u.id, u.email, u.username, u.credits, u.ad_balance, u.total_clicks, u.total_payouts,
-                       u.referral_code, u.total_referral_earnings
-                FROM sessions s
-                JOIN users u ON s.user_id = u.id
-                WHERE s.session_token = '{session_token_escaped}' AND s.expires_at > NOW()
-                """
-            )
+            cur.execute(build_verify_query(session_token))
             user = cur.fetchone()
             
             if not user:
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Invalid or expired session'}),
-                    'isBase64Encoded': False
-                }
+                return error_response(401, 'Invalid or expired session')
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'user': {
-                        'id': user['id'],
-                        'email': user['email'],
-                        'username': user['username'],
-                        'credits': float(user['credits']),
-                        'ad_balance': float(user['ad_balance']),
-                        'total_clicks': user['total_clicks'],
-                        'total_payouts': float(user['total_payouts']),
-                        'referral_code': user['referral_code'],
-                        'total_referral_earnings': float(user['total_referral_earnings'])
-                    }
-                }),
-                'isBase64Encoded': False
-            }
+            return json_response(200, {'success': True, 'user': user})
         
         else:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid action'}),
-                'isBase64Encoded': False
-            }
+            return error_response(400, 'Invalid action')
     
     finally:
         cur.close()
@@ -0,0 +1,110 @@
+'''
+Response helpers for one backend function.
+
+Every function directory ships an identical copy of this module, like metrics.py.
+Bodies are serialized with orjson when it is installed (stdlib json otherwise);
+Decimal, datetime and date values from RealDictCursor rows are encoded directly,
+so handlers do not convert rows field by field. When the event is passed and the
+client sends Accept-Encoding, bodies over COMPRESS_MIN_BYTES are brotli- or
+gzip-compressed and returned base64-encoded. Encoders and compressors are imported
+on first use to keep them out of the cold start.
+'''
+import json
+from typing import Any, Dict, Optional
+
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+_orjson = None
+_brotli = None
+
+def load_orjson():
+    '''orjson module, or False when it is not installed'''
+    global _orjson
+    if _orjson is None:
+        try:
+            import orjson
+            _orjson = orjson
+        except ImportError:
+            _orjson = False
+    return _orjson
+
+def load_brotli():
+    '''brotli module, or False when it is not installed'''
+    global _brotli
+    if _brotli is None:
+        try:
+            import brotli
+            _brotli = brotli
+        except ImportError:
+            _brotli = False
+    return _brotli
+
+def encode_value(value: Any) -> Any:
+    from decimal import Decimal
+
+    if isinstance(value, Decimal):
+        return float(value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def dumps(payload: Any) -> bytes:
+    orjson = load_orjson()
+    if orjson:
+        return orjson.dumps(payload, default=encode_value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, default=encode_value).encode()
+
+def accepted_encoding(event: Dict[str, Any]) -> Optional[str]:
+    headers = event.get('headers') or {}
+    header = headers.get('accept-encoding') or headers.get('Accept-Encoding') or ''
+    accepted = set()
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        if params.replace(' ', '') not in ('q=0', 'q=0.0'):
+            accepted.add(name.strip().lower())
+    if 'br' in accepted and load_brotli():
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return load_brotli().compress(body, quality=BROTLI_QUALITY)
+    import gzip
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+def encoded_response(status_code: int, body: bytes, headers: Dict[str, str],
+                     event: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    '''Response for an already serialized body, compressed when the event allows it'''
+    encoding = accepted_encoding(event) if event is not None and len(body) >= COMPRESS_MIN_BYTES else None
+    if encoding:
+        import base64
+        return {
+            'statusCode': status_code,
+            'headers': {**headers, 'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'},
+            'body': base64.b64encode(compress(body, encoding)).decode(),
+            'isBase64Encoded': True
+        }
+
+    return {
+        'statusCode': status_code,
+        'headers': {**headers, 'Vary': 'Accept-Encoding'} if event is not None else headers,
+        'body': body.decode(),
+        'isBase64Encoded': False
+    }
+
+def json_response(status_code: int, payload: Any, event: Optional[Dict[str, Any]] = None,
+                  headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    '''
+    JSON response; pass the event to allow compression of large bodies and
+    headers to add to (or override) the JSON/CORS template
+    '''
+    return encoded_response(status_code, dumps(payload), {**JSON_HEADERS, **headers} if headers else dict(JSON_HEADERS), event)
+
+def error_response(status_code: int, message: str) -> Dict[str, Any]:
+    return json_response(status_code, {'error': message})
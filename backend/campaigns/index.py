@@ -1,30 +1,153 @@
 import json
-import os
-from typing import Dict, Any
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from typing import Dict, Any, List, Optional
 from decimal import Decimal
 
+import daily_views
+import metrics
+from replica import get_db_connection, get_read_connection
+from responses import json_response, error_response
+
+TRANSACTION_KIND_CAMPAIGN_CREATE = 4
+TRANSACTION_KIND_CAMPAIGN_IMPORT = 6
+CAMPAIGN_COST_PER_1000 = Decimal('0.15')
+metrics.register_cache('daily_views', daily_views.stats)
+BULK_IMPORT_MAX_ROWS = 1000
+CAMPAIGNS_LIST_SQL = """
+    SELECT id, title, url, reward, duration, total_views, required_views,
+           moderation_status AS status
+    FROM campaigns
+    WHERE moderation_status = 'approved' AND is_active = true
+    ORDER BY created_at DESC
+    LIMIT 20
+    """
+
 def escape_sql_string(value: str) -> str:
     """Escape single quotes in SQL strings by doubling them"""
     return value.replace("'", "''")
 
-def get_db_connection():
-    database_url = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(database_url, cursor_factory=RealDictCursor)
+def build_stats_series_query(granularity: str, days: int, filters: str) -> str:
+    if granularity == 'hour':
+        return f"""
+            SELECT hour AS bucket, SUM(views)::bigint AS views, SUM(spend) AS spend,
+                   SUM(payouts) AS payouts, SUM(referral_payouts) AS referral_payouts
+            FROM campaign_stats_hourly
+            WHERE hour >= DATE_TRUNC('hour', NOW()) - INTERVAL '{days} days' {filters}
+            GROUP BY hour
+            ORDER BY hour
+            """
+    return f"""
+        SELECT day AS bucket, SUM(views)::bigint AS views, SUM(spend) AS spend,
+               SUM(payouts) AS payouts, SUM(referral_payouts) AS referral_payouts
+        FROM campaign_stats_daily
+        WHERE day > CURRENT_DATE - {days} {filters}
+        GROUP BY day
+        ORDER BY day
+        """
+
+def fetch_stats_series(cur, granularity: str, days: int, filters: str) -> list:
+    '''Time-series of views, spend and payouts from campaign_stats_hourly/daily rollups'''
+    cur.execute(build_stats_series_query(granularity, days, filters))
+    return cur.fetchall()
 
-def get_user_from_session(session_token: str, cur):
-    escaped_token = escape_sql_string(session_token)
-    cur.execute(
-        f"""
+def parse_bulk_campaigns(event: Dict[str, Any]) -> Optional[List[Any]]:
+    '''Rows of a bulk import: CSV body (title,url,required_views) or JSON array / {"campaigns": [...]}'''
+    body = event.get('body') or ''
+    headers = event.get('headers') or {}
+    content_type = (headers.get('content-type') or headers.get('Content-Type') or '').lower()
+    if 'csv' in content_type:
+        import csv
+        import io
+        return list(csv.DictReader(io.StringIO(body)))
+    
+    try:
+        data = json.loads(body or '[]')
+    except ValueError:
+        return None
+    if isinstance(data, dict):
+        data = data.get('campaigns')
+    return data if isinstance(data, list) else None
+
+def validate_campaign_row(row: Any) -> Dict[str, Any]:
+    if not isinstance(row, dict):
+        return {'error': 'Row must be an object'}
+    title = str(row.get('title') or '').strip()
+    url = str(row.get('url') or '').strip()
+    try:
+        required_views = int(row.get('required_views') or 0)
+    except (TypeError, ValueError):
+        required_views = 0
+    
+    if not title or len(title) > 255 or not url or required_views <= 0:
+        return {'error': 'Invalid campaign data'}
+    return {
+        'title': title,
+        'url': url,
+        'required_views': required_views,
+        'total_cost': (Decimal(required_views) / 1000) * CAMPAIGN_COST_PER_1000
+    }
+
+def build_session_user_query(session_token: str) -> str:
+    return f"""
         SELECT u.id FROM sessions s
         JOIN users u ON s.user_id = u.id
-        WHERE s.session_token = '{escaped_token}' AND s.expires_at > NOW()
+        WHERE s.session_token = '{escape_sql_string(session_token)}' AND s.expires_at > NOW()
         """
+
+def build_available_query(viewed: List[int]) -> str:
+    not_viewed = f"AND c.id NOT IN ({', '.join(str(int(campaign_id)) for campaign_id in viewed)})" if viewed else ''
+    return f"""
+        SELECT c.id, c.title, c.url, c.reward, c.duration
+        FROM campaigns c
+        WHERE c.is_active = true 
+        AND c.moderation_status = 'approved'
+        AND c.total_views < c.required_views
+        {not_viewed}
+        ORDER BY c.created_at DESC
+        LIMIT 50
+        """
+
+def build_bulk_create_query(user_id: int, campaigns: List[Dict[str, Any]], total_cost: Decimal) -> str:
+    '''
+    One statement for a whole import: debit the advertiser, insert the campaigns and the ledger row.
+    Returns (row_number, id) per created campaign; no rows when the balance is insufficient.
+    '''
+    reward_per_view = float(CAMPAIGN_COST_PER_1000 / 1000)
+    values_sql = ',\n'.join(
+        f"({c['row']}, '{escape_sql_string(c['title'])}', '{escape_sql_string(c['url'])}', "
+        f"{float(c['total_cost'])}, {c['required_views']})"
+        for c in campaigns
     )
+    return f"""
+        WITH debit AS (
+            UPDATE users SET ad_balance = ad_balance - {float(total_cost)}
+            WHERE id = {user_id} AND ad_balance >= {float(total_cost)}
+            RETURNING id
+        ), numbered AS (
+            -- Ids are taken from the sequence per import row, so each row keeps its own id
+            SELECT nextval(pg_get_serial_sequence('campaigns', 'id')) AS id, v.*
+            FROM (VALUES {values_sql}) AS v(row_number, title, url, budget, required_views)
+            WHERE EXISTS (SELECT 1 FROM debit)
+        ), created AS (
+            INSERT INTO campaigns
+            (id, advertiser_id, title, url, reward, duration, budget, required_views, moderation_status, is_active)
+            SELECT n.id, {user_id}, n.title, n.url, {reward_per_view}, 5, n.budget, n.required_views, 'pending', false
+            FROM numbered n
+            ORDER BY n.row_number
+            RETURNING id
+        ), ledger AS (
+            INSERT INTO transactions (user_id, kind, amount, ref_id)
+            SELECT {user_id}, {TRANSACTION_KIND_CAMPAIGN_IMPORT}, {float(total_cost)}, (SELECT MIN(id) FROM created)
+            FROM debit
+        )
+        SELECT n.row_number, n.id FROM numbered n JOIN created c ON c.id = n.id
+        """
+
+def get_user_from_session(session_token: str, cur):
+    cur.execute(build_session_user_query(session_token))
     user = cur.fetchone()
     return user['id'] if user else None
 
+@metrics.instrument('campaigns')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Manage PTC campaigns (create, list, view)
@@ -47,7 +170,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    conn = get_db_connection()
+    params = event.get('queryStringParameters') or {}
+    if method == 'GET' and params.get('action', 'list') not in ('available', 'analytics'):
+        conn = get_read_connection()
+    else:
+        conn = get_db_connection()
     cur = conn.cursor()
     
     try:
@@ -56,21 +183,51 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             session_token = headers.get('x-session-token') or headers.get('X-Session-Token')
             
             if not session_token:
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Unauthorized'}),
-                    'isBase64Encoded': False
-                }
+                return error_response(401, 'Unauthorized')
             
             user_id = get_user_from_session(session_token, cur)
             if not user_id:
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Invalid session'}),
-                    'isBase64Encoded': False
-                }
+                return error_response(401, 'Invalid session')
+            
+            if params.get('action') == 'bulk_create':
+                rows = parse_bulk_campaigns(event)
+                if not rows or len(rows) > BULK_IMPORT_MAX_ROWS:
+                    return error_response(400, f'Provide 1-{BULK_IMPORT_MAX_ROWS} campaigns as JSON array or CSV (title,url,required_views)')
+                
+                results = []
+                valid = []
+                for row_number, row in enumerate(rows):
+                    checked = validate_campaign_row(row)
+                    if 'error' in checked:
+                        results.append({'row': row_number, 'success': False, 'error': checked['error']})
+                    else:
+                        checked['row'] = row_number
+                        valid.append(checked)
+                        results.append({'row': row_number, 'success': True, 'total_cost': float(checked['total_cost'])})
+                
+                total_cost = sum((c['total_cost'] for c in valid), Decimal(0))
+                if not valid:
+                    return json_response(400, {'error': 'No valid campaigns', 'results': results})
+                
+                cur.execute(build_bulk_create_query(user_id, valid, total_cost))
+                created = {row['row_number']: row['id'] for row in cur.fetchall()}
+                
+                if not created:
+                    conn.rollback()
+                    return json_response(400, {'error': 'Insufficient balance', 'total_cost': total_cost, 'results': results})
+                
+                conn.commit()
+                
+                for row_number, campaign_id in created.items():
+                    results[row_number]['campaign_id'] = campaign_id
+                
+                return json_response(201, {
+                    'success': True,
+                    'created': len(created),
+                    'total_cost': total_cost,
+                    'results': results,
+                    'message': 'Кампании отправлены на модерацию.'
+                })
             
             body_data = json.loads(event.get('body', '{}'))
             title = body_data.get('title', '').strip()
@@ -78,14 +235,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             required_views = body_data.get('required_views', 0)
             
             if not title or not url or required_views <= 0:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Invalid campaign data'}),
-                    'isBase64Encoded': False
-                }
-            
-            cost_per_1000 = Decimal('0.15')
+                return error_response(400, 'Invalid campaign data')
+            
+            cost_per_1000 = CAMPAIGN_COST_PER_1000
             total_cost = (Decimal(required_views) / 1000) * cost_per_1000
             reward_per_view = cost_per_1000 / 1000
             
@@ -93,12 +245,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             user = cur.fetchone()
             
             if Decimal(user['ad_balance']) < total_cost:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Insufficient balance'}),
-                    'isBase64Encoded': False
-                }
+                return error_response(400, 'Insufficient balance')
             
             escaped_title = escape_sql_string(title)
             escaped_url = escape_sql_string(url)
@@ -116,27 +263,20 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 f"UPDATE users SET ad_balance = ad_balance - {float(total_cost)} WHERE id = {user_id}"
             )
             
-            escaped_description = escape_sql_string(f'Created campaign: {title}')
             cur.execute(
-                f"INSERT INTO transactions (user_id, type, amount, description) VALUES ({user_id}, 'campaign_create', {float(total_cost)}, '{escaped_description}')"
+                f"INSERT INTO transactions (user_id, kind, amount, ref_id) VALUES ({user_id}, {TRANSACTION_KIND_CAMPAIGN_CREATE}, {float(total_cost)}, {campaign_id})"
             )
             
             conn.commit()
             
-            return {
-                'statusCode': 201,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'campaign_id': campaign_id,
-                    'total_cost': float(total_cost),
-                    'message': 'Кампания отправлена на модерацию. Таймер: 5 секунд.'
-                }),
-                'isBase64Encoded': False
-            }
+            return json_response(201, {
+                'success': True,
+                'campaign_id': campaign_id,
+                'total_cost': total_cost,
+                'message': 'Кампания отправлена на модерацию. Таймер: 5 секунд.'
+            })
         
         elif method == 'GET':
-            params = event.get('queryStringParameters') or {}
             action = params.get('action', 'list')
             
             if action == 'available':
@@ -144,98 +284,58 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 session_token = headers.get('x-session-token') or headers.get('X-Session-Token')
                 
                 if not session_token:
-                    return {
-                        'statusCode': 401,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Unauthorized'}),
-                        'isBase64Encoded': False
-                    }
+                    return error_response(401, 'Unauthorized')
                 
                 user_id = get_user_from_session(session_token, cur)
                 if not user_id:
-                    return {
-                        'statusCode': 401,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Invalid session'}),
-                        'isBase64Encoded': False
-                    }
-                
-                cur.execute(
-                    f"""
-                    SELECT c.id, c.title, c.url, c.reward, c.duration
-                    FROM campaigns c
-                    WHERE c.is_active = true 
-                    AND c.moderation_status = 'approved'
-                    AND c.total_views < c.required_views
-                    AND c.id NOT IN (
-                        SELECT campaign_id FROM ad_views 
-                        WHERE user_id = {user_id} AND DATE(created_at) = CURRENT_DATE
-                    )
-                    ORDER BY c.created_at DESC
-                    LIMIT 50
-                    """
-                )
-                campaigns = cur.fetchall()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'campaigns': [
-                            {
-                                'id': c['id'],
-                                'title': c['title'],
-                                'url': c['url'],
-                                'reward': float(c['reward']),
-                                'duration': c['duration']
-                            }
-                            for c in campaigns
-                        ]
-                    }),
-                    'isBase64Encoded': False
-                }
+                    return error_response(401, 'Invalid session')
+                
+                # Views completed in ptc-view since the index was loaded only reach it on the next
+                # rebuild, so the user's own recent rows are read back from idx_ad_views_created
+                views = daily_views.get_daily_views(cur)
+                cur.execute(daily_views.build_recent_views_query(user_id, views.loaded_at))
+                viewed = set(views.viewed_campaigns(user_id))
+                viewed.update(row['campaign_id'] for row in cur.fetchall())
+                cur.execute(build_available_query(sorted(viewed)))
+                return json_response(200, {'campaigns': cur.fetchall()}, event)
+            
+            elif action == 'analytics':
+                headers = event.get('headers', {})
+                session_token = headers.get('x-session-token') or headers.get('X-Session-Token')
+                
+                if not session_token:
+                    return error_response(401, 'Unauthorized')
+                
+                user_id = get_user_from_session(session_token, cur)
+                if not user_id:
+                    return error_response(401, 'Invalid session')
+                
+                granularity = params.get('granularity', 'day')
+                try:
+                    days = int(params.get('days', 7 if granularity == 'hour' else 30))
+                    campaign_id = int(params['campaign_id']) if params.get('campaign_id') else None
+                except ValueError:
+                    days = 0
+                    campaign_id = None
+                
+                if granularity not in ('hour', 'day') or days <= 0 or days > (7 if granularity == 'hour' else 365):
+                    return error_response(400, 'Invalid params (granularity hour: 1-7 days, day: 1-365 days)')
+                
+                filters = f"AND advertiser_id = {user_id}"
+                if campaign_id:
+                    filters += f" AND campaign_id = {campaign_id}"
+                
+                return json_response(200, {
+                    'granularity': granularity,
+                    'series': fetch_stats_series(cur, granularity, days, filters)
+                }, event)
             
             else:
-                cur.execute(
-                    """
-                    SELECT id, title, url, reward, duration, total_views, required_views, 
-                           moderation_status, is_active, created_at
-                    FROM campaigns
-                    WHERE moderation_status = 'approved' AND is_active = true
-                    ORDER BY created_at DESC
-                    LIMIT 20
-                    """
-                )
-                campaigns = cur.fetchall()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'campaigns': [
-                            {
-                                'id': c['id'],
-                                'title': c['title'],
-                                'url': c['url'],
-                                'reward': float(c['reward']),
-                                'duration': c['duration'],
-                                'total_views': c['total_views'],
-                                'required_views': c['required_views'],
-                                'status': c['moderation_status']
-                            }
-                            for c in campaigns
-                        ]
-                    }),
-                    'isBase64Encoded': False
-                }
+                cur.execute(CAMPAIGNS_LIST_SQL)
+                return json_response(200, {'campaigns': cur.fetchall()}, event)
         
         else:
-            return {
-                'statusCode': 405,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
+            return error_response(405, 'Method not allowed')
     
     finally:
         cur.close()
@@ -0,0 +1,82 @@
+'''
+Primary and read-replica connections for one backend function.
+
+Every function that reads from the replica (admin, campaigns, stats) ships an
+identical copy of this module, like metrics.py and responses.py. A write answers
+with its primary WAL position in X-Last-Write-LSN (last_write_headers); the client
+echoes it on later reads, and get_read_connection only picks the replica once it
+has replayed that position.
+'''
+import os
+from typing import Any, Dict, Optional
+
+import metrics
+
+def get_db_connection():
+    database_url = os.environ.get('DATABASE_URL')
+    return metrics.connect(database_url)
+
+def get_read_connection(last_write_lsn: Optional[str] = None):
+    '''
+    Connection for read-only actions: replica from DATABASE_REPLICA_URL when its lag
+    is under REPLICA_MAX_LAG_SECONDS and it has replayed the caller's last write (the
+    primary WAL position returned by that write), otherwise the primary
+    '''
+    replica_url = os.environ.get('DATABASE_REPLICA_URL')
+    if not replica_url:
+        return get_db_connection()
+    
+    import psycopg2
+    
+    max_lag = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+    try:
+        conn = metrics.connect(replica_url, target='replica', connect_timeout=2)
+    except psycopg2.Error:
+        return get_db_connection()
+    
+    try:
+        cur = conn.cursor()
+        # The lag alone reads 0 whenever receive and replay positions match, even if the
+        # replica has not received the caller's write yet, so compare against its LSN too
+        caught_up = 'TRUE'
+        if last_write_lsn:
+            caught_up = f"NOT pg_is_in_recovery() OR COALESCE(pg_last_wal_replay_lsn() >= '{last_write_lsn}'::pg_lsn, FALSE)"
+        cur.execute(
+            f"""
+            SELECT CASE
+                       WHEN NOT pg_is_in_recovery() THEN 0
+                       WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                       ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                   END AS lag,
+                   {caught_up} AS caught_up
+            """
+        )
+        replica = cur.fetchone()
+        cur.close()
+    except psycopg2.Error:
+        conn.close()
+        return get_db_connection()
+    
+    if float(replica['lag']) > max_lag or not replica['caught_up']:
+        conn.close()
+        return get_db_connection()
+    
+    conn.rollback()
+    return conn
+
+def get_last_write_lsn(headers: Dict[str, Any]) -> Optional[str]:
+    '''X-Last-Write-LSN echoed by the client; anything that is not a pg_lsn is ignored'''
+    value = str(headers.get('x-last-write-lsn') or headers.get('X-Last-Write-LSN') or '').strip().upper()
+    high, _, low = value.partition('/')
+    if 0 < len(high) <= 8 and 0 < len(low) <= 8 and all(c in '0123456789ABCDEF' for c in high + low):
+        return value
+    return None
+
+def current_wal_lsn(cur) -> str:
+    '''Primary WAL position now; at or after every write committed before the call'''
+    cur.execute("SELECT pg_current_wal_lsn()::text AS lsn")
+    return cur.fetchone()['lsn']
+
+def last_write_headers(cur) -> Dict[str, str]:
+    '''Primary WAL position after the caller's commit, for get_read_connection of later reads'''
+    return {'Access-Control-Expose-Headers': 'X-Last-Write-LSN', 'X-Last-Write-LSN': current_wal_lsn(cur)}
@@ -0,0 +1,105 @@
+'''
+Pre-generated captcha image pool for ptc-view.
+
+Renders every shape of ptc-view's CAPTCHA_SHAPES several times, randomly rotated,
+scaled and shifted over pixel noise, into backend/ptc-view/captcha_pool.json. The
+handler only picks a pooled image for the challenge target, so no rendering happens
+in the request path. Regenerate the pool before a deploy so the images differ from
+the ones clients have already seen:
+
+    python backend/captcha_pool.py                  # 16 images per shape
+    python backend/captcha_pool.py --variants 32
+'''
+import argparse
+import base64
+import json
+import math
+import os
+import struct
+import sys
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTION_DIR = os.path.join(BACKEND_DIR, 'ptc-view')
+IMAGE_SIZE = 64
+
+sys.path.insert(0, FUNCTION_DIR)
+from index import CAPTCHA_POOL_PATH, CAPTCHA_SHAPES
+
+def polygon(points: int, inner: Optional[float] = None) -> List[Tuple[float, float]]:
+    '''Regular polygon with radius 1 and a vertex on top; a star when inner radius is given'''
+    radii = [1.0, inner] if inner else [1.0]
+    count = points * len(radii)
+    return [
+        (radii[i % len(radii)] * math.cos(2 * math.pi * i / count - math.pi / 2),
+         radii[i % len(radii)] * math.sin(2 * math.pi * i / count - math.pi / 2))
+        for i in range(count)
+    ]
+
+GEOMETRY = {
+    'Triangle': polygon(3),
+    'Square': polygon(4),
+    'Pentagon': polygon(5),
+    'Hexagon': polygon(6),
+    'Circle': polygon(24),
+    'Star': polygon(5, 0.45),
+    'Plus': [(-0.3, -1), (0.3, -1), (0.3, -0.3), (1, -0.3), (1, 0.3), (0.3, 0.3),
+             (0.3, 1), (-0.3, 1), (-0.3, 0.3), (-1, 0.3), (-1, -0.3), (-0.3, -0.3)],
+    'ArrowUp': [(0, -1), (0.8, -0.1), (0.3, -0.1), (0.3, 1), (-0.3, 1), (-0.3, -0.1), (-0.8, -0.1)]
+}
+
+def render(shape: str, size: int = IMAGE_SIZE) -> str:
+    '''PNG data URI of the shape: scanline fill of the transformed polygon over noise'''
+    noise = os.urandom(size * size + 4)
+    angle = noise[-1] / 256 * 2 * math.pi
+    scale = size * (0.3 + noise[-2] / 256 * 0.1)
+    center_x = size / 2 + (noise[-3] % 9) - 4
+    center_y = size / 2 + (noise[-4] % 9) - 4
+    cos_a, sin_a = math.cos(angle), math.sin(angle)
+    points = [(center_x + scale * (x * cos_a - y * sin_a), center_y + scale * (x * sin_a + y * cos_a))
+              for x, y in GEOMETRY[shape]]
+    edges = list(zip(points, points[1:] + points[:1]))
+
+    raw = bytearray()
+    for row in range(size):
+        y = row + 0.5
+        crossings = sorted(
+            x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+            for (x1, y1), (x2, y2) in edges if (y1 <= y) != (y2 <= y)
+        )
+        # Four noise levels per region keep the pool small after zlib
+        line = bytearray(200 + (noise[row * size + col] & 3) * 18 for col in range(size))
+        for start, end in zip(crossings[::2], crossings[1::2]):
+            for col in range(max(0, math.ceil(start - 0.5)), min(size, math.floor(end - 0.5) + 1)):
+                line[col] = (noise[row * size + col] & 3) * 30
+        raw += b'\x00' + line
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    png = (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 0, 0, 0, 0))
+           + chunk(b'IDAT', zlib.compress(bytes(raw), 9)) + chunk(b'IEND', b''))
+    return 'data:image/png;base64,' + base64.b64encode(png).decode()
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Render the ptc-view captcha image pool')
+    parser.add_argument('--variants', type=int, default=16, help='images per shape')
+    parser.add_argument('--output', default=CAPTCHA_POOL_PATH)
+    args = parser.parse_args(argv)
+
+    missing = set(CAPTCHA_SHAPES) - set(GEOMETRY)
+    if missing:
+        parser.error(f'no geometry for shapes: {", ".join(sorted(missing))}')
+
+    images: Dict[str, List[str]] = {
+        shape: [render(shape) for _ in range(max(1, args.variants))] for shape in CAPTCHA_SHAPES
+    }
+    with open(args.output, 'w') as f:
+        json.dump({'size': IMAGE_SIZE, 'images': images}, f, separators=(',', ':'))
+        f.write('\n')
+    print(f'{sum(len(v) for v in images.values())} images, {os.path.getsize(args.output) // 1024} KiB -> {args.output}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
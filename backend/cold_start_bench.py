@@ -0,0 +1,121 @@
+'''
+Cold-start benchmark for backend functions.
+
+Every function runs in a fresh interpreter, the way a new serverless container does:
+load backend/<name>/index.py, call handler() once, and record import time,
+time-to-first-response and peak RSS at first response. Results are checked against
+backend/cold_start_budget.json and the exit code is 1 when any budget is exceeded.
+
+    python backend/cold_start_bench.py                      # OPTIONS preflight, no database
+    DATABASE_URL=... python backend/cold_start_bench.py --mode tests   # first case of each tests.json
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List
+from urllib.parse import parse_qsl, urlsplit
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+BUDGET_PATH = os.path.join(BACKEND_DIR, 'cold_start_budget.json')
+METRICS = ('import_ms', 'first_response_ms', 'max_rss_mb')
+
+PROBE = r'''
+import importlib.util, json, os, resource, sys, time
+
+class Context:
+    request_id = 'cold-start-bench'
+    function_name = os.path.basename(os.path.dirname(sys.argv[1]))
+
+started = time.perf_counter()
+sys.path.insert(0, os.path.dirname(sys.argv[1]))
+spec = importlib.util.spec_from_file_location('index', sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+imported = time.perf_counter()
+response = module.handler(json.loads(sys.argv[2]), Context())
+responded = time.perf_counter()
+
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_response_ms': (responded - started) * 1000,
+    'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'status': response.get('statusCode'),
+    'psycopg2_loaded': 'psycopg2' in sys.modules
+}))
+'''
+
+def discover_functions() -> List[str]:
+    return sorted(
+        name for name in os.listdir(BACKEND_DIR)
+        if os.path.isfile(os.path.join(BACKEND_DIR, name, 'index.py'))
+    )
+
+def build_event(name: str, mode: str) -> Dict[str, Any]:
+    if mode == 'options':
+        return {'httpMethod': 'OPTIONS', 'headers': {}, 'queryStringParameters': {}, 'body': ''}
+
+    with open(os.path.join(BACKEND_DIR, name, 'tests.json')) as f:
+        case = json.load(f)['tests'][0]
+    url = urlsplit(case.get('path', '/'))
+    return {
+        'httpMethod': case.get('method', 'GET'),
+        'headers': case.get('headers', {}),
+        'queryStringParameters': dict(parse_qsl(url.query)),
+        'body': json.dumps(case['body']) if 'body' in case else ''
+    }
+
+def probe(name: str, event: Dict[str, Any]) -> Dict[str, Any]:
+    result = subprocess.run(
+        [sys.executable, '-c', PROBE, os.path.join(BACKEND_DIR, name, 'index.py'), json.dumps(event)],
+        capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def load_budget(mode: str, name: str) -> Dict[str, float]:
+    with open(BUDGET_PATH) as f:
+        budget = json.load(f)
+    limits = dict(budget[mode])
+    limits.update(budget.get('functions', {}).get(name, {}).get(mode, {}))
+    return limits
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Measure cold-start cost of each backend function')
+    parser.add_argument('--mode', choices=('options', 'tests'), default='options')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help='print raw results as JSON')
+    parser.add_argument('functions', nargs='*')
+    args = parser.parse_args(argv)
+
+    failures = []
+    report = {}
+    for name in args.functions or discover_functions():
+        event = build_event(name, args.mode)
+        runs = [probe(name, event) for _ in range(max(1, args.repeat))]
+        result = {metric: round(statistics.median(run[metric] for run in runs), 2) for metric in METRICS}
+        result['status'] = runs[-1]['status']
+        result['psycopg2_loaded'] = runs[-1]['psycopg2_loaded']
+        report[name] = result
+
+        for metric, limit in load_budget(args.mode, name).items():
+            if result[metric] > limit:
+                failures.append(f'{name}: {metric} {result[metric]} > budget {limit}')
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'function':<12} {'import_ms':>10} {'first_ms':>10} {'rss_mb':>8} {'status':>7}  psycopg2")
+        for name, result in report.items():
+            print(
+                f"{name:<12} {result['import_ms']:>10} {result['first_response_ms']:>10} "
+                f"{result['max_rss_mb']:>8} {result['status']:>7}  {'loaded' if result['psycopg2_loaded'] else 'lazy'}"
+            )
+
+    for failure in failures:
+        print(f'BUDGET EXCEEDED {failure}', file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,448 @@
+'''
+Query plan regression check for the SQL issued by the backend handlers.
+
+Every query shape used by auth, campaigns, ptc-view, admin and stats is listed in SHAPES
+with representative parameters. Each one runs under EXPLAIN (ANALYZE, BUFFERS) against a
+large synthetic dataset (inside a rolled-back transaction, so writes leave no trace) and
+the plan is checked for forbidden sequential scans and sorts, required indexes, shared
+buffer counts and row misestimates. Exit code is 1 when any expectation fails.
+
+The SQL comes from the handlers' own query builders and constants (build_*_query, *_SQL),
+loaded from each function directory, so the check always runs what the handlers run.
+
+    createdb plan_check
+    python backend/plan_check.py --dsn postgresql://localhost/plan_check --setup   # migrate + seed, then check
+    python backend/plan_check.py --dsn postgresql://localhost/plan_check           # check only
+
+When a handler adds a query, add its shape here in the same commit.
+'''
+import argparse
+import glob
+import hashlib
+import importlib.util
+import json
+import os
+import sys
+from datetime import date, timedelta
+from types import ModuleType
+from typing import Any, Dict, Iterator, List
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+MIGRATIONS_DIR = os.path.join(os.path.dirname(BACKEND_DIR), 'db_migrations')
+
+def load_function(name: str) -> ModuleType:
+    '''index.py of a function directory under its own module name (every function's is "index")'''
+    function_dir = os.path.join(BACKEND_DIR, name)
+    sys.path.insert(0, function_dir)
+    try:
+        spec = importlib.util.spec_from_file_location(f"{name.replace('-', '_')}_index", os.path.join(function_dir, 'index.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(function_dir)
+    return module
+
+admin = load_function('admin')
+auth = load_function('auth')
+campaigns = load_function('campaigns')
+ptc_view = load_function('ptc-view')
+stats = load_function('stats')
+
+SEED_SIZES = {
+    'users': 100000,
+    'campaigns': 5000,
+    'ad_views': 2000000,
+    'heavy_user_transactions': 100000,
+    'transactions': 2000000,
+    'sessions': 100000,
+    'vouchers': 100000,
+    'withdrawals': 50000,
+    'idempotency_keys': 100000,
+    'stats_days': 90,
+    'stats_hours': 168
+}
+
+SEED_SQL = [
+    """INSERT INTO users (email, password_hash, username, credits, ad_balance, referral_code)
+       SELECT 'user' || g || '@plan.test', md5(g::text), 'user' || g, (g % 500), (g % 50), 'pc' || g
+       FROM generate_series(1, {users}) g""",
+    """UPDATE users SET referred_by = id - 1
+       WHERE email LIKE '%@plan.test' AND id % 3 = 0""",
+    """INSERT INTO campaigns (advertiser_id, title, url, reward, duration, budget, required_views,
+                            moderation_status, is_active, cost_per_view, total_views, created_at)
+       SELECT {min_user} + (g % 1000), 'Campaign ' || g, 'https://example.com/' || g, 0.00015, 5, 15.00,
+              100000, CASE WHEN g % 10 = 0 THEN 'pending' ELSE 'approved' END, g % 10 <> 0, 1.00, g % 1000,
+              NOW() - (g || ' minutes')::interval
+       FROM generate_series(1, {campaigns}) g""",
+    """INSERT INTO ad_views (user_id, campaign_id, reward, completed, completed_at, created_at)
+       SELECT {min_user} + (g % {users}), {min_campaign} + (g % {campaigns}), 0.7, true,
+              NOW() - ((g % 2160) || ' hours')::interval, NOW() - ((g % 2160) || ' hours')::interval
+       FROM generate_series(1, {ad_views}) g
+       ON CONFLICT DO NOTHING""",
+    """INSERT INTO transactions (user_id, kind, amount, ref_id, created_at)
+       SELECT {min_user}, CASE WHEN g % 100 = 0 THEN 2 ELSE 1 END, 0.7, {min_campaign} + (g % {campaigns}),
+              NOW() - (g || ' seconds')::interval
+       FROM generate_series(1, {heavy_user_transactions}) g""",
+    """INSERT INTO transactions (user_id, kind, amount, ref_id, created_at)
+       SELECT {min_user} + 1 + (g % ({users} - 1)), 1 + (g % 4), 0.7, g, NOW() - (g || ' seconds')::interval
+       FROM generate_series(1, {transactions}) g""",
+    """INSERT INTO sessions (user_id, session_token, expires_at)
+       SELECT {min_user} + (g % {users}), md5('session' || g), NOW() + INTERVAL '30 days'
+       FROM generate_series(1, {sessions}) g""",
+    """INSERT INTO vouchers (code, credits, is_used, created_at)
+       SELECT upper(substr(md5('voucher' || g), 1, 20)), 100, g % 2 = 0, NOW() - (g || ' minutes')::interval
+       FROM generate_series(1, {vouchers}) g""",
+    """INSERT INTO withdrawal_requests (user_id, credits, usd_amount, method_id, wallet_address, status, created_at)
+       SELECT {min_user} + (g % {users}), 1000, 10, (SELECT MIN(id) FROM withdrawal_methods), 'wallet' || g,
+              CASE WHEN g % 5 = 0 THEN 'pending' ELSE 'completed' END, NOW() - (g || ' minutes')::interval
+       FROM generate_series(1, {withdrawals}) g""",
+    """INSERT INTO campaign_stats_daily (campaign_id, advertiser_id, day, views, spend, payouts, referral_payouts)
+       SELECT c.id, c.advertiser_id, CURRENT_DATE - d, 100, 100, 70, 5
+       FROM campaigns c CROSS JOIN generate_series(0, {stats_days} - 1) d
+       ON CONFLICT DO NOTHING""",
+    """INSERT INTO campaign_stats_hourly (campaign_id, advertiser_id, hour, views, spend, payouts, referral_payouts)
+       SELECT c.id, c.advertiser_id, DATE_TRUNC('hour', NOW()) - (h || ' hours')::interval, 5, 5, 3.5, 0.25
+       FROM campaigns c CROSS JOIN generate_series(0, {stats_hours} - 1) h
+       ON CONFLICT DO NOTHING""",
+    """INSERT INTO idempotency_keys (scope, idem_key, status_code, response, created_at)
+       SELECT 'ptc-view:' || md5(md5('session' || g)), md5('idem' || g), 200, '{{"success": true}}',
+              NOW() - ((g % 172800) || ' seconds')::interval
+       FROM generate_series(1, {idempotency_keys}) g""",
+    """INSERT INTO referral_earnings (referrer_id, referred_user_id, day, views, credits)
+       SELECT referred_by, id, CURRENT_DATE - (id % {stats_days}), 10, 1.00 FROM users WHERE referred_by IS NOT NULL
+       ON CONFLICT DO NOTHING"""
+]
+
+PARAM_SQL = {
+    'user_id': "SELECT MIN(id) AS value FROM users WHERE email LIKE '%@plan.test'",
+    'advertiser_id': "SELECT advertiser_id AS value FROM campaigns ORDER BY id LIMIT 1",
+    'campaign_id': "SELECT MAX(id) AS value FROM campaigns WHERE moderation_status = 'approved'",
+    'pending_campaign_id': "SELECT MIN(id) AS value FROM campaigns WHERE moderation_status = 'pending'",
+    'referral_code': "SELECT referral_code AS value FROM users ORDER BY id DESC LIMIT 1",
+    'session_token': "SELECT session_token AS value FROM sessions ORDER BY id DESC LIMIT 1",
+    'email': "SELECT email AS value FROM users ORDER BY id DESC LIMIT 1",
+    'voucher_code': "SELECT code AS value FROM vouchers WHERE is_used = FALSE LIMIT 1",
+    'cursor_created_at': "SELECT (NOW() - INTERVAL '10000 seconds')::timestamp AS value",
+    'voucher_watermark': "SELECT (NOW() - INTERVAL '5 minutes')::timestamp AS value",
+    'daily_views_loaded_at': "SELECT (NOW() - INTERVAL '10 seconds')::timestamp AS value",
+    'idem_key': "SELECT md5('idem') AS value"
+}
+
+# sql: the handler's builder applied to the resolved PARAM_SQL values
+# expectations: forbid_seq_scan (relations), require_index (any of), forbid_sort, max_buffers, max_misestimate
+SHAPES: List[Dict[str, Any]] = [
+    {
+        'name': 'session lookup (campaigns)',
+        'sql': lambda p: campaigns.build_session_user_query(p['session_token']),
+        'expect': {'forbid_seq_scan': ['sessions', 'users'], 'max_buffers': 20, 'max_misestimate': 10}
+    },
+    {
+        'name': 'session lookup (ptc-view)',
+        'sql': lambda p: ptc_view.build_session_user_query(p['session_token']),
+        'expect': {'forbid_seq_scan': ['sessions', 'users'], 'max_buffers': 20, 'max_misestimate': 10}
+    },
+    {
+        'name': 'auth verify',
+        'sql': lambda p: auth.build_verify_query(p['session_token']),
+        'expect': {'forbid_seq_scan': ['sessions', 'users'], 'max_buffers': 20, 'max_misestimate': 10}
+    },
+    {
+        'name': 'auth login',
+        'sql': lambda p: auth.build_login_query(p['email'], auth.hash_password(p['email']), 'plan-check-login'),
+        'expect': {'forbid_seq_scan': ['users'], 'require_index': ['idx_users_email_lower'], 'max_buffers': 30,
+                   'max_misestimate': 10}
+    },
+    {
+        'name': 'auth register',
+        'sql': lambda p: auth.build_register_query('plan-check-new@plan.test', auth.hash_password('new'), 'plan-check-new',
+                                                   'pcnew', p['referral_code'], 'plan-check-register'),
+        'expect': {'forbid_seq_scan': ['users'], 'max_buffers': 100}
+    },
+    {
+        'name': 'campaigns available feed',
+        'sql': lambda p: campaigns.build_available_query([p['campaign_id']]),
+        'expect': {'require_index': ['idx_campaigns_live'], 'forbid_sort': True, 'max_buffers': 1000}
+    },
+    {
+        'name': 'campaigns list',
+        'sql': lambda p: campaigns.CAMPAIGNS_LIST_SQL,
+        'expect': {'require_index': ['idx_campaigns_live'], 'forbid_sort': True, 'max_buffers': 50}
+    },
+    {
+        'name': 'campaigns bulk_create',
+        'sql': lambda p: campaigns.build_bulk_create_query(p['advertiser_id'], [
+            {'row': 0, 'title': 'Plan check A', 'url': 'https://example.com/a', 'total_cost': 1.0, 'required_views': 1000},
+            {'row': 1, 'title': 'Plan check B', 'url': 'https://example.com/b', 'total_cost': 2.0, 'required_views': 2000}
+        ], 3.0),
+        'expect': {'forbid_seq_scan': ['users'], 'max_buffers': 200}
+    },
+    {
+        'name': 'campaigns analytics (hourly rollup)',
+        'sql': lambda p: campaigns.build_stats_series_query('hour', 7, f"AND advertiser_id = {p['advertiser_id']}"),
+        'expect': {'forbid_seq_scan': ['campaign_stats_hourly'],
+                   'require_index': ['idx_campaign_stats_hourly_advertiser'], 'max_buffers': 2000}
+    },
+    {
+        'name': 'campaigns analytics (daily rollup)',
+        'sql': lambda p: campaigns.build_stats_series_query('day', 30, f"AND advertiser_id = {p['advertiser_id']}"),
+        'expect': {'forbid_seq_scan': ['campaign_stats_daily'], 'max_buffers': 500}
+    },
+    {
+        'name': 'ptc-view campaign lookup',
+        'sql': lambda p: ptc_view.build_campaign_lookup_query(p['campaign_id']),
+        'expect': {'forbid_seq_scan': ['campaigns'], 'max_buffers': 10}
+    },
+    {
+        'name': 'daily views load (campaigns feed, ptc-view dedupe)',
+        'sql': lambda p: campaigns.daily_views.DAILY_VIEWS_SQL,
+        'expect': {'forbid_seq_scan': ['ad_views'], 'require_index': ['idx_ad_views_created'], 'max_buffers': 1000}
+    },
+    {
+        'name': 'campaigns feed recent views',
+        'sql': lambda p: campaigns.daily_views.build_recent_views_query(p['user_id'], p['daily_views_loaded_at']),
+        'expect': {'forbid_seq_scan': ['ad_views'], 'require_index': ['idx_ad_views_created'], 'max_buffers': 50}
+    },
+    {
+        'name': 'ptc-view idempotency lookup',
+        'sql': lambda p: ptc_view.build_stored_response_query(
+            'ptc-view:' + hashlib.sha256(p['session_token'].encode()).hexdigest()[:32], p['idem_key']
+        ),
+        'expect': {'forbid_seq_scan': ['idempotency_keys'], 'max_buffers': 10}
+    },
+    {
+        'name': 'ptc-view ad view insert',
+        'sql': lambda p: ptc_view.build_ad_view_insert_query(p['user_id'], p['campaign_id'], 0.7),
+        'expect': {'max_buffers': 50}
+    },
+    {
+        'name': 'ptc-view referral upsert',
+        'sql': lambda p: ptc_view.build_referral_upsert_query(p['user_id'], p['user_id'] + 1, 0.1),
+        'expect': {'forbid_seq_scan': ['users', 'referral_earnings'], 'max_buffers': 50}
+    },
+    {
+        'name': 'ptc-view rollup upsert',
+        'sql': lambda p: ptc_view.build_rollup_upsert_query(p['campaign_id'], p['advertiser_id'], 1.0, 0.7, 0.1),
+        'expect': {'max_buffers': 50}
+    },
+    {
+        'name': 'idempotency purge (ptc-view)',
+        'sql': lambda p: ptc_view.PURGE_EXPIRED_RESPONSES_SQL,
+        'expect': {'forbid_seq_scan': ['idempotency_keys'], 'require_index': ['idx_idempotency_keys_created'],
+                   'forbid_sort': True, 'max_buffers': 5000}
+    },
+    {
+        'name': 'idempotency purge (admin)',
+        'sql': lambda p: admin.PURGE_EXPIRED_RESPONSES_SQL,
+        'expect': {'forbid_seq_scan': ['idempotency_keys'], 'require_index': ['idx_idempotency_keys_created'],
+                   'forbid_sort': True, 'max_buffers': 5000}
+    },
+    {
+        'name': 'admin transaction_history first page (heavy user)',
+        'sql': lambda p: admin.build_transaction_history_query(p['user_id'], 50),
+        'expect': {'require_index': ['idx_transactions_user_history'], 'forbid_sort': True, 'max_buffers': 400}
+    },
+    {
+        'name': 'admin transaction_history cursor page filtered by type',
+        'sql': lambda p: admin.build_transaction_history_query(
+            p['user_id'], 50, admin.TRANSACTION_KINDS['credit'], (p['cursor_created_at'], 2147483647)
+        ),
+        'expect': {'require_index': ['idx_transactions_user_kind_history'], 'forbid_sort': True, 'max_buffers': 400}
+    },
+    {
+        'name': 'admin withdrawal_history',
+        'sql': lambda p: admin.build_withdrawal_history_query(p['user_id']),
+        'expect': {'forbid_seq_scan': ['withdrawal_requests'], 'max_buffers': 100}
+    },
+    {
+        'name': 'admin withdrawals',
+        'sql': lambda p: admin.WITHDRAWALS_LIST_SQL,
+        'expect': {'forbid_seq_scan': ['withdrawal_requests', 'users'], 'require_index': ['idx_withdrawal_created'],
+                   'max_buffers': 1000}
+    },
+    {
+        'name': 'admin vouchers',
+        'sql': lambda p: admin.VOUCHERS_LIST_SQL,
+        'expect': {'require_index': ['idx_vouchers_created'], 'forbid_sort': True, 'max_buffers': 200}
+    },
+    {
+        'name': 'admin voucher filter refresh',
+        'sql': lambda p: admin.build_voucher_refresh_query(p['voucher_watermark']),
+        'expect': {'forbid_seq_scan': ['vouchers'], 'require_index': ['idx_vouchers_created'], 'max_buffers': 100}
+    },
+    {
+        'name': 'admin activate_voucher redemption',
+        'sql': lambda p: admin.build_voucher_redemption_query(p['voucher_code'], p['user_id']),
+        'expect': {'forbid_seq_scan': ['vouchers', 'users'], 'max_buffers': 100}
+    },
+    {
+        'name': 'admin moderation_lease',
+        'sql': lambda p: admin.build_moderation_lease_query('plan-check', 50),
+        'expect': {'require_index': ['idx_campaigns_pending_queue'], 'max_buffers': 2000}
+    },
+    {
+        'name': 'admin moderate_campaigns approve',
+        'sql': lambda p: admin.build_moderation_query(
+            'plan-check', 'approve', [p['pending_campaign_id'], p['pending_campaign_id'] + 10]
+        ),
+        'expect': {'forbid_seq_scan': ['campaigns'], 'max_buffers': 50}
+    },
+    {
+        'name': 'admin moderate_campaigns reject with refunds',
+        'sql': lambda p: admin.build_moderation_query(
+            'plan-check', 'reject', [p['pending_campaign_id'], p['pending_campaign_id'] + 10]
+        ),
+        'expect': {'forbid_seq_scan': ['campaigns', 'users'], 'max_buffers': 100}
+    },
+    {
+        'name': 'stats total users',
+        'sql': lambda p: stats.TOTAL_USERS_SQL,
+        'expect': {'max_buffers': 1000}
+    },
+    {
+        'name': 'stats active campaigns',
+        'sql': lambda p: stats.ACTIVE_CAMPAIGNS_SQL,
+        'expect': {'max_buffers': 50}
+    },
+    {
+        'name': 'stats total payouts (daily rollup)',
+        'sql': lambda p: stats.TOTAL_PAYOUTS_SQL,
+        'expect': {'max_buffers': 5000}
+    },
+    {
+        'name': 'stats average earnings',
+        'sql': lambda p: stats.AVG_EARNINGS_SQL,
+        'expect': {'max_buffers': 4000}
+    }
+]
+
+# The HTTP export action and export.py share build_export_query as well
+SHAPES += [
+    {
+        'name': f'admin export {table} ({admin.EXPORT_MAX_DAYS} days)',
+        'sql': lambda p, table=table: admin.build_export_query(
+            table, date.today() - timedelta(days=admin.EXPORT_MAX_DAYS), date.today()
+        ),
+        'expect': {'forbid_seq_scan': [table]}
+    }
+    for table in admin.EXPORT_TABLES
+]
+
+def walk(plan: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from walk(child)
+
+def check_plan(plan: Dict[str, Any], expect: Dict[str, Any]) -> List[str]:
+    nodes = list(walk(plan))
+    problems = []
+
+    for relation in expect.get('forbid_seq_scan', []):
+        if any(n['Node Type'] == 'Seq Scan' and n.get('Relation Name') == relation for n in nodes):
+            problems.append(f'Seq Scan on {relation}')
+
+    required = expect.get('require_index')
+    if required and not any(n.get('Index Name') in required for n in nodes):
+        used = sorted({n['Index Name'] for n in nodes if n.get('Index Name')})
+        problems.append(f'expected index {" or ".join(required)}, plan uses {used or "none"}')
+
+    if expect.get('forbid_sort') and any(n['Node Type'] in ('Sort', 'Incremental Sort') for n in nodes):
+        problems.append('plan contains a Sort node')
+
+    buffers = plan.get('Shared Hit Blocks', 0) + plan.get('Shared Read Blocks', 0)
+    if 'max_buffers' in expect and buffers > expect['max_buffers']:
+        problems.append(f'{buffers} shared buffers > {expect["max_buffers"]}')
+
+    if 'max_misestimate' in expect:
+        for n in nodes:
+            if 'Scan' not in n['Node Type'] or not n.get('Actual Loops'):
+                continue
+            planned, actual = max(n['Plan Rows'], 1), max(n['Actual Rows'], 1)
+            if max(planned, actual) / min(planned, actual) > expect['max_misestimate']:
+                problems.append(f'{n["Node Type"]} estimated {planned} rows, got {actual}')
+
+    return problems
+
+def migrate(conn) -> None:
+    cur = conn.cursor()
+    for path in sorted(glob.glob(os.path.join(MIGRATIONS_DIR, 'V*.sql'))):
+        with open(path) as f:
+            cur.execute(f.read())
+    conn.commit()
+    cur.close()
+
+def seed(conn, scale: float) -> None:
+    sizes = {name: max(1, int(size * scale)) for name, size in SEED_SIZES.items()}
+    sizes['stats_days'] = SEED_SIZES['stats_days']
+    sizes['stats_hours'] = SEED_SIZES['stats_hours']
+    cur = conn.cursor()
+    for sql in SEED_SQL:
+        cur.execute("SELECT MIN(id) AS value FROM users WHERE email LIKE '%@plan.test'")
+        sizes['min_user'] = cur.fetchone()['value'] or 0
+        cur.execute("SELECT MIN(id) AS value FROM campaigns WHERE title LIKE 'Campaign %'")
+        sizes['min_campaign'] = cur.fetchone()['value'] or 0
+        cur.execute(sql.format(**sizes))
+    conn.commit()
+    conn.autocommit = True
+    cur.execute('VACUUM ANALYZE')
+    conn.autocommit = False
+    cur.close()
+
+def resolve_params(cur) -> Dict[str, Any]:
+    params = {}
+    for name, sql in PARAM_SQL.items():
+        cur.execute(sql)
+        params[name] = cur.fetchone()['value']
+    return params
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='EXPLAIN-based regression check for handler queries')
+    parser.add_argument('--dsn', default=os.environ.get('PLAN_CHECK_DATABASE_URL'))
+    parser.add_argument('--setup', action='store_true', help='apply db_migrations and seed synthetic data first')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for synthetic table sizes')
+    parser.add_argument('--json', action='store_true', help='print plans and problems as JSON')
+    args = parser.parse_args(argv)
+    if not args.dsn:
+        parser.error('--dsn or PLAN_CHECK_DATABASE_URL is required (use a throwaway database)')
+
+    conn = psycopg2.connect(args.dsn, cursor_factory=RealDictCursor)
+    try:
+        if args.setup:
+            migrate(conn)
+            seed(conn, args.scale)
+
+        cur = conn.cursor()
+        params = resolve_params(cur)
+        conn.rollback()
+
+        report = []
+        for shape in SHAPES:
+            cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {shape['sql'](params)}")
+            explain = cur.fetchone()['QUERY PLAN'][0]
+            conn.rollback()
+            problems = check_plan(explain['Plan'], shape['expect'])
+            report.append({
+                'name': shape['name'],
+                'time_ms': explain.get('Execution Time'),
+                'problems': problems,
+                'plan': explain['Plan']
+            })
+        cur.close()
+    finally:
+        conn.close()
+
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+    else:
+        for entry in report:
+            status = 'FAIL' if entry['problems'] else 'ok'
+            print(f"{status:<5} {entry['time_ms']:>9.2f} ms  {entry['name']}")
+            for problem in entry['problems']:
+                print(f'        - {problem}')
+
+    return 1 if any(entry['problems'] for entry in report) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
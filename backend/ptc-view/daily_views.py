@@ -0,0 +1,134 @@
+'''
+Today's views per campaign, kept in the warm container.
+
+Identical copy in campaigns/ and ptc-view/. For each campaign it keeps a sorted
+array of viewer ids, so "has user X viewed campaign Y today" is a binary search
+and the feed can exclude a user's viewed campaigns without touching ad_views.
+The index is loaded on first use and rebuilt from all of today's rows
+(created_at >= CURRENT_DATE) once it is older than DAILY_VIEWS_REFRESH_SECONDS,
+so a view that commits late is picked up by the next rebuild. Completions served
+by this container are added with record_view() right after their commit; the
+feed adds the user's own views since the rebuild with build_recent_views_query().
+The unique index on ad_views (user_id, campaign_id, created_at::date) stays the
+final authority.
+'''
+import os
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from datetime import date, datetime
+
+DAILY_VIEWS_REFRESH_SECONDS = float(os.environ.get('DAILY_VIEWS_REFRESH_SECONDS', '10'))
+# How long a completion transaction may stay open: its created_at can be this much older than its commit
+DAILY_VIEWS_COMMIT_SLACK_SECONDS = 60
+
+class DailyViews:
+    def __init__(self, day: 'date', loaded_at: 'datetime'):
+        self.day = day
+        self.loaded_at = loaded_at
+        self.size = 0
+        self.viewers: Dict[int, array] = {}
+        self.refreshed_at = 0.0
+
+    def has_viewed(self, user_id: int, campaign_id: int) -> bool:
+        viewers = self.viewers.get(campaign_id)
+        if not viewers:
+            return False
+        i = bisect_left(viewers, user_id)
+        return i < len(viewers) and viewers[i] == user_id
+
+    def viewed_campaigns(self, user_id: int) -> List[int]:
+        return [campaign_id for campaign_id in self.viewers if self.has_viewed(user_id, campaign_id)]
+
+    def add(self, user_id: int, campaign_id: int) -> None:
+        viewers = self.viewers.get(campaign_id)
+        if viewers is None:
+            viewers = self.viewers[campaign_id] = array('i')
+        i = bisect_left(viewers, user_id)
+        if i == len(viewers) or viewers[i] != user_id:
+            viewers.insert(i, user_id)
+            self.size += 1
+
+    def merge(self, campaign_id: int, viewers: array) -> None:
+        '''Add a sorted array of viewer ids; a campaign not seen yet takes it as is'''
+        current = self.viewers.get(campaign_id)
+        if not current:
+            self.viewers[campaign_id] = viewers
+            self.size += len(viewers)
+            return
+        for user_id in viewers:
+            self.add(user_id, campaign_id)
+
+_daily_views: Optional[DailyViews] = None
+
+DAILY_VIEWS_SQL = """
+    SELECT CURRENT_DATE AS today, LOCALTIMESTAMP AS loaded_at, v.campaign_id, v.viewers
+    FROM (SELECT 1) AS one
+    LEFT JOIN (
+        SELECT campaign_id, string_agg(int4send(user_id), ''::bytea ORDER BY user_id) AS viewers
+        FROM ad_views
+        WHERE created_at >= CURRENT_DATE AND created_at < CURRENT_DATE + INTERVAL '1 day'
+        GROUP BY campaign_id
+    ) v ON TRUE
+    """
+
+def build_recent_views_query(user_id: int, since: 'datetime') -> str:
+    '''Campaigns the user viewed today after the index was loaded, less the commit slack'''
+    return f"""
+        SELECT campaign_id FROM ad_views
+        WHERE created_at >= GREATEST(CURRENT_DATE, '{since.isoformat()}'::timestamp - INTERVAL '{DAILY_VIEWS_COMMIT_SLACK_SECONDS} seconds')
+          AND user_id = {int(user_id)}
+        """
+
+def get_daily_views(cur, today: Optional['date'] = None) -> DailyViews:
+    '''
+    Index for the current database day. Callers that already know the database
+    date pass it as today: the index is then only (re)loaded when missing or
+    stale by day, with no query otherwise. Without it, the index is rebuilt
+    from today's rows once DAILY_VIEWS_REFRESH_SECONDS have passed.
+    '''
+    global _daily_views
+    views = _daily_views
+    if views is not None and today is not None:
+        if views.day == today:
+            return views
+        views = None
+    if views is not None and time.time() - views.refreshed_at < DAILY_VIEWS_REFRESH_SECONDS:
+        return views
+
+    # Viewer ids come pre-sorted per campaign as big-endian int4 bytes, so each array
+    # is built with one frombytes() call instead of a Python object per view.
+    cur.execute(DAILY_VIEWS_SQL)
+    rows = cur.fetchall()
+    views = DailyViews(rows[0]['today'], rows[0]['loaded_at'])
+    for row in rows:
+        if row['campaign_id'] is None:
+            continue
+        viewers = array('i')
+        viewers.frombytes(row['viewers'])
+        if sys.byteorder == 'little':
+            viewers.byteswap()
+        views.merge(row['campaign_id'], viewers)
+    views.refreshed_at = time.time()
+    _daily_views = views
+    return views
+
+def record_view(user_id: int, campaign_id: int, day: 'date') -> None:
+    '''Add a committed completion; ignored when no index for that day is loaded'''
+    if _daily_views is not None and _daily_views.day == day:
+        _daily_views.add(user_id, campaign_id)
+
+def stats() -> Dict[str, float]:
+    if _daily_views is None:
+        return {'loaded': 0}
+    return {
+        'loaded': 1,
+        'campaigns': len(_daily_views.viewers),
+        'views': _daily_views.size,
+        'bytes': sum(viewers.buffer_info()[1] * viewers.itemsize for viewers in _daily_views.viewers.values()),
+        'age_seconds': round(time.time() - _daily_views.refreshed_at, 1)
+    }
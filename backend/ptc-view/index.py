@@ -1,27 +1,297 @@
 import json
 import os
-from typing import Dict, Any
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import time
+import hmac
+import hashlib
+from typing import Dict, Any, List, Optional, Tuple
+
+import daily_views
+import metrics
+from responses import JSON_HEADERS, json_response, error_response
+
+TRANSACTION_KIND_AD_VIEW = 1
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400'))
+IDEMPOTENCY_CACHE_SIZE = 1000
+IDEMPOTENCY_PURGE_EVERY = 100
+IDEMPOTENCY_PURGE_BATCH = 1000
+PURGE_EXPIRED_RESPONSES_SQL = f"""DELETE FROM idempotency_keys WHERE ctid = ANY (ARRAY(
+    SELECT ctid FROM idempotency_keys
+    WHERE created_at < NOW() - INTERVAL '{IDEMPOTENCY_TTL_SECONDS} seconds'
+    ORDER BY created_at LIMIT {IDEMPOTENCY_PURGE_BATCH}))"""
+_idempotency_cache: Dict[Tuple[str, str], Tuple[float, int, str]] = {}
+CAPTCHA_OPTION_COUNT = 4
+CAPTCHA_MIN_VIEW_SECONDS = int(os.environ.get('CAPTCHA_MIN_VIEW_SECONDS', '5'))
+CAPTCHA_TTL_SECONDS = int(os.environ.get('CAPTCHA_TTL_SECONDS', '300'))
+CAPTCHA_POOL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'captcha_pool.json')
+CAPTCHA_SPENT_LIMIT = 100000
+# Shape names double as the lucide icons the client draws for the options;
+# backend/captcha_pool.py renders the images of each shape into captcha_pool.json
+CAPTCHA_SHAPES = ('Triangle', 'Square', 'Pentagon', 'Hexagon', 'Circle', 'Star', 'Plus', 'ArrowUp')
+_captcha_pool: Optional[Dict[str, List[str]]] = None
+# nonce -> (expires_at, solved) for challenges already answered in this container
+_captcha_spent: Dict[str, Tuple[float, bool]] = {}
+metrics.register_cache('daily_views', daily_views.stats)
 
 def escape_sql_string(value: str) -> str:
     return value.replace("'", "''")
 
 def get_db_connection():
     database_url = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(database_url, cursor_factory=RealDictCursor)
+    return metrics.connect(database_url)
 
-def get_user_from_session(session_token: str, cur):
-    escaped_token = escape_sql_string(session_token)
+def get_idempotency_key(headers: Dict[str, Any]) -> Optional[str]:
+    key = headers.get('idempotency-key') or headers.get('Idempotency-Key') or ''
+    return str(key).strip()[:100] or None
+
+def replay_response(status_code: int, body: str) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': {**JSON_HEADERS, 'Access-Control-Expose-Headers': 'Idempotent-Replayed', 'Idempotent-Replayed': 'true'},
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+def remember_response(scope: str, key: str, status_code: int, body: str) -> None:
+    if len(_idempotency_cache) >= IDEMPOTENCY_CACHE_SIZE:
+        _idempotency_cache.pop(next(iter(_idempotency_cache)))
+    _idempotency_cache[(scope, key)] = (time.time() + IDEMPOTENCY_TTL_SECONDS, status_code, body)
+
+def find_cached_response(scope: str, key: str) -> Optional[Dict[str, Any]]:
+    entry = _idempotency_cache.get((scope, key))
+    if entry and entry[0] > time.time():
+        metrics.count_cache('idempotency', 'hit')
+        return replay_response(entry[1], entry[2])
+    metrics.count_cache('idempotency', 'miss')
+    return None
+
+metrics.register_cache('idempotency', lambda: {'entries': len(_idempotency_cache), 'capacity': IDEMPOTENCY_CACHE_SIZE})
+
+def find_stored_response(cur, scope: str, key: str) -> Optional[Dict[str, Any]]:
+    '''Replay of a response already stored for this key: in-memory tier first, then idempotency_keys'''
+    return find_cached_response(scope, key) or load_stored_response(cur, scope, key)
+
+def build_stored_response_query(scope: str, key: str) -> str:
+    return f"""SELECT status_code, response FROM idempotency_keys
+        WHERE scope = '{escape_sql_string(scope)}' AND idem_key = '{escape_sql_string(key)}'
+          AND created_at > NOW() - INTERVAL '{IDEMPOTENCY_TTL_SECONDS} seconds'"""
+
+def load_stored_response(cur, scope: str, key: str) -> Optional[Dict[str, Any]]:
+    cur.execute(build_stored_response_query(scope, key))
+    row = cur.fetchone()
+    if not row:
+        return None
+    remember_response(scope, key, row['status_code'], row['response'])
+    return replay_response(row['status_code'], row['response'])
+
+def purge_expired_responses(conn) -> None:
+    '''
+    About once per IDEMPOTENCY_PURGE_EVERY stored responses, delete up to
+    IDEMPOTENCY_PURGE_BATCH rows past the TTL in a short transaction of their own,
+    so idempotency_keys stays bounded without a scheduled job. Runs after the
+    caller's commit; a failure here never affects the response.
+    '''
+    if int.from_bytes(os.urandom(2), 'little') % IDEMPOTENCY_PURGE_EVERY:
+        return
+    
+    import psycopg2
+    
+    cur = conn.cursor()
+    try:
+        cur.execute(PURGE_EXPIRED_RESPONSES_SQL)
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+    finally:
+        cur.close()
+
+def store_response(cur, scope: str, key: str, response: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    '''
+    Record the response inside the caller's transaction (an expired row is overwritten).
+    If a concurrent request with the same key committed first, the caller's transaction is
+    rolled back and that request's response is returned instead.
+    '''
     cur.execute(
-        f"""
+        f"""INSERT INTO idempotency_keys (scope, idem_key, status_code, response)
+            VALUES ('{escape_sql_string(scope)}', '{escape_sql_string(key)}', {response['statusCode']}, '{escape_sql_string(response['body'])}')
+            ON CONFLICT (scope, idem_key) DO UPDATE SET
+                status_code = EXCLUDED.status_code, response = EXCLUDED.response, created_at = NOW()
+            WHERE idempotency_keys.created_at <= NOW() - INTERVAL '{IDEMPOTENCY_TTL_SECONDS} seconds'
+            RETURNING idem_key"""
+    )
+    if cur.fetchone():
+        return None
+    
+    cur.connection.rollback()
+    return find_stored_response(cur, scope, key) or error_response(409, 'Request with this Idempotency-Key is already in progress')
+
+def get_captcha_secret() -> Optional[bytes]:
+    '''CAPTCHA_SECRET shared by all containers; challenges are refused while it is unset'''
+    secret = os.environ.get('CAPTCHA_SECRET')
+    return secret.encode() if secret else None
+
+def captcha_challenge(nonce: str) -> Tuple[str, List[str]]:
+    '''
+    (target shape, option shapes) for a challenge nonce. Derived from the secret, so
+    any container can rebuild it from the token while clients only see the nonce
+    '''
+    digest = hmac.new(get_captcha_secret(), f'challenge:{nonce}'.encode(), hashlib.sha256).digest()
+    shapes = list(CAPTCHA_SHAPES)
+    for i in range(len(shapes) - 1, 0, -1):
+        j = digest[i] % (i + 1)
+        shapes[i], shapes[j] = shapes[j], shapes[i]
+    options = shapes[:CAPTCHA_OPTION_COUNT]
+    return options[digest[16] % CAPTCHA_OPTION_COUNT], options
+
+def captcha_option_handle(token: str, shape: str) -> str:
+    '''Opaque per-challenge id of an option; the client posts the handle it picked'''
+    return hmac.new(get_captcha_secret(), f'option:{token}:{shape}'.encode(), hashlib.sha256).hexdigest()[:16]
+
+def get_captcha_pool() -> Dict[str, List[str]]:
+    '''Pre-rendered PNG data URIs per shape, loaded on the first challenge of the container'''
+    global _captcha_pool
+    if _captcha_pool is None:
+        with open(CAPTCHA_POOL_PATH) as f:
+            _captcha_pool = json.load(f)['images']
+    return _captcha_pool
+
+def sign_captcha(session_token: str, user_id: int, campaign_id: int, issued_at: int, nonce: str) -> str:
+    session_digest = hashlib.sha256(session_token.encode()).hexdigest()
+    message = f'{session_digest}:{user_id}:{campaign_id}:{issued_at}:{nonce}'.encode()
+    return hmac.new(get_captcha_secret(), message, hashlib.sha256).hexdigest()[:32]
+
+def issue_captcha(session_token: str, user_id: int, campaign_id: int) -> Dict[str, Any]:
+    '''Challenge for a verified session: a pooled image of the target and opaque option handles, never the answer'''
+    issued_at = int(time.time())
+    nonce = os.urandom(8).hex()
+    signature = sign_captcha(session_token, user_id, campaign_id, issued_at, nonce)
+    token = f'{issued_at}.{campaign_id}.{user_id}.{nonce}.{signature}'
+    target, options = captcha_challenge(nonce)
+    images = get_captcha_pool()[target]
+    return {
+        'token': token,
+        'image': images[int.from_bytes(os.urandom(2), 'little') % len(images)],
+        'options': [{'handle': captcha_option_handle(token, shape), 'shape': shape} for shape in options],
+        'min_view_seconds': CAPTCHA_MIN_VIEW_SECONDS,
+        'expires_in': CAPTCHA_TTL_SECONDS
+    }
+
+def parse_captcha_token(token: Any) -> Optional[Tuple[int, int, int, str, str]]:
+    '''(issued_at, campaign_id, user_id, nonce, signature), or None for anything malformed'''
+    try:
+        issued_at, campaign_id, user_id, nonce, signature = str(token).split('.')
+        return int(issued_at), int(campaign_id), int(user_id), nonce, signature
+    except (TypeError, ValueError):
+        return None
+
+def spend_captcha(nonce: str, expires_at: float, solved: bool) -> None:
+    '''
+    Mark a challenge as answered until it expires anyway. When the set is full, expired
+    entries go first and then the oldest ones, so a flood of fresh challenges can only
+    make the oldest unexpired nonces usable again, never the current ones.
+    '''
+    if len(_captcha_spent) >= CAPTCHA_SPENT_LIMIT:
+        now = time.time()
+        for spent_nonce in [n for n, (until, _) in _captcha_spent.items() if until <= now]:
+            del _captcha_spent[spent_nonce]
+        while len(_captcha_spent) >= CAPTCHA_SPENT_LIMIT:
+            _captcha_spent.pop(next(iter(_captcha_spent)))
+    _captcha_spent[nonce] = (expires_at, solved)
+
+metrics.register_cache('captcha_spent', lambda: {'entries': len(_captcha_spent), 'capacity': CAPTCHA_SPENT_LIMIT})
+
+def verify_captcha(session_token: str, campaign_id: int, token: Any, answer: Any) -> Optional[str]:
+    '''
+    Error message for an invalid completion, None when the challenge was solved; pure CPU, no SQL.
+    Every challenge takes one answer per container: a wrong one burns the nonce, so the
+    client has to fetch a new challenge instead of trying the remaining options.
+    '''
+    parsed = parse_captcha_token(token)
+    if not parsed:
+        return 'Invalid captcha'
+    issued_at, token_campaign_id, user_id, nonce, signature = parsed
+    expires_at = issued_at + CAPTCHA_TTL_SECONDS
+    
+    spent = _captcha_spent.get(nonce)
+    if spent and spent[0] > time.time():
+        return 'Captcha already used' if spent[1] else 'Invalid captcha'
+    
+    try:
+        signature = signature.encode('ascii')
+        answer = str(answer).encode('ascii')
+    except UnicodeEncodeError:
+        return 'Invalid captcha'
+    if token_campaign_id != campaign_id:
+        return 'Invalid captcha'
+    if not hmac.compare_digest(signature, sign_captcha(session_token, user_id, campaign_id, issued_at, nonce).encode()):
+        return 'Invalid captcha'
+    
+    elapsed = time.time() - issued_at
+    if elapsed < CAPTCHA_MIN_VIEW_SECONDS:
+        return 'View time too short'
+    if elapsed > CAPTCHA_TTL_SECONDS:
+        return 'Captcha expired'
+    solved = hmac.compare_digest(answer, captcha_option_handle(token, captcha_challenge(nonce)[0]).encode())
+    spend_captcha(nonce, expires_at, solved)
+    return None if solved else 'Invalid captcha'
+
+def build_session_user_query(session_token: str) -> str:
+    return f"""
         SELECT u.id, u.referred_by FROM sessions s
         JOIN users u ON s.user_id = u.id
-        WHERE s.session_token = '{escaped_token}' AND s.expires_at > NOW()
+        WHERE s.session_token = '{escape_sql_string(session_token)}' AND s.expires_at > NOW()
         """
+
+def build_campaign_lookup_query(campaign_id: int) -> str:
+    return (
+        "SELECT id, advertiser_id, cost_per_view, total_views, required_views, CURRENT_DATE AS today "
+        f"FROM campaigns WHERE id = {int(campaign_id)} AND is_active = true AND moderation_status = 'approved'"
     )
+
+def build_ad_view_insert_query(user_id: int, campaign_id: int, reward: float) -> str:
+    return f"""INSERT INTO ad_views (user_id, campaign_id, reward, completed, completed_at)
+        VALUES ({user_id}, {campaign_id}, {reward}, true, NOW())
+        ON CONFLICT (user_id, campaign_id, (created_at::date)) DO NOTHING
+        RETURNING id"""
+
+def build_referral_upsert_query(referrer_id: int, user_id: int, reward: float) -> str:
+    return f"""
+        WITH referrer AS (
+            UPDATE users SET credits = credits + {reward}, total_referral_earnings = total_referral_earnings + {reward}
+            WHERE id = {referrer_id}
+        )
+        INSERT INTO referral_earnings (referrer_id, referred_user_id, day, views, credits)
+        VALUES ({referrer_id}, {user_id}, CURRENT_DATE, 1, {reward})
+        ON CONFLICT (referrer_id, referred_user_id, day) DO UPDATE SET
+            views = referral_earnings.views + 1,
+            credits = referral_earnings.credits + EXCLUDED.credits
+        """
+
+def build_rollup_upsert_query(campaign_id: int, advertiser_id: int, spend: float, payout: float,
+                              referral_payout: float) -> str:
+    return f"""
+        WITH hourly AS (
+            INSERT INTO campaign_stats_hourly (campaign_id, advertiser_id, hour, views, spend, payouts, referral_payouts)
+            VALUES ({campaign_id}, {advertiser_id}, DATE_TRUNC('hour', NOW()), 1, {spend}, {payout}, {referral_payout})
+            ON CONFLICT (campaign_id, hour) DO UPDATE SET
+                views = campaign_stats_hourly.views + 1,
+                spend = campaign_stats_hourly.spend + EXCLUDED.spend,
+                payouts = campaign_stats_hourly.payouts + EXCLUDED.payouts,
+                referral_payouts = campaign_stats_hourly.referral_payouts + EXCLUDED.referral_payouts
+        )
+        INSERT INTO campaign_stats_daily (campaign_id, advertiser_id, day, views, spend, payouts, referral_payouts)
+        VALUES ({campaign_id}, {advertiser_id}, CURRENT_DATE, 1, {spend}, {payout}, {referral_payout})
+        ON CONFLICT (campaign_id, day) DO UPDATE SET
+            views = campaign_stats_daily.views + 1,
+            spend = campaign_stats_daily.spend + EXCLUDED.spend,
+            payouts = campaign_stats_daily.payouts + EXCLUDED.payouts,
+            referral_payouts = campaign_stats_daily.referral_payouts + EXCLUDED.referral_payouts
+        """
+
+def get_user_from_session(session_token: str, cur):
+    cur.execute(build_session_user_query(session_token))
     return cur.fetchone()
 
+@metrics.instrument('ptc-view')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Complete PTC view and earn credits (0.7 per view, 0.1 to referrer)
@@ -36,101 +306,118 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'statusCode': 200,
             'headers': {
                 'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token, Idempotency-Key',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
     
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+    if method not in ['GET', 'POST']:
+        return error_response(405, 'Method not allowed')
     
     headers = event.get('headers', {})
     session_token = headers.get('x-session-token') or headers.get('X-Session-Token')
     
     if not session_token:
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Unauthorized'}),
-            'isBase64Encoded': False
-        }
+        return error_response(401, 'Unauthorized')
+    
+    if method == 'GET':
+        params = event.get('queryStringParameters') or {}
+        try:
+            campaign_id = int(params.get('campaign_id'))
+        except (TypeError, ValueError):
+            return error_response(400, 'campaign_id required')
+        if not get_captcha_secret():
+            return error_response(503, 'Captcha is not configured')
+        
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            user_data = get_user_from_session(session_token, cur)
+        finally:
+            cur.close()
+            conn.close()
+        if not user_data:
+            return error_response(401, 'Invalid session')
+        
+        return json_response(200, issue_captcha(session_token, user_data['id'], campaign_id))
+    
+    body_data = json.loads(event.get('body', '{}'))
+    try:
+        campaign_id = int(body_data.get('campaign_id'))
+    except (TypeError, ValueError):
+        campaign_id = None
+    
+    # Scoped by the session token rather than the user id, so a replay from the
+    # in-memory tier is answered before the captcha check and without any SQL
+    idempotency_key = get_idempotency_key(headers)
+    idempotency_scope = 'ptc-view:' + hashlib.sha256(session_token.encode()).hexdigest()[:32]
+    if idempotency_key:
+        cached = find_cached_response(idempotency_scope, idempotency_key)
+        if cached:
+            return cached
+    
+    captcha_token = body_data.get('captcha_token')
+    # Malformed tokens are rejected without the secret; well-formed ones cannot be checked
+    if not get_captcha_secret() and parse_captcha_token(captcha_token):
+        return error_response(503, 'Captcha is not configured')
+    
+    captcha_error = 'Invalid request' if not campaign_id else verify_captcha(
+        session_token, campaign_id, captcha_token, body_data.get('captcha_answer')
+    )
+    # An expired or already solved token may belong to a retry of a completed view
+    if captcha_error and not (captcha_error in ('Captcha expired', 'Captcha already used') and idempotency_key):
+        return error_response(400, captcha_error)
     
     conn = get_db_connection()
     cur = conn.cursor()
     
     try:
+        if idempotency_key:
+            stored = load_stored_response(cur, idempotency_scope, idempotency_key)
+            if stored:
+                return stored
+        if captcha_error:
+            return error_response(400, captcha_error)
+        
         user_data = get_user_from_session(session_token, cur)
         if not user_data:
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid session'}),
-                'isBase64Encoded': False
-            }
+            return error_response(401, 'Invalid session')
+        if user_data['id'] != parse_captcha_token(captcha_token)[2]:
+            return error_response(400, 'Invalid captcha')
         
         user_id = user_data['id']
         referrer_id = user_data['referred_by']
         
-        body_data = json.loads(event.get('body', '{}'))
-        campaign_id = body_data.get('campaign_id')
-        captcha_correct = body_data.get('captcha_correct', False)
-        
-        if not campaign_id or not captcha_correct:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid request'}),
-                'isBase64Encoded': False
-            }
-        
-        cur.execute(
-            f"SELECT id, cost_per_view, total_views, required_views FROM campaigns WHERE id = {campaign_id} AND is_active = true AND moderation_status = 'approved'"
-        )
+        cur.execute(build_campaign_lookup_query(campaign_id))
         campaign = cur.fetchone()
         
         if not campaign:
-            return {
-                'statusCode': 404,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Campaign not found'}),
-                'isBase64Encoded': False
-            }
+            return error_response(404, 'Campaign not found')
         
         if campaign['total_views'] >= campaign['required_views']:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Campaign views limit reached'}),
-                'isBase64Encoded': False
-            }
+            return error_response(400, 'Campaign views limit reached')
         
-        cur.execute(
-            f"SELECT id FROM ad_views WHERE user_id = {user_id} AND campaign_id = {campaign_id} AND DATE(created_at) = CURRENT_DATE"
-        )
-        if cur.fetchone():
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Already viewed today'}),
-                'isBase64Encoded': False
-            }
+        if daily_views.get_daily_views(cur, campaign['today']).has_viewed(user_id, campaign_id):
+            return error_response(400, 'Already viewed today')
         
         user_reward = 0.7
         referrer_reward = 0.1
         cost_per_view = float(campaign['cost_per_view'])
         
-        cur.execute(
-            f"INSERT INTO ad_views (user_id, campaign_id, reward, completed, completed_at) VALUES ({user_id}, {campaign_id}, {user_reward}, true, NOW()) RETURNING id"
-        )
-        ad_view_id = cur.fetchone()['id']
+        cur.execute(build_ad_view_insert_query(user_id, campaign_id, user_reward))
+        if not cur.fetchone():
+            # A concurrent request with the same key waits here on the unique index
+            # and, once the winner commits, replays its stored response
+            conn.rollback()
+            daily_views.record_view(user_id, campaign_id, campaign['today'])
+            if idempotency_key:
+                stored = load_stored_response(cur, idempotency_scope, idempotency_key)
+                if stored:
+                    return stored
+            return error_response(400, 'Already viewed today')
         
         cur.execute(
             f"UPDATE users SET credits = credits + {user_reward}, total_clicks = total_clicks + 1 WHERE id = {user_id} RETURNING credits"
@@ -138,35 +425,37 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         new_balance = cur.fetchone()['credits']
         
         if referrer_id:
-            cur.execute(
-                f"UPDATE users SET credits = credits + {referrer_reward}, total_referral_earnings = total_referral_earnings + {referrer_reward} WHERE id = {referrer_id}"
-            )
-            
-            cur.execute(
-                f"INSERT INTO referral_earnings (referrer_id, referred_user_id, ad_view_id, credits) VALUES ({referrer_id}, {user_id}, {ad_view_id}, {referrer_reward})"
-            )
+            cur.execute(build_referral_upsert_query(referrer_id, user_id, referrer_reward))
         
         cur.execute(
             f"UPDATE campaigns SET total_views = total_views + 1, spent = spent + {cost_per_view} WHERE id = {campaign_id}"
         )
         
-        escaped_description = escape_sql_string(f'Viewed campaign #{campaign_id}')
+        referral_payout = referrer_reward if referrer_id else 0
+        cur.execute(build_rollup_upsert_query(campaign_id, campaign['advertiser_id'], cost_per_view, user_reward, referral_payout))
+        
         cur.execute(
-            f"INSERT INTO transactions (user_id, type, amount, description) VALUES ({user_id}, 'ad_view', {user_reward}, '{escaped_description}')"
+            f"INSERT INTO transactions (user_id, kind, amount, ref_id) VALUES ({user_id}, {TRANSACTION_KIND_AD_VIEW}, {user_reward}, {campaign_id})"
         )
         
+        response = json_response(200, {
+            'success': True,
+            'reward': user_reward,
+            'new_balance': new_balance
+        })
+        
+        if idempotency_key:
+            stored = store_response(cur, idempotency_scope, idempotency_key, response)
+            if stored:
+                return stored
+        
         conn.commit()
+        daily_views.record_view(user_id, campaign_id, campaign['today'])
+        if idempotency_key:
+            remember_response(idempotency_scope, idempotency_key, response['statusCode'], response['body'])
+            purge_expired_responses(conn)
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'success': True,
-                'reward': user_reward,
-                'new_balance': float(new_balance)
-            }),
-            'isBase64Encoded': False
-        }
+        return response
     
     finally:
         cur.close()
@@ -0,0 +1,138 @@
+'''
+Response serialization and compression benchmark.
+
+Builds synthetic RealDictCursor-shaped rows (Decimal amounts, datetime columns) for
+the heaviest list responses and compares the old path (float()/isoformat() per
+field in a comprehension, then json.dumps) with responses.dumps, and reports body
+size and CPU time for identity, gzip and brotli encodings.
+
+    python backend/response_bench.py
+    python backend/response_bench.py --rows 200 --repeat 200 --json
+'''
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Any, Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'admin'))
+
+import responses
+
+def transaction_rows(count: int) -> List[Dict[str, Any]]:
+    started = datetime(2026, 1, 1)
+    return [
+        {
+            'id': 1000000 + i,
+            'type': ('ad_view', 'credit', 'withdrawal')[i % 3],
+            'amount': Decimal('0.0123') * (i % 17 + 1),
+            'ref_id': 5000 + i % 40,
+            'description': f'Просмотр рекламы: Campaign {i % 40}',
+            'created_at': started + timedelta(seconds=37 * i)
+        }
+        for i in range(count)
+    ]
+
+def withdrawal_rows(count: int) -> List[Dict[str, Any]]:
+    started = datetime(2026, 1, 1)
+    return [
+        {
+            'id': i,
+            'user_id': 700 + i % 90,
+            'username': f'user{700 + i % 90}',
+            'email': f'user{700 + i % 90}@example.com',
+            'credits': Decimal('1500.00') + i,
+            'usd_amount': Decimal('15.00') + Decimal(i) / 100,
+            'wallet_address': f'T{i:033d}',
+            'method_name': 'USDT TRC20',
+            'status': 'pending',
+            'created_at': started + timedelta(minutes=i)
+        }
+        for i in range(count)
+    ]
+
+def legacy_transactions(rows: List[Dict[str, Any]]) -> bytes:
+    return json.dumps({
+        'transactions': [
+            {
+                'id': t['id'],
+                'type': t['type'],
+                'amount': float(t['amount']),
+                'ref_id': t['ref_id'],
+                'description': t['description'],
+                'created_at': t['created_at'].isoformat()
+            }
+            for t in rows
+        ]
+    }).encode()
+
+def legacy_withdrawals(rows: List[Dict[str, Any]]) -> bytes:
+    return json.dumps({
+        'withdrawals': [
+            {key: float(value) if isinstance(value, Decimal) else value.isoformat() if isinstance(value, datetime) else value
+             for key, value in row.items()}
+            for row in rows
+        ]
+    }).encode()
+
+def time_call(fn: Callable[[], Any], repeat: int) -> Tuple[float, Any]:
+    started = time.process_time()
+    for _ in range(repeat):
+        result = fn()
+    return (time.process_time() - started) / repeat * 1e6, result
+
+def run(rows: int, repeat: int) -> Dict[str, Any]:
+    payloads = {
+        'transaction_history': (transaction_rows(rows), legacy_transactions, 'transactions'),
+        'withdrawals': (withdrawal_rows(rows), legacy_withdrawals, 'withdrawals')
+    }
+    report = {'encoder': 'orjson' if responses.load_orjson() else 'json', 'payloads': {}}
+    for name, (data, legacy, key) in payloads.items():
+        legacy_us, legacy_body = time_call(lambda: legacy(data), repeat)
+        new_us, body = time_call(lambda: responses.dumps({key: data}), repeat)
+        result = {
+            'rows': rows,
+            'legacy_serialize_us': round(legacy_us, 1),
+            'serialize_us': round(new_us, 1),
+            'identity_bytes': len(body),
+            'legacy_bytes': len(legacy_body)
+        }
+        encodings = ['gzip'] + (['br'] if responses.load_brotli() else [])
+        for encoding in encodings:
+            compress_us, compressed = time_call(lambda: responses.compress(body, encoding), repeat)
+            result[f'{encoding}_bytes'] = len(compressed)
+            result[f'{encoding}_compress_us'] = round(compress_us, 1)
+            result[f'{encoding}_saved_pct'] = round(100 * (1 - len(compressed) / len(body)), 1)
+        report['payloads'][name] = result
+    return report
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Measure response serialization and compression cost')
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--json', action='store_true', help='print raw results as JSON')
+    args = parser.parse_args(argv)
+
+    report = run(args.rows, max(1, args.repeat))
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+
+    print(f"encoder: {report['encoder']}, brotli: {'yes' if responses.load_brotli() else 'not installed'}")
+    for name, result in report['payloads'].items():
+        print(f"\n{name} ({result['rows']} rows)")
+        print(f"  serialize     legacy {result['legacy_serialize_us']:>9} us   now {result['serialize_us']:>9} us")
+        print(f"  identity      {result['identity_bytes']:>9} B   (legacy json.dumps {result['legacy_bytes']} B)")
+        for encoding in ('gzip', 'br'):
+            if f'{encoding}_bytes' in result:
+                print(
+                    f"  {encoding:<13} {result[f'{encoding}_bytes']:>9} B   "
+                    f"-{result[f'{encoding}_saved_pct']}%   {result[f'{encoding}_compress_us']} us"
+                )
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
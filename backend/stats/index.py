@@ -1,17 +1,20 @@
-import json
-import os
 from typing import Dict, Any
-import psycopg2
-from psycopg2.extras import RealDictCursor
+
+import metrics
+from replica import get_db_connection, get_read_connection
+from responses import json_response, error_response
+
+TOTAL_USERS_SQL = "SELECT COUNT(*) as total_users FROM users"
+ACTIVE_CAMPAIGNS_SQL = "SELECT COUNT(*) as active_campaigns FROM campaigns WHERE is_active = true"
+# Same total as SUM(reward) over completed ad_views, read from the daily rollup
+TOTAL_PAYOUTS_SQL = "SELECT COALESCE(SUM(payouts), 0) as total_payouts FROM campaign_stats_daily"
+AVG_EARNINGS_SQL = "SELECT COALESCE(AVG(balance), 0) as avg_earnings FROM users WHERE balance > 0"
 
 def escape_sql_string(value: str) -> str:
     """Escape single quotes in SQL strings by doubling them"""
     return value.replace("'", "''")
 
-def get_db_connection():
-    database_url = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(database_url, cursor_factory=RealDictCursor)
-
+@metrics.instrument('stats')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Get platform statistics (total users, payouts, campaigns)
@@ -35,44 +38,30 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     if method != 'GET':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+        return error_response(405, 'Method not allowed')
     
-    conn = get_db_connection()
+    conn = get_read_connection()
     cur = conn.cursor()
     
     try:
-        cur.execute("SELECT COUNT(*) as total_users FROM users")
+        cur.execute(TOTAL_USERS_SQL)
         total_users = cur.fetchone()['total_users']
         
-        cur.execute("SELECT COUNT(*) as active_campaigns FROM campaigns WHERE is_active = true")
+        cur.execute(ACTIVE_CAMPAIGNS_SQL)
         active_campaigns = cur.fetchone()['active_campaigns']
         
-        cur.execute(
-            "SELECT COALESCE(SUM(reward), 0) as total_payouts FROM ad_views WHERE completed = true"
-        )
+        cur.execute(TOTAL_PAYOUTS_SQL)
         total_payouts = float(cur.fetchone()['total_payouts'])
         
-        cur.execute(
-            "SELECT COALESCE(AVG(balance), 0) as avg_earnings FROM users WHERE balance > 0"
-        )
+        cur.execute(AVG_EARNINGS_SQL)
         avg_earnings = float(cur.fetchone()['avg_earnings'])
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'total_users': total_users,
-                'active_campaigns': active_campaigns,
-                'total_payouts': round(total_payouts, 2),
-                'avg_earnings': round(avg_earnings, 2)
-            }),
-            'isBase64Encoded': False
-        }
+        return json_response(200, {
+            'total_users': total_users,
+            'active_campaigns': active_campaigns,
+            'total_payouts': round(total_payouts, 2),
+            'avg_earnings': round(avg_earnings, 2)
+        })
     
     finally:
         cur.close()
@@ -0,0 +1,377 @@
+'''
+Request metrics for one backend function, kept in the warm container.
+
+Every function directory ships an identical copy of this module (functions are
+deployed one directory at a time, so they cannot import each other). The handler
+is wrapped with @instrument('<function>') and database connections go through
+connect(), which times the connect and counts every statement executed.
+
+    GET ?action=metrics                  Prometheus text exposition
+    GET ?action=metrics&format=json      same data as JSON
+
+When METRICS_TOKEN is set the X-Metrics-Token header must match it. Counters are
+per container: scrape repeatedly and aggregate by the function/action labels.
+
+With TRAFFIC_CAPTURE_PATH set, a TRAFFIC_CAPTURE_SAMPLE share of requests is
+appended to that file as anonymized NDJSON events with timing ('-' prints them to
+the function log prefixed with 'TRAFFIC '), for backend/traffic_replay.py.
+Only numbers and whitelisted keys are kept as they are: user ids and every other
+string, in the query, JSON bodies of any shape and CSV cells, become salted
+pseudonyms, and bodies that are neither JSON nor CSV are dropped.
+'''
+import json
+import os
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+CONNECT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+MAX_ACTION_LABELS = 50
+CAPTURE_PATH = os.environ.get('TRAFFIC_CAPTURE_PATH')
+CAPTURE_SAMPLE = float(os.environ.get('TRAFFIC_CAPTURE_SAMPLE', '1'))
+CAPTURE_HEADERS = ('content-type', 'accept-encoding', 'x-last-write-lsn')
+PSEUDONYM_HEADERS = ('x-session-token', 'idempotency-key')
+# Captured verbatim; any other string parameter or body value is pseudonymized
+CAPTURE_PARAMS = ('action', 'table', 'format', 'type', 'granularity', 'from', 'to', 'cursor')
+CAPTURE_FIELDS = ('action', 'decision', 'status')
+# User ids are pseudonymized even when numeric; traffic_replay.py maps them to local users
+PSEUDONYM_ID_FIELDS = ('user_id', 'advertiser_id')
+DROPPED_FIELDS = ('captcha_token', 'captcha_answer')
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        total = 0
+        result = []
+        for bound, count in zip([str(b) for b in self.buckets] + ['+Inf'], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'buckets': dict(self.cumulative()), 'sum': round(self.sum, 6), 'count': sum(self.counts)}
+
+_function = ''
+_current_action = ''
+_started_at = time.time()
+_requests: Dict[Tuple[str, str, int], int] = {}
+_latency: Dict[str, Histogram] = {}
+_statements: Dict[str, int] = {}
+_db_connect: Dict[str, Histogram] = {}
+_db_connect_failures: Dict[str, int] = {}
+_cache_events: Dict[Tuple[str, str], int] = {}
+_cache_gauges: Dict[str, Callable[[], Dict[str, float]]] = {}
+_cursor_class = None
+_capture_salt: Optional[bytes] = None
+_capture_errors = 0
+
+def request_action(event: Dict[str, Any]) -> str:
+    '''action query parameter, else the action key of a JSON body, else the method'''
+    method = event.get('httpMethod', 'GET')
+    action = (event.get('queryStringParameters') or {}).get('action')
+    body = event.get('body') or ''
+    if not action and method == 'POST' and body.startswith('{'):
+        try:
+            action = json.loads(body).get('action')
+        except (ValueError, AttributeError):
+            action = None
+    action = str(action or method.lower())[:40]
+    if action not in _latency and len(_latency) >= MAX_ACTION_LABELS:
+        return 'other'
+    return action
+
+def count_statement() -> None:
+    _statements[_current_action] = _statements.get(_current_action, 0) + 1
+
+def count_cache(cache: str, outcome: str) -> None:
+    _cache_events[(cache, outcome)] = _cache_events.get((cache, outcome), 0) + 1
+
+def register_cache(cache: str, stats: Callable[[], Dict[str, float]]) -> None:
+    '''stats() returns current gauge values, e.g. {'entries': 120, 'age_seconds': 30}'''
+    _cache_gauges[cache] = stats
+
+def counting_cursor():
+    '''RealDictCursor that counts execute/executemany/copy_expert calls'''
+    global _cursor_class
+    if _cursor_class is None:
+        from psycopg2.extras import RealDictCursor
+
+        class CountingCursor(RealDictCursor):
+            def execute(self, query, vars=None):
+                count_statement()
+                return super().execute(query, vars)
+
+            def executemany(self, query, vars_list):
+                count_statement()
+                return super().executemany(query, vars_list)
+
+            def copy_expert(self, sql, file, size=8192):
+                count_statement()
+                return super().copy_expert(sql, file, size)
+
+        _cursor_class = CountingCursor
+    return _cursor_class
+
+def connect(dsn: Optional[str], target: str = 'primary', **kwargs):
+    import psycopg2
+
+    started = time.perf_counter()
+    try:
+        conn = psycopg2.connect(dsn, cursor_factory=counting_cursor(), **kwargs)
+    except psycopg2.Error:
+        _db_connect_failures[target] = _db_connect_failures.get(target, 0) + 1
+        raise
+    _db_connect.setdefault(target, Histogram(CONNECT_BUCKETS)).observe(time.perf_counter() - started)
+    return conn
+
+def pseudonym(value: Any) -> str:
+    '''
+    Stable per-salt replacement for a secret or personal value. Set
+    TRAFFIC_CAPTURE_SALT to keep pseudonyms consistent across containers.
+    '''
+    global _capture_salt
+    import hashlib
+    import hmac
+
+    if _capture_salt is None:
+        _capture_salt = os.environ.get('TRAFFIC_CAPTURE_SALT', '').encode() or os.urandom(16)
+    return hmac.new(_capture_salt, str(value).encode(), hashlib.sha256).hexdigest()[:24]
+
+def is_number(value: Any) -> bool:
+    if isinstance(value, bool) or value is None:
+        return True
+    if isinstance(value, (int, float)):
+        return True
+    return isinstance(value, str) and value.lstrip('-').replace('.', '', 1).isdigit()
+
+def anonymize_value(key: str, value: Any, verbatim: Tuple[str, ...]) -> Any:
+    '''Whitelist: numbers and verbatim keys stay, user ids and every other string get a pseudonym'''
+    if isinstance(value, dict):
+        return {k: anonymize_value(k, v, verbatim) for k, v in value.items() if k not in DROPPED_FIELDS}
+    if isinstance(value, list):
+        return [anonymize_value(key, item, verbatim) for item in value]
+    if key in PSEUDONYM_ID_FIELDS and value not in (None, ''):
+        return 'anon-' + pseudonym(value)
+    if key == 'email' and value:
+        return pseudonym(str(value).lower()) + '@replay.test'
+    if key == 'password' and value:
+        return 'replay-password'
+    if key in verbatim or is_number(value) or value == '':
+        return value
+    return 'anon-' + pseudonym(value)
+
+def anonymize_body(body: str, content_type: str) -> str:
+    '''JSON of any shape goes through anonymize_value; CSV keeps its header row and numeric cells'''
+    if 'csv' in content_type:
+        import csv
+        import io
+
+        rows = list(csv.reader(io.StringIO(body)))
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerows(rows[:1])
+        writer.writerows([[cell if is_number(cell) else 'anon-' + pseudonym(cell) for cell in row] for row in rows[1:]])
+        return out.getvalue()
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return ''
+    return json.dumps(anonymize_value('', data, CAPTURE_FIELDS))
+
+def anonymize_event(event: Dict[str, Any]) -> Dict[str, Any]:
+    headers = {}
+    for name, value in (event.get('headers') or {}).items():
+        name = name.lower()
+        if name in CAPTURE_HEADERS:
+            headers[name] = value
+        elif name in PSEUDONYM_HEADERS:
+            headers[name] = 'anon-' + pseudonym(value)
+
+    body = event.get('body') or ''
+    if body and not event.get('isBase64Encoded'):
+        body = anonymize_body(body, str(headers.get('content-type', '')).lower())
+    elif body:
+        body = ''
+
+    params = event.get('queryStringParameters') or {}
+    return {
+        'httpMethod': event.get('httpMethod', 'GET'),
+        'headers': headers,
+        'queryStringParameters': {key: anonymize_value(key, value, CAPTURE_PARAMS) for key, value in params.items()},
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+def capture(event: Dict[str, Any], started_at: float, duration: float, status: int) -> None:
+    import random
+
+    if random.random() >= CAPTURE_SAMPLE:
+        return
+    line = json.dumps({
+        'function': _function,
+        'ts': round(started_at, 6),
+        'duration_ms': round(duration * 1000, 3),
+        'status': status,
+        'event': anonymize_event(event)
+    })
+    if CAPTURE_PATH == '-':
+        print('TRAFFIC ' + line, flush=True)
+    else:
+        with open(CAPTURE_PATH, 'a') as f:
+            f.write(line + '\n')
+
+def escape_label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def labels(**values: Any) -> str:
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in values.items()) + '}'
+
+def render_histogram(lines: List[str], name: str, histogram: Histogram, **values: Any) -> None:
+    for bound, total in histogram.cumulative():
+        lines.append(f'{name}_bucket{labels(**values, le=bound)} {total}')
+    lines.append(f'{name}_sum{labels(**values)} {histogram.sum:.6f}')
+    lines.append(f'{name}_count{labels(**values)} {sum(histogram.counts)}')
+
+def render_prometheus() -> str:
+    fn = _function
+    lines = [
+        '# HELP ptp_container_start_time_seconds Unix time this container loaded the function',
+        '# TYPE ptp_container_start_time_seconds gauge',
+        f'ptp_container_start_time_seconds{labels(function=fn)} {_started_at:.3f}',
+        '# HELP ptp_requests_total Requests handled, by action, method and status',
+        '# TYPE ptp_requests_total counter'
+    ]
+    for (action, method, status), count in sorted(_requests.items()):
+        lines.append(f'ptp_requests_total{labels(function=fn, action=action, method=method, status=status)} {count}')
+
+    lines += ['# HELP ptp_errors_total Responses with status >= 400', '# TYPE ptp_errors_total counter']
+    errors: Dict[int, int] = {}
+    for (_, _, status), count in _requests.items():
+        if status >= 400:
+            errors[status] = errors.get(status, 0) + count
+    for status, count in sorted(errors.items()):
+        lines.append(f'ptp_errors_total{labels(function=fn, status=status)} {count}')
+
+    lines += ['# HELP ptp_request_duration_seconds Handler latency', '# TYPE ptp_request_duration_seconds histogram']
+    for action, histogram in sorted(_latency.items()):
+        render_histogram(lines, 'ptp_request_duration_seconds', histogram, function=fn, action=action)
+
+    lines += ['# HELP ptp_db_statements_total SQL statements executed', '# TYPE ptp_db_statements_total counter']
+    for action, count in sorted(_statements.items()):
+        lines.append(f'ptp_db_statements_total{labels(function=fn, action=action)} {count}')
+
+    lines += ['# HELP ptp_db_connect_seconds Time to open a database connection', '# TYPE ptp_db_connect_seconds histogram']
+    for target, histogram in sorted(_db_connect.items()):
+        render_histogram(lines, 'ptp_db_connect_seconds', histogram, function=fn, target=target)
+
+    lines += ['# HELP ptp_db_connect_failures_total Failed connection attempts', '# TYPE ptp_db_connect_failures_total counter']
+    for target, count in sorted(_db_connect_failures.items()):
+        lines.append(f'ptp_db_connect_failures_total{labels(function=fn, target=target)} {count}')
+
+    lines += ['# HELP ptp_cache_events_total In-container cache lookups by outcome', '# TYPE ptp_cache_events_total counter']
+    for (cache, outcome), count in sorted(_cache_events.items()):
+        lines.append(f'ptp_cache_events_total{labels(function=fn, cache=cache, outcome=outcome)} {count}')
+
+    lines += ['# HELP ptp_cache_stat Current in-container cache gauges', '# TYPE ptp_cache_stat gauge']
+    for cache, stats in sorted(_cache_gauges.items()):
+        for stat, value in sorted(stats().items()):
+            lines.append(f'ptp_cache_stat{labels(function=fn, cache=cache, stat=stat)} {value}')
+
+    if CAPTURE_PATH:
+        lines += [
+            '# HELP ptp_capture_errors_total Traffic capture writes that failed',
+            '# TYPE ptp_capture_errors_total counter',
+            f'ptp_capture_errors_total{labels(function=fn)} {_capture_errors}'
+        ]
+
+    return '\n'.join(lines) + '\n'
+
+def snapshot() -> Dict[str, Any]:
+    return {
+        'function': _function,
+        'container_started_at': _started_at,
+        'requests': [
+            {'action': action, 'method': method, 'status': status, 'count': count}
+            for (action, method, status), count in sorted(_requests.items())
+        ],
+        'latency_seconds': {action: histogram.to_dict() for action, histogram in _latency.items()},
+        'db_statements': dict(_statements),
+        'db_connect_seconds': {target: histogram.to_dict() for target, histogram in _db_connect.items()},
+        'db_connect_failures': dict(_db_connect_failures),
+        'cache_events': [
+            {'cache': cache, 'outcome': outcome, 'count': count}
+            for (cache, outcome), count in sorted(_cache_events.items())
+        ],
+        'caches': {cache: stats() for cache, stats in _cache_gauges.items()},
+        'capture_errors': _capture_errors
+    }
+
+def metrics_response(event: Dict[str, Any]) -> Dict[str, Any]:
+    headers = event.get('headers') or {}
+    token = os.environ.get('METRICS_TOKEN')
+    if token and (headers.get('x-metrics-token') or headers.get('X-Metrics-Token')) != token:
+        return {
+            'statusCode': 401,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'error': 'Unauthorized'}),
+            'isBase64Encoded': False
+        }
+
+    if (event.get('queryStringParameters') or {}).get('format') == 'json':
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps(snapshot()),
+            'isBase64Encoded': False
+        }
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'text/plain; version=0.0.4', 'Access-Control-Allow-Origin': '*'},
+        'body': render_prometheus(),
+        'isBase64Encoded': False
+    }
+
+def instrument(function_name: str):
+    '''Wrap a handler: serve ?action=metrics and record every other request'''
+    def decorate(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]):
+        @wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            global _function, _current_action, _capture_errors
+            _function = function_name
+            method = event.get('httpMethod', 'GET')
+            if method == 'GET' and (event.get('queryStringParameters') or {}).get('action') == 'metrics':
+                return metrics_response(event)
+
+            action = request_action(event)
+            _current_action = action
+            started_at = time.time()
+            started = time.perf_counter()
+            status = 500
+            try:
+                response = handler(event, context)
+                status = response.get('statusCode', 200)
+                return response
+            finally:
+                duration = time.perf_counter() - started
+                _latency.setdefault(action, Histogram(LATENCY_BUCKETS)).observe(duration)
+                _requests[(action, method, status)] = _requests.get((action, method, status), 0) + 1
+                _current_action = ''
+                if CAPTURE_PATH and method != 'OPTIONS':
+                    # Capture must never change the response the handler produced
+                    try:
+                        capture(event, started_at, duration, status)
+                    except Exception:
+                        _capture_errors += 1
+        return wrapper
+    return decorate
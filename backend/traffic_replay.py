@@ -0,0 +1,383 @@
+'''
+Replay captured traffic against local functions and compare two builds.
+
+Capture: set TRAFFIC_CAPTURE_PATH (and optionally TRAFFIC_CAPTURE_SAMPLE,
+TRAFFIC_CAPTURE_SALT) on the functions; metrics.py appends anonymized
+handler(event, context) inputs with timing. With TRAFFIC_CAPTURE_PATH=- the events
+go to the function log; 'extract' pulls them back out.
+
+    python backend/traffic_replay.py extract function.log > capture.ndjson
+    python backend/traffic_replay.py run capture.ndjson --dsn postgresql://localhost/replay \
+        --seed-sessions --speed 10 --concurrency 8 --output before.json
+    python backend/traffic_replay.py run capture.ndjson --backend ../new-build/backend \
+        --dsn postgresql://localhost/replay --speed 10 --concurrency 8 --output after.json
+    python backend/traffic_replay.py compare before.json after.json
+
+Each function runs in its own worker process (module names repeat across function
+directories) with handler() called in-process and timed there, as cold_start_bench.py
+does; nothing but handler() is required from the build under test. Events keep their
+captured spacing divided by --speed. An event whose replay itself fails (not the
+handler) is reported on stderr and makes the run exit with 1. ptc-view completions get a freshly
+signed captcha, since captured tokens are dropped and bound to the real session.
+Pseudonymized user ids in parameters and bodies are pointed at existing local users.
+Reset the database between runs (plan_check.py --setup) so both builds see the same data.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+CAPTURE_PREFIX = 'TRAFFIC '
+# metrics.PSEUDONYM_ID_FIELDS: captured as pseudonyms, replayed as existing local users
+USER_ID_FIELDS = ('user_id', 'advertiser_id')
+
+WORKER = r'''
+import importlib.util, json, os, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+function_dir, events_path, start_at, speed, concurrency = sys.argv[1], sys.argv[2], float(sys.argv[3]), float(sys.argv[4]), int(sys.argv[5])
+sys.path.insert(0, function_dir)
+spec = importlib.util.spec_from_file_location('index', os.path.join(function_dir, 'index.py'))
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+
+class Context:
+    function_name = os.path.basename(function_dir)
+    def __init__(self, request_id):
+        self.request_id = request_id
+
+session_users = {}
+
+def session_user(session_token):
+    if session_token not in session_users:
+        conn = module.get_db_connection()
+        cur = conn.cursor()
+        try:
+            user = module.get_user_from_session(session_token, cur)
+        finally:
+            cur.close()
+            conn.close()
+        session_users[session_token] = user['id'] if user else 0
+    return session_users[session_token]
+
+def resign_captcha(i, event):
+    if not hasattr(module, 'sign_captcha') or event['httpMethod'] != 'POST':
+        return event
+    try:
+        body = json.loads(event['body'] or '{}')
+        campaign_id = int(body['campaign_id'])
+    except (ValueError, KeyError, TypeError):
+        return event
+    session_token = event['headers'].get('x-session-token', '')
+    user_id = session_user(session_token)
+    issued_at = int(time.time()) - module.CAPTCHA_MIN_VIEW_SECONDS - 1
+    nonce = f'replay{i}'
+    signature = module.sign_captcha(session_token, user_id, campaign_id, issued_at, nonce)
+    token = f'{issued_at}.{campaign_id}.{user_id}.{nonce}.{signature}'
+    body['captcha_token'] = token
+    body['captcha_answer'] = module.captcha_option_handle(token, module.captcha_challenge(nonce)[0])
+    return dict(event, body=json.dumps(body))
+
+lock = threading.Lock()
+
+def run(i, record):
+    delay = start_at + record['offset'] / speed - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    lag = max(0.0, -delay)
+    event = resign_captcha(i, record['event'])
+    started = time.perf_counter()
+    try:
+        status = module.handler(event, Context(f'replay-{i}')).get('statusCode', 200)
+        error = None
+    except Exception as e:
+        status, error = 599, f'{type(e).__name__}: {e}'[:200]
+    result = {
+        'i': record['i'],
+        'status': status,
+        'latency_ms': (time.perf_counter() - started) * 1000,
+        'lag_ms': lag * 1000,
+        'captured_status': record.get('status')
+    }
+    if error:
+        result['error'] = error
+    with lock:
+        print(json.dumps(result), flush=True)
+
+with open(events_path) as f:
+    records = [json.loads(line) for line in f]
+failures = 0
+with ThreadPoolExecutor(max_workers=concurrency) as pool:
+    futures = [(record, pool.submit(run, i, record)) for i, record in enumerate(records)]
+    for record, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            failures += 1
+            print(f"{Context.function_name}: replay of event {record['i']} failed: {type(e).__name__}: {e}",
+                  file=sys.stderr, flush=True)
+sys.exit(1 if failures else 0)
+'''
+
+def request_action(event: Dict[str, Any]) -> str:
+    '''action query parameter, else the action key of a JSON body, else the method'''
+    method = event.get('httpMethod', 'GET')
+    action = (event.get('queryStringParameters') or {}).get('action')
+    body = event.get('body') or ''
+    if not action and method == 'POST' and body.startswith('{'):
+        try:
+            action = json.loads(body).get('action')
+        except (ValueError, AttributeError):
+            action = None
+    return str(action or method.lower())[:40]
+
+def load_capture(path: str) -> List[Dict[str, Any]]:
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda record: record['ts'])
+    first = records[0]['ts'] if records else 0
+    for i, record in enumerate(records):
+        record['i'] = i
+        record['offset'] = record['ts'] - first
+    return records
+
+def load_user_ids(dsn: str) -> List[int]:
+    import psycopg2
+
+    conn = psycopg2.connect(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM users ORDER BY id LIMIT 10000")
+        user_ids = [row[0] for row in cur.fetchall()]
+    finally:
+        conn.close()
+    if not user_ids:
+        raise SystemExit('no users in the replay database; run plan_check.py --setup first')
+    return user_ids
+
+def local_user(user_ids: List[int], value: str) -> int:
+    '''The same pseudonym always lands on the same local user'''
+    return user_ids[int(value[5:13], 16) % len(user_ids)]
+
+def map_user_ids(dsn: str, records: List[Dict[str, Any]]) -> int:
+    '''Replace pseudonymized user ids in query parameters and JSON bodies with local users'''
+    user_ids: List[int] = []
+    mapped = 0
+
+    def replace(value: Any, key: str = '') -> Any:
+        nonlocal mapped
+        if isinstance(value, dict):
+            return {k: replace(v, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [replace(item, key) for item in value]
+        if key in USER_ID_FIELDS and isinstance(value, str) and value.startswith('anon-'):
+            if not user_ids:
+                user_ids.extend(load_user_ids(dsn))
+            mapped += 1
+            return local_user(user_ids, value)
+        return value
+
+    for record in records:
+        event = record['event']
+        event['queryStringParameters'] = {k: str(v) for k, v in replace(event.get('queryStringParameters') or {}).items()}
+        body = event.get('body') or ''
+        if body[:1] in ('{', '['):
+            event['body'] = json.dumps(replace(json.loads(body)))
+    return mapped
+
+def seed_sessions(dsn: str, records: List[Dict[str, Any]]) -> int:
+    '''Create a session for every pseudonymized token, owned by an existing local user'''
+    import psycopg2
+
+    tokens = sorted({
+        record['event']['headers']['x-session-token']
+        for record in records if record['event']['headers'].get('x-session-token')
+    })
+    if not tokens:
+        return 0
+
+    user_ids = load_user_ids(dsn)
+    conn = psycopg2.connect(dsn)
+    try:
+        cur = conn.cursor()
+        values = ', '.join(
+            f"({local_user(user_ids, token)}, '{token}', NOW() + INTERVAL '1 day')"
+            for token in tokens
+        )
+        cur.execute(
+            f"""INSERT INTO sessions (user_id, session_token, expires_at) VALUES {values}
+                ON CONFLICT (session_token) DO UPDATE SET expires_at = EXCLUDED.expires_at"""
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return len(tokens)
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def summarize(results: List[Dict[str, Any]], wall_seconds: float, failed: int) -> Dict[str, Any]:
+    groups: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for result in results:
+        groups[f"{result['function']}:{result['action']}"].append(result)
+        groups[f"{result['function']}:*"].append(result)
+
+    summary = {}
+    for key, items in sorted(groups.items()):
+        latencies = [item['latency_ms'] for item in items]
+        statuses: Dict[str, int] = defaultdict(int)
+        for item in items:
+            statuses[str(item['status'])] += 1
+        summary[key] = {
+            'count': len(items),
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'mean_ms': round(statistics.mean(latencies), 2),
+            'errors_5xx': sum(1 for item in items if item['status'] >= 500),
+            'errors_4xx': sum(1 for item in items if 400 <= item['status'] < 500),
+            'status_changed': sum(
+                1 for item in items if item['captured_status'] is not None and item['status'] != item['captured_status']
+            ),
+            'statuses': dict(statuses),
+            'max_lag_ms': round(max(item['lag_ms'] for item in items), 2)
+        }
+    return {'requests': len(results), 'failed': failed, 'wall_seconds': round(wall_seconds, 2), 'groups': summary}
+
+def run_replay(records: List[Dict[str, Any]], backend: str, dsn: str, speed: float, concurrency: int) -> Dict[str, Any]:
+    by_function: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for record in records:
+        by_function[record['function']].append(record)
+
+    env = dict(os.environ, DATABASE_URL=dsn, CAPTCHA_SECRET='traffic-replay')
+    for name in ('DATABASE_REPLICA_URL', 'TRAFFIC_CAPTURE_PATH'):
+        env.pop(name, None)
+
+    by_index = {record['i']: record for record in records}
+    start_at = time.time() + 1.0
+    workers = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, function_records in sorted(by_function.items()):
+            function_dir = os.path.join(os.path.abspath(backend), name)
+            if not os.path.isfile(os.path.join(function_dir, 'index.py')):
+                print(f'skipping {len(function_records)} events for unknown function {name}', file=sys.stderr)
+                continue
+            events_path = os.path.join(tmp, f'{name}.ndjson')
+            with open(events_path, 'w') as f:
+                for record in function_records:
+                    f.write(json.dumps(record) + '\n')
+            workers.append((name, subprocess.Popen(
+                [sys.executable, '-c', WORKER, function_dir, events_path, str(start_at), str(speed), str(concurrency)],
+                stdout=subprocess.PIPE, text=True, env=env
+            )))
+
+        results = []
+        for name, worker in workers:
+            stdout, _ = worker.communicate()
+            replayed = [json.loads(line) for line in stdout.splitlines() if line.startswith('{"i"')]
+            for result in replayed:
+                result.update(function=name, action=request_action(by_index[result['i']]['event']))
+            results.extend(replayed)
+            if worker.returncode:
+                print(f'{name}: worker exited with {worker.returncode}', file=sys.stderr)
+
+    return summarize(results, time.time() - start_at, sum(len(by_function[name]) for name, _ in workers) - len(results))
+
+def compare(before: Dict[str, Any], after: Dict[str, Any], max_regression_pct: float) -> int:
+    print(f"{'group':<32} {'count':>6} {'p50 ms':>16} {'p95 ms':>16} {'p99 ms':>16} {'5xx':>9} {'4xx':>9}")
+    regressions = []
+    for key in sorted(set(before['groups']) | set(after['groups'])):
+        a, b = before['groups'].get(key), after['groups'].get(key)
+        if a is None or b is None:
+            print(f"{key:<32} only in {'after' if a is None else 'before'}")
+            continue
+
+        cells = []
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            delta = b[metric] - a[metric]
+            pct = 100 * delta / a[metric] if a[metric] else 0.0
+            cells.append(f"{b[metric]:>7} {pct:+7.1f}%")
+            if metric == 'p95_ms' and pct > max_regression_pct and key.endswith(':*'):
+                regressions.append(f'{key}: p95 {a[metric]} -> {b[metric]} ms ({pct:+.1f}%)')
+        errors = [f"{b[field]:>4}{b[field] - a[field]:+4d}" for field in ('errors_5xx', 'errors_4xx')]
+        if b['errors_5xx'] > a['errors_5xx']:
+            regressions.append(f"{key}: 5xx {a['errors_5xx']} -> {b['errors_5xx']}")
+        print(f"{key:<32} {b['count']:>6} {cells[0]:>16} {cells[1]:>16} {cells[2]:>16} {errors[0]:>9} {errors[1]:>9}")
+
+    for regression in regressions:
+        print(f'REGRESSION {regression}', file=sys.stderr)
+    return 1 if regressions else 0
+
+def extract(log_path: str) -> int:
+    with open(log_path) as f:
+        for line in f:
+            position = line.find(CAPTURE_PREFIX + '{')
+            if position >= 0:
+                print(line[position + len(CAPTURE_PREFIX):].rstrip())
+    return 0
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Replay captured handler traffic and compare builds')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    extract_parser = commands.add_parser('extract', help='pull captured events out of a function log')
+    extract_parser.add_argument('log')
+
+    run_parser = commands.add_parser('run', help='replay a capture against one build')
+    run_parser.add_argument('capture')
+    run_parser.add_argument('--backend', default=BACKEND_DIR, help='backend/ directory of the build to run')
+    run_parser.add_argument('--dsn', default=os.environ.get('DATABASE_URL'))
+    run_parser.add_argument('--speed', type=float, default=1.0, help='divide captured gaps by this factor')
+    run_parser.add_argument('--concurrency', type=int, default=8, help='in-flight requests per function')
+    run_parser.add_argument('--functions', nargs='*', help='replay only these functions')
+    run_parser.add_argument('--seed-sessions', action='store_true', help='create sessions for captured tokens first')
+    run_parser.add_argument('--output')
+
+    compare_parser = commands.add_parser('compare', help='latency and error deltas between two runs')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--max-p95-regression', type=float, default=20.0, help='percent, per function')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'extract':
+        return extract(args.log)
+
+    if args.command == 'compare':
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        return compare(before, after, args.max_p95_regression)
+
+    if not args.dsn:
+        parser.error('--dsn or DATABASE_URL is required')
+    records = load_capture(args.capture)
+    if args.functions:
+        records = [record for record in records if record['function'] in args.functions]
+    if args.seed_sessions:
+        print(f'seeded {seed_sessions(args.dsn, records)} sessions', file=sys.stderr)
+    map_user_ids(args.dsn, records)
+
+    report = run_replay(records, args.backend, args.dsn, max(args.speed, 0.001), max(1, args.concurrency))
+    report.update({'capture': args.capture, 'backend': os.path.abspath(args.backend), 'speed': args.speed,
+                   'concurrency': args.concurrency})
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output if not args.output else f"{report['requests']} requests in {report['wall_seconds']} s -> {args.output}")
+    if report['failed']:
+        print(f"{report['failed']} events were not replayed", file=sys.stderr)
+    return 1 if report['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
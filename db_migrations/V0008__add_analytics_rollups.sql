@@ -0,0 +1,49 @@
+-- Почасовые агрегаты по кампаниям (просмотры, расход рекламодателя, выплаты)
+CREATE TABLE IF NOT EXISTS campaign_stats_hourly (
+    campaign_id INTEGER NOT NULL REFERENCES campaigns(id),
+    advertiser_id INTEGER NOT NULL REFERENCES users(id),
+    hour TIMESTAMP NOT NULL,
+    views INTEGER NOT NULL DEFAULT 0,
+    spend DECIMAL(15, 2) NOT NULL DEFAULT 0.00,
+    payouts DECIMAL(15, 2) NOT NULL DEFAULT 0.00,
+    referral_payouts DECIMAL(15, 2) NOT NULL DEFAULT 0.00,
+    PRIMARY KEY (campaign_id, hour)
+);
+
+-- Дневные агрегаты по кампаниям
+CREATE TABLE IF NOT EXISTS campaign_stats_daily (
+    campaign_id INTEGER NOT NULL REFERENCES campaigns(id),
+    advertiser_id INTEGER NOT NULL REFERENCES users(id),
+    day DATE NOT NULL,
+    views INTEGER NOT NULL DEFAULT 0,
+    spend DECIMAL(15, 2) NOT NULL DEFAULT 0.00,
+    payouts DECIMAL(15, 2) NOT NULL DEFAULT 0.00,
+    referral_payouts DECIMAL(15, 2) NOT NULL DEFAULT 0.00,
+    PRIMARY KEY (campaign_id, day)
+);
+
+CREATE INDEX IF NOT EXISTS idx_campaign_stats_hourly_advertiser ON campaign_stats_hourly(advertiser_id, hour);
+CREATE INDEX IF NOT EXISTS idx_campaign_stats_daily_advertiser ON campaign_stats_daily(advertiser_id, day);
+CREATE INDEX IF NOT EXISTS idx_campaign_stats_daily_day ON campaign_stats_daily(day);
+
+-- Заполняем агрегаты из истории просмотров (расход по текущей цене просмотра кампании)
+INSERT INTO campaign_stats_hourly (campaign_id, advertiser_id, hour, views, spend, payouts, referral_payouts)
+SELECT av.campaign_id,
+       c.advertiser_id,
+       DATE_TRUNC('hour', COALESCE(av.completed_at, av.created_at)),
+       COUNT(*),
+       SUM(c.cost_per_view),
+       SUM(av.reward),
+       COALESCE(SUM(re.credits), 0)
+FROM ad_views av
+JOIN campaigns c ON c.id = av.campaign_id
+LEFT JOIN referral_earnings re ON re.ad_view_id = av.id
+WHERE av.completed = true
+GROUP BY av.campaign_id, c.advertiser_id, DATE_TRUNC('hour', COALESCE(av.completed_at, av.created_at))
+ON CONFLICT (campaign_id, hour) DO NOTHING;
+
+INSERT INTO campaign_stats_daily (campaign_id, advertiser_id, day, views, spend, payouts, referral_payouts)
+SELECT campaign_id, advertiser_id, hour::date, SUM(views), SUM(spend), SUM(payouts), SUM(referral_payouts)
+FROM campaign_stats_hourly
+GROUP BY campaign_id, advertiser_id, hour::date
+ON CONFLICT (campaign_id, day) DO NOTHING;
@@ -0,0 +1,9 @@
+-- Покрывающие индексы для постраничной истории транзакций (keyset по created_at, id)
+CREATE INDEX IF NOT EXISTS idx_transactions_user_history
+    ON transactions(user_id, created_at DESC, id DESC) INCLUDE (type, amount, description);
+
+CREATE INDEX IF NOT EXISTS idx_transactions_user_type_history
+    ON transactions(user_id, type, created_at DESC, id DESC) INCLUDE (amount, description);
+
+-- Старый индекс по user_id покрывается новым
+DROP INDEX IF EXISTS idx_transactions_user;
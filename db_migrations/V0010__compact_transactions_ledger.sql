@@ -0,0 +1,52 @@
+-- Компактный журнал транзакций: тип SMALLINT и ссылка на объект вместо текстов
+-- kind: 1 = ad_view (ref_id -> campaigns), 2 = credit/ваучер (ref_id -> vouchers),
+--       3 = withdrawal (ref_id -> withdrawal_requests), 4 = campaign_create (ref_id -> campaigns), 0 = прочее
+ALTER TABLE transactions
+  ADD COLUMN kind SMALLINT,
+  ADD COLUMN ref_id INTEGER;
+
+UPDATE transactions SET kind = CASE type
+    WHEN 'ad_view' THEN 1
+    WHEN 'credit' THEN 2
+    WHEN 'withdrawal' THEN 3
+    WHEN 'campaign_create' THEN 4
+    ELSE 0
+END;
+
+UPDATE transactions
+SET ref_id = SUBSTRING(description FROM 'Viewed campaign #([0-9]+)')::INTEGER
+WHERE kind = 1;
+
+UPDATE transactions t
+SET ref_id = v.id
+FROM vouchers v
+WHERE t.kind = 2 AND v.code = SUBSTRING(t.description FROM 'Voucher: (.*)$');
+
+UPDATE transactions
+SET ref_id = SUBSTRING(description FROM 'Withdrawal #([0-9]+)')::INTEGER
+WHERE kind = 3;
+
+UPDATE transactions t
+SET ref_id = (
+    SELECT c.id FROM campaigns c
+    WHERE c.advertiser_id = t.user_id AND 'Created campaign: ' || c.title = t.description
+    ORDER BY ABS(EXTRACT(EPOCH FROM c.created_at - t.created_at))
+    LIMIT 1
+)
+WHERE t.kind = 4;
+
+ALTER TABLE transactions ALTER COLUMN kind SET NOT NULL;
+
+-- Пересоздаём индексы истории без текстовых колонок
+DROP INDEX IF EXISTS idx_transactions_user_history;
+DROP INDEX IF EXISTS idx_transactions_user_type_history;
+
+ALTER TABLE transactions
+  DROP COLUMN type,
+  DROP COLUMN description;
+
+CREATE INDEX IF NOT EXISTS idx_transactions_user_history
+    ON transactions(user_id, created_at DESC, id DESC) INCLUDE (kind, amount, ref_id);
+
+CREATE INDEX IF NOT EXISTS idx_transactions_user_kind_history
+    ON transactions(user_id, kind, created_at DESC, id DESC) INCLUDE (amount, ref_id);
@@ -0,0 +1,19 @@
+-- Реферальные начисления: одна строка на (реферер, реферал, день) вместо строки на каждый просмотр
+ALTER TABLE referral_earnings RENAME TO referral_earnings_legacy;
+
+CREATE TABLE referral_earnings (
+  referrer_id INTEGER NOT NULL REFERENCES users(id),
+  referred_user_id INTEGER NOT NULL REFERENCES users(id),
+  day DATE NOT NULL,
+  views INTEGER NOT NULL DEFAULT 0,
+  credits DECIMAL(15, 2) NOT NULL DEFAULT 0.00,
+  PRIMARY KEY (referrer_id, referred_user_id, day)
+);
+
+-- Сжимаем существующую историю (суммы точные, users.total_referral_earnings не меняется)
+INSERT INTO referral_earnings (referrer_id, referred_user_id, day, views, credits)
+SELECT referrer_id, referred_user_id, created_at::date, COUNT(*), SUM(credits)
+FROM referral_earnings_legacy
+GROUP BY referrer_id, referred_user_id, created_at::date;
+
+DROP TABLE referral_earnings_legacy;
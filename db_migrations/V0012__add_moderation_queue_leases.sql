@@ -0,0 +1,7 @@
+-- Очередь модерации: аренда пачки кампаний модератором
+ALTER TABLE campaigns
+  ADD COLUMN moderation_lease_owner VARCHAR(100),
+  ADD COLUMN moderation_lease_until TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_campaigns_pending_queue
+    ON campaigns(created_at, id) WHERE moderation_status = 'pending';
@@ -0,0 +1,12 @@
+-- Сохранённые ответы для повторных запросов с заголовком Idempotency-Key
+-- scope: '<действие>:<user_id>', чтобы ключи разных пользователей не пересекались
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+  scope VARCHAR(50) NOT NULL,
+  idem_key VARCHAR(100) NOT NULL,
+  status_code SMALLINT NOT NULL,
+  response TEXT NOT NULL,
+  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (scope, idem_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys(created_at);
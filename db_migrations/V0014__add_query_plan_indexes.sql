@@ -0,0 +1,13 @@
+-- Индексы под реальные запросы обработчиков (проверяются backend/plan_check.py)
+
+-- Дедупликация просмотров и лента доступных кампаний: user_id + campaign_id + диапазон дня
+CREATE INDEX IF NOT EXISTS idx_ad_views_user_campaign_created ON ad_views(user_id, campaign_id, created_at);
+DROP INDEX IF EXISTS idx_ad_views_user;
+
+-- Активные одобренные кампании в порядке ленты
+CREATE INDEX IF NOT EXISTS idx_campaigns_live
+    ON campaigns(created_at DESC) WHERE is_active = true AND moderation_status = 'approved';
+
+-- Последние ваучеры и заявки на вывод в админке
+CREATE INDEX IF NOT EXISTS idx_vouchers_created ON vouchers(created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_withdrawal_created ON withdrawal_requests(created_at DESC);
@@ -0,0 +1,25 @@
+-- Нормализованный email: вход ищет по LOWER(email), регистрация — INSERT ... ON CONFLICT ((LOWER(email)))
+-- Аккаунты, отличающиеся только регистром email, автоматически не сливаются (у каждого свой баланс и история):
+-- миграция останавливается со списком таких email, их нужно разобрать вручную и запустить её снова
+DO $$
+DECLARE
+    duplicates TEXT;
+BEGIN
+    SELECT string_agg(email_lower || ' (id ' || ids || ')', ', ')
+    INTO duplicates
+    FROM (
+        SELECT LOWER(email) AS email_lower, string_agg(id::text, ', ' ORDER BY id) AS ids
+        FROM users
+        GROUP BY LOWER(email)
+        HAVING COUNT(*) > 1
+        ORDER BY LOWER(email)
+        LIMIT 50
+    ) d;
+
+    IF duplicates IS NOT NULL THEN
+        RAISE EXCEPTION 'users.email differs only by case for: %', duplicates
+            USING HINT = 'Merge or rename these accounts, then rerun the migration';
+    END IF;
+END $$;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email_lower ON users(LOWER(email));
@@ -0,0 +1,20 @@
+-- Один засчитанный просмотр кампании на пользователя в день: финальная проверка для ptc-view
+-- (INSERT ... ON CONFLICT (user_id, campaign_id, (created_at::date)) DO NOTHING)
+-- Гонка SELECT-then-INSERT в прежнем ptc-view могла записать несколько просмотров за день:
+-- оставляем самый ранний, иначе уникальный индекс не создастся (начисления остаются в transactions)
+DELETE FROM ad_views
+WHERE id IN (
+  SELECT id FROM (
+    SELECT id, ROW_NUMBER() OVER (PARTITION BY user_id, campaign_id, created_at::date ORDER BY id) AS n
+    FROM ad_views
+  ) ranked
+  WHERE n > 1
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_ad_views_user_campaign_day ON ad_views(user_id, campaign_id, (created_at::date));
+
+-- Загрузка и догрузка дневного индекса просмотров (daily_views.py) без чтения таблицы
+CREATE INDEX IF NOT EXISTS idx_ad_views_created ON ad_views(created_at) INCLUDE (id, user_id, campaign_id);
+
+-- Уникальный индекс покрывает поиск по (user_id, campaign_id), прежний индекс только замедляет вставки
+DROP INDEX IF EXISTS idx_ad_views_user_campaign_created;
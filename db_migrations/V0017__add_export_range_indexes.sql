@@ -0,0 +1,7 @@
+-- Выгрузка за период (admin export, export.py) фильтрует по дате, а не по пользователю
+
+-- Журнал транзакций пишется только в конец, порядок строк совпадает с created_at: BRIN почти не весит
+CREATE INDEX IF NOT EXISTS idx_transactions_created_brin ON transactions USING brin (created_at);
+
+-- Реферальные начисления: новая строка раз в день на пару, обновления счётчиков индекс не трогают
+CREATE INDEX IF NOT EXISTS idx_referral_earnings_day ON referral_earnings(day);
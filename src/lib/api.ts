@@ -6,6 +6,46 @@ const API_BASE = {
   admin: 'https://functions.poehali.dev/6a1dc141-0dd3-4944-b24a-072bdd7c2393',
 };
 
+// Kept in sessionStorage so a reload right after a write still reads it back from the primary
+const ADMIN_LAST_WRITE_LSN_KEY = 'adminLastWriteLsn';
+
+// pg_lsn "X/Y" (hex halves) as a number, for keeping the later of two positions
+const lsnValue = (lsn: string): number => {
+  const [high, low] = lsn.split('/');
+  return parseInt(high, 16) * 2 ** 32 + parseInt(low, 16);
+};
+
+const rememberAdminWrite = (response: Response): Response => {
+  const lastWriteLsn = response.headers.get('X-Last-Write-LSN');
+  const adminLastWriteLsn = sessionStorage.getItem(ADMIN_LAST_WRITE_LSN_KEY);
+  if (lastWriteLsn && (!adminLastWriteLsn || lsnValue(lastWriteLsn) > lsnValue(adminLastWriteLsn))) {
+    sessionStorage.setItem(ADMIN_LAST_WRITE_LSN_KEY, lastWriteLsn);
+  }
+  return response;
+};
+
+const adminReadHeaders = (): HeadersInit => {
+  const adminLastWriteLsn = sessionStorage.getItem(ADMIN_LAST_WRITE_LSN_KEY);
+  return adminLastWriteLsn ? { 'X-Last-Write-LSN': adminLastWriteLsn } : {};
+};
+
+const IDEMPOTENT_RETRIES = 2;
+
+// Sends a money-moving request, retrying network failures, 5xx and 409 (still in progress)
+// with the same Idempotency-Key so the backend replays the first outcome instead of acting twice
+const fetchIdempotent = async (url: string, init: RequestInit, idempotencyKey: string): Promise<Response> => {
+  const headers = { ...init.headers, 'Idempotency-Key': idempotencyKey };
+  for (let attempt = 0; ; attempt++) {
+    try {
+      const response = await fetch(url, { ...init, headers });
+      if ((response.status < 500 && response.status !== 409) || attempt >= IDEMPOTENT_RETRIES) return response;
+    } catch (error) {
+      if (attempt >= IDEMPOTENT_RETRIES) throw error;
+    }
+    await new Promise((resolve) => setTimeout(resolve, 500 * 2 ** attempt));
+  }
+};
+
 export interface User {
   id: number;
   email: string;
@@ -53,6 +93,57 @@ export interface CampaignResponse {
   error?: string;
 }
 
+export interface StatsPoint {
+  bucket: string;
+  views: number;
+  spend: number;
+  payouts: number;
+  referral_payouts: number;
+}
+
+export interface AnalyticsResponse {
+  granularity?: 'hour' | 'day';
+  series?: StatsPoint[];
+  error?: string;
+}
+
+export interface BulkCampaignInput {
+  title: string;
+  url: string;
+  required_views: number;
+}
+
+export interface BulkCampaignResult {
+  row: number;
+  success: boolean;
+  campaign_id?: number;
+  total_cost?: number;
+  error?: string;
+}
+
+export interface BulkCampaignResponse {
+  success?: boolean;
+  created?: number;
+  total_cost?: number;
+  results?: BulkCampaignResult[];
+  message?: string;
+  error?: string;
+}
+
+export interface CaptchaOption {
+  handle: string;
+  shape: string;
+}
+
+export interface CaptchaChallenge {
+  token: string;
+  image: string;
+  options: CaptchaOption[];
+  min_view_seconds: number;
+  expires_in: number;
+  error?: string;
+}
+
 export interface PTCViewResponse {
   success: boolean;
   reward?: number;
@@ -87,6 +178,44 @@ export interface WithdrawalHistory {
   method_name: string;
 }
 
+export interface Transaction {
+  id: number;
+  type: 'ad_view' | 'credit' | 'withdrawal' | 'campaign_create' | 'campaign_refund' | 'campaign_import' | 'other';
+  amount: number;
+  ref_id: number | null;
+  description: string;
+  created_at: string;
+}
+
+export interface TransactionHistory {
+  transactions?: Transaction[];
+  next_cursor?: string | null;
+  error?: string;
+}
+
+export interface ModerationCampaign {
+  id: number;
+  advertiser_id: number;
+  title: string;
+  url: string;
+  budget: number;
+  required_views: number;
+  created_at: string;
+}
+
+export interface ModerationLease {
+  campaigns?: ModerationCampaign[];
+  lease_until?: string | null;
+  error?: string;
+}
+
+export interface ModerationResult {
+  success?: boolean;
+  processed?: number[];
+  skipped?: number[];
+  error?: string;
+}
+
 export interface VoucherResponse {
   success: boolean;
   credits_added?: number;
@@ -143,6 +272,19 @@ export const campaignsAPI = {
     return response.json();
   },
 
+  bulkCreate: async (sessionToken: string, campaigns: BulkCampaignInput[] | string): Promise<BulkCampaignResponse> => {
+    const isCsv = typeof campaigns === 'string';
+    const response = await fetch(`${API_BASE.campaigns}?action=bulk_create`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': isCsv ? 'text/csv' : 'application/json',
+        'X-Session-Token': sessionToken,
+      },
+      body: isCsv ? campaigns : JSON.stringify({ campaigns }),
+    });
+    return response.json();
+  },
+
   getAvailable: async (sessionToken: string): Promise<CampaignResponse> => {
     const response = await fetch(`${API_BASE.campaigns}?action=available`, {
       headers: { 'X-Session-Token': sessionToken },
@@ -150,6 +292,20 @@ export const campaignsAPI = {
     return response.json();
   },
 
+  getAnalytics: async (
+    sessionToken: string,
+    granularity: 'hour' | 'day' = 'day',
+    days = 30,
+    campaignId?: number
+  ): Promise<AnalyticsResponse> => {
+    const campaignParam = campaignId ? `&campaign_id=${campaignId}` : '';
+    const response = await fetch(
+      `${API_BASE.campaigns}?action=analytics&granularity=${granularity}&days=${days}${campaignParam}`,
+      { headers: { 'X-Session-Token': sessionToken } }
+    );
+    return response.json();
+  },
+
   getList: async (): Promise<CampaignResponse> => {
     const response = await fetch(API_BASE.campaigns);
     return response.json();
@@ -157,31 +313,48 @@ export const campaignsAPI = {
 };
 
 export const ptcViewAPI = {
-  complete: async (sessionToken: string, campaignId: number, captchaCorrect: boolean): Promise<PTCViewResponse> => {
-    const response = await fetch(API_BASE.ptcView, {
+  getChallenge: async (sessionToken: string, campaignId: number): Promise<CaptchaChallenge> => {
+    const response = await fetch(`${API_BASE.ptcView}?campaign_id=${campaignId}`, {
+      headers: { 'X-Session-Token': sessionToken },
+    });
+    return response.json();
+  },
+
+  complete: async (
+    sessionToken: string,
+    campaignId: number,
+    captchaToken: string,
+    captchaAnswer: string,
+    idempotencyKey: string
+  ): Promise<PTCViewResponse> => {
+    const response = await fetchIdempotent(API_BASE.ptcView, {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
         'X-Session-Token': sessionToken,
       },
-      body: JSON.stringify({ campaign_id: campaignId, captcha_correct: captchaCorrect }),
-    });
+      body: JSON.stringify({ campaign_id: campaignId, captcha_token: captchaToken, captcha_answer: captchaAnswer }),
+    }, idempotencyKey);
     return response.json();
   },
 };
 
 export const adminAPI = {
-  activateVoucher: async (userId: number, voucherCode: string): Promise<VoucherResponse> => {
-    const response = await fetch(API_BASE.admin, {
+  activateVoucher: async (
+    userId: number,
+    voucherCode: string,
+    idempotencyKey: string
+  ): Promise<VoucherResponse> => {
+    const response = rememberAdminWrite(await fetchIdempotent(API_BASE.admin, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ action: 'activate_voucher', user_id: userId, voucher_code: voucherCode }),
-    });
+    }, idempotencyKey));
     return response.json();
   },
 
   getWithdrawalInfo: async (): Promise<WithdrawalInfo> => {
-    const response = await fetch(`${API_BASE.admin}?action=withdrawal_methods`);
+    const response = await fetch(`${API_BASE.admin}?action=withdrawal_methods`, { headers: adminReadHeaders() });
     return response.json();
   },
 
@@ -189,9 +362,10 @@ export const adminAPI = {
     userId: number,
     credits: number,
     methodId: number,
-    walletAddress: string
+    walletAddress: string,
+    idempotencyKey: string
   ): Promise<WithdrawalRequest> => {
-    const response = await fetch(API_BASE.admin, {
+    const response = rememberAdminWrite(await fetchIdempotent(API_BASE.admin, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({
@@ -201,48 +375,87 @@ export const adminAPI = {
         method_id: methodId,
         wallet_address: walletAddress,
       }),
-    });
+    }, idempotencyKey));
     return response.json();
   },
 
   getWithdrawalHistory: async (userId: number): Promise<{ history: WithdrawalHistory[] }> => {
-    const response = await fetch(`${API_BASE.admin}?action=withdrawal_history&user_id=${userId}`);
+    const response = await fetch(`${API_BASE.admin}?action=withdrawal_history&user_id=${userId}`, { headers: adminReadHeaders() });
+    return response.json();
+  },
+
+  getTransactionHistory: async (
+    userId: number,
+    cursor?: string | null,
+    type?: Exclude<Transaction['type'], 'other'>
+  ): Promise<TransactionHistory> => {
+    const params = new URLSearchParams({ action: 'transaction_history', user_id: String(userId) });
+    if (cursor) params.set('cursor', cursor);
+    if (type) params.set('type', type);
+    const response = await fetch(`${API_BASE.admin}?${params}`, { headers: adminReadHeaders() });
     return response.json();
   },
 
   generateVouchers: async (credits: number, count: number): Promise<Response> => {
-    return fetch(API_BASE.admin, {
+    return rememberAdminWrite(await fetch(API_BASE.admin, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ action: 'generate_vouchers', credits, count }),
-    });
+    }));
   },
 
   getVouchers: async (): Promise<any> => {
-    const response = await fetch(`${API_BASE.admin}?action=vouchers`);
+    const response = await fetch(`${API_BASE.admin}?action=vouchers`, { headers: adminReadHeaders() });
+    return response.json();
+  },
+
+  getSettings: async (): Promise<any> => {
+    const response = await fetch(`${API_BASE.admin}?action=settings`, { headers: adminReadHeaders() });
     return response.json();
   },
 
   getWithdrawals: async (): Promise<any> => {
-    const response = await fetch(`${API_BASE.admin}?action=withdrawals`);
+    const response = await fetch(`${API_BASE.admin}?action=withdrawals`, { headers: adminReadHeaders() });
     return response.json();
   },
 
   processWithdrawal: async (requestId: number, status: 'completed' | 'rejected'): Promise<{ success: boolean }> => {
-    const response = await fetch(API_BASE.admin, {
+    const response = rememberAdminWrite(await fetch(API_BASE.admin, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ action: 'process_withdrawal', request_id: requestId, status }),
-    });
+    }));
+    return response.json();
+  },
+
+  leaseModeration: async (moderator: string, batchSize = 50): Promise<ModerationLease> => {
+    const response = rememberAdminWrite(await fetch(API_BASE.admin, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ action: 'moderation_lease', moderator, batch_size: batchSize }),
+    }));
+    return response.json();
+  },
+
+  moderateCampaigns: async (
+    moderator: string,
+    campaignIds: number[],
+    decision: 'approve' | 'reject'
+  ): Promise<ModerationResult> => {
+    const response = rememberAdminWrite(await fetch(API_BASE.admin, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ action: 'moderate_campaigns', moderator, campaign_ids: campaignIds, decision }),
+    }));
     return response.json();
   },
 
   updateRate: async (rate: number): Promise<{ success: boolean; rate: number }> => {
-    const response = await fetch(API_BASE.admin, {
+    const response = rememberAdminWrite(await fetch(API_BASE.admin, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({ action: 'update_rate', rate }),
-    });
+    }));
     return response.json();
   },
 };
@@ -33,7 +33,7 @@ const Admin = () => {
       const [vouchersRes, withdrawalsRes, settingsRes] = await Promise.all([
         adminAPI.getVouchers(),
         adminAPI.getWithdrawals(),
-        fetch(`https://functions.poehali.dev/6a1dc141-0dd3-4944-b24a-072bdd7c2393?action=settings`).then(r => r.json())
+        adminAPI.getSettings()
       ]);
 
       if (vouchersRes.vouchers) setVouchers(vouchersRes.vouchers);
@@ -1,4 +1,4 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import { useNavigate } from "react-router-dom";
 import { Button } from "@/components/ui/button";
 import { Card } from "@/components/ui/card";
@@ -44,6 +44,9 @@ const Index = () => {
     walletAddress: ''
   });
   const [withdrawalHistory, setWithdrawalHistory] = useState<WithdrawalHistory[]>([]);
+  // One Idempotency-Key per submitted payload, kept until a response arrives so a resubmit after a network error reuses it
+  const pendingIdempotencyKeys = useRef<Record<string, string>>({});
+  const idempotencyKeyFor = (payload: string) => (pendingIdempotencyKeys.current[payload] ??= crypto.randomUUID());
   const { toast } = useToast();
 
   useEffect(() => {
@@ -174,8 +177,10 @@ const Index = () => {
     e.preventDefault();
     if (!user || !voucherCode.trim()) return;
 
+    const payload = `voucher:${user.id}:${voucherCode.trim()}`;
     try {
-      const response = await adminAPI.activateVoucher(user.id, voucherCode.trim());
+      const response = await adminAPI.activateVoucher(user.id, voucherCode.trim(), idempotencyKeyFor(payload));
+      delete pendingIdempotencyKeys.current[payload];
       
       if (response.success) {
         toast({ 
@@ -225,8 +230,10 @@ const Index = () => {
       return;
     }
 
+    const payload = `withdrawal:${user.id}:${credits}:${methodId}:${walletAddress}`;
     try {
-      const response = await adminAPI.requestWithdrawal(user.id, credits, methodId, walletAddress);
+      const response = await adminAPI.requestWithdrawal(user.id, credits, methodId, walletAddress, idempotencyKeyFor(payload));
+      delete pendingIdempotencyKeys.current[payload];
       
       if (response.success) {
         toast({ 
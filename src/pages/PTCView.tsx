@@ -5,18 +5,7 @@ import { Card } from "@/components/ui/card";
 import { Progress } from "@/components/ui/progress";
 import { useToast } from "@/hooks/use-toast";
 import Icon from "@/components/ui/icon";
-import { ptcViewAPI, campaignsAPI, type Campaign } from "@/lib/api";
-
-const CAPTCHA_IMAGES = [
-  { id: 1, emoji: "🐶", name: "dog" },
-  { id: 2, emoji: "🐱", name: "cat" },
-  { id: 3, emoji: "🦁", name: "lion" },
-  { id: 4, emoji: "🐘", name: "elephant" },
-  { id: 5, emoji: "🦊", name: "fox" },
-  { id: 6, emoji: "🐼", name: "panda" },
-  { id: 7, emoji: "🦉", name: "owl" },
-  { id: 8, emoji: "🦋", name: "butterfly" },
-];
+import { ptcViewAPI, campaignsAPI, type Campaign, type CaptchaChallenge } from "@/lib/api";
 
 const PTCView = () => {
   const [searchParams] = useSearchParams();
@@ -27,10 +16,11 @@ const PTCView = () => {
   const [currentIndex, setCurrentIndex] = useState(0);
   const [timer, setTimer] = useState(5);
   const [showCaptcha, setShowCaptcha] = useState(false);
-  const [captchaTarget, setCaptchaTarget] = useState<typeof CAPTCHA_IMAGES[0] | null>(null);
-  const [captchaOptions, setCaptchaOptions] = useState<typeof CAPTCHA_IMAGES>([]);
+  const [challenge, setChallenge] = useState<CaptchaChallenge | null>(null);
   const [isProcessing, setIsProcessing] = useState(false);
   const iframeRef = useRef<HTMLIFrameElement>(null);
+  // Idempotency-Key of the completion for the current challenge, reused if the user retries after a network error
+  const completionKey = useRef('');
 
   useEffect(() => {
     const sessionToken = localStorage.getItem('session_token');
@@ -50,6 +40,27 @@ const PTCView = () => {
     });
   }, [navigate, toast]);
 
+  const loadChallenge = (campaignId: number) => {
+    const sessionToken = localStorage.getItem('session_token');
+    if (!sessionToken) return;
+
+    setChallenge(null);
+    completionKey.current = crypto.randomUUID();
+    ptcViewAPI.getChallenge(sessionToken, campaignId).then((response) => {
+      if (response.token) {
+        setChallenge(response);
+      } else {
+        toast({ title: "Ошибка", description: response.error || "Не удалось загрузить капчу", variant: "destructive" });
+      }
+    });
+  };
+
+  useEffect(() => {
+    if (currentCampaign) {
+      loadChallenge(currentCampaign.id);
+    }
+  }, [currentCampaign]);
+
   useEffect(() => {
     if (currentCampaign && timer > 0 && !showCaptcha) {
       let isPageVisible = !document.hidden;
@@ -71,31 +82,12 @@ const PTCView = () => {
         document.removeEventListener('visibilitychange', handleVisibilityChange);
       };
     } else if (timer === 0 && !showCaptcha) {
-      generateCaptcha();
       setShowCaptcha(true);
     }
   }, [timer, currentCampaign, showCaptcha]);
 
-  const generateCaptcha = () => {
-    const shuffled = [...CAPTCHA_IMAGES].sort(() => Math.random() - 0.5);
-    const target = shuffled[0];
-    const wrongOptions = shuffled.slice(1, 4);
-    const options = [target, ...wrongOptions].sort(() => Math.random() - 0.5);
-    
-    setCaptchaTarget(target);
-    setCaptchaOptions(options);
-  };
-
-  const handleCaptchaAnswer = async (selectedId: number) => {
-    if (isProcessing || !currentCampaign || !captchaTarget) return;
-    
-    const isCorrect = selectedId === captchaTarget.id;
-    
-    if (!isCorrect) {
-      toast({ title: "Неверно!", description: "Попробуй ещё раз", variant: "destructive" });
-      generateCaptcha();
-      return;
-    }
+  const handleCaptchaAnswer = async (handle: string) => {
+    if (isProcessing || !currentCampaign || !challenge) return;
 
     setIsProcessing(true);
     const sessionToken = localStorage.getItem('session_token');
@@ -106,7 +98,7 @@ const PTCView = () => {
     }
 
     try {
-      const response = await ptcViewAPI.complete(sessionToken, currentCampaign.id, true);
+      const response = await ptcViewAPI.complete(sessionToken, currentCampaign.id, challenge.token, handle, completionKey.current);
       
       if (response.success) {
         toast({ 
@@ -129,6 +121,19 @@ const PTCView = () => {
           toast({ title: "Все кампании просмотрены!", description: "Возвращаемся в кабинет" });
           setTimeout(() => navigate('/'), 2000);
         }
+      } else if (response.error === 'Invalid captcha') {
+        toast({ title: "Неверно!", description: "Посмотри рекламу ещё раз", variant: "destructive" });
+        setShowCaptcha(false);
+        setTimer(5);
+        setIsProcessing(false);
+        loadChallenge(currentCampaign.id);
+      } else if (response.error === 'Captcha expired' || response.error === 'Captcha already used') {
+        // Every challenge takes one answer: start over with a new one
+        toast({ title: "Капча устарела", description: "Посмотри рекламу ещё раз", variant: "destructive" });
+        setShowCaptcha(false);
+        setTimer(5);
+        setIsProcessing(false);
+        loadChallenge(currentCampaign.id);
       } else {
         toast({ title: "Ошибка", description: response.error || "Не удалось засчитать просмотр", variant: "destructive" });
         setIsProcessing(false);
@@ -195,28 +200,30 @@ const PTCView = () => {
             </h2>
             
             <div className="mb-8 text-center">
-              <p className="text-muted-foreground mb-4">Выбери такую же картинку:</p>
+              <p className="text-muted-foreground mb-4">Выбери такую же фигуру:</p>
               <div className="inline-block p-8 rounded-2xl bg-gradient-to-br from-primary/20 to-secondary/20 border-2 border-primary/50">
-                <div 
-                  className="text-8xl select-none pointer-events-none"
-                  style={{ userSelect: 'none', WebkitUserSelect: 'none' }}
-                  onContextMenu={(e) => e.preventDefault()}
-                  onDragStart={(e) => e.preventDefault()}
-                >
-                  {captchaTarget?.emoji}
-                </div>
+                {challenge && (
+                  <img
+                    src={challenge.image}
+                    alt=""
+                    className="w-32 h-32 select-none pointer-events-none"
+                    style={{ userSelect: 'none', WebkitUserSelect: 'none', imageRendering: 'pixelated' }}
+                    onContextMenu={(e) => e.preventDefault()}
+                    onDragStart={(e) => e.preventDefault()}
+                  />
+                )}
               </div>
             </div>
 
             <div className="grid grid-cols-2 gap-4">
-              {captchaOptions.map((option) => (
+              {(challenge?.options ?? []).map((option) => (
                 <button
-                  key={option.id}
-                  onClick={() => handleCaptchaAnswer(option.id)}
+                  key={option.handle}
+                  onClick={() => handleCaptchaAnswer(option.handle)}
                   disabled={isProcessing}
                   className="p-8 rounded-2xl bg-gradient-to-br from-muted/50 to-muted/30 border-2 border-border hover:border-primary transition-all hover:scale-105 disabled:opacity-50"
                 >
-                  <div className="text-6xl">{option.emoji}</div>
+                  <Icon name={option.shape} size={64} className="mx-auto" />
                 </button>
               ))}
             </div>